@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Microbenchmark of job_runner.ExpireCollection against the implementation it replaced,
+# which started a threading.Timer per added item and scanned a deque on each membership check
+# Usage: bench_expire_collection.py [--items N] [--lookups N]
+import argparse, collections, threading, time, timeit
+import job_runner
+
+
+class TimerExpireCollection:
+    """The former ExpireCollection, kept here for comparison"""
+    def __init__(self, timeout=60*60*3):
+        self.timeout = timeout
+        self.events = collections.deque()
+        self.timers = []
+
+    def add(self, item):
+        self.events.append(item)
+        timer = threading.Timer(self.timeout, self.expire)
+        timer.start()
+        self.timers.append(timer)
+
+    def __len__(self):
+        return len(self.events)
+
+    def expire(self):
+        self.events.popleft()
+
+    def __contains__(self, elem):
+        return elem in self.events
+
+    def cancel(self):
+        for timer in self.timers:
+            timer.cancel()
+        for timer in self.timers:
+            timer.join()
+
+
+def bench(name, collection, items, lookups):
+    threads_before = threading.active_count()
+    start = time.time()
+    for item in items:
+        collection.add(item)
+    add_seconds = time.time() - start
+    threads = threading.active_count() - threads_before
+    missing = [('missing', i) for i in range(lookups)]
+    hits = [items[i % len(items)] for i in range(lookups)]
+    hit_seconds = timeit.timeit(lambda: [h in collection for h in hits], number=1)
+    miss_seconds = timeit.timeit(lambda: [m in collection for m in missing], number=1)
+    print('{0:>8}: add {1:8.1f} us/item, hit {2:8.2f} us/lookup, miss {3:8.2f} us/lookup, {4} extra threads'.format(
+        name, add_seconds * 1e6 / len(items), hit_seconds * 1e6 / lookups, miss_seconds * 1e6 / lookups, threads))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+    # Items shaped like the blacklisted FullConfs
+    region_conf = list(job_runner.regions_conf.values())[0]
+    items = [job_runner.FullConf(job_runner.ClusterConf('r3.xlarge', 0.1, str(i), '1', '20G', 'hvm'), region_conf, region_conf.region + 'a')
+             for i in range(args.items)]
+    legacy = TimerExpireCollection()
+    try:
+        bench('timer', legacy, items, args.lookups)
+    finally:
+        legacy.cancel()
+    bench('heap', job_runner.ExpireCollection(), items, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# Benchmarks of the job_runner.py supervisor loop against the in-process fake backend (see fake_backend.py)
+# Usage:
+#   bench_runner.py selection [--repeat N] [--api-latency SECONDS]
+#       Latency of get_best_conf_and_az: cold (empty cache), warm and after the cache TTL expired
+#   bench_runner.py recovery [--failures N] [--warm-standby]
+#       Time from a cluster failure until the job runs again, in simulated minutes
+#   bench_runner.py soak [--hours N] [--warm-standby] [--stall-rate RATE] [--no-rest-api] [--stages-page]
+#       Runs the supervisor for N simulated hours with injected failures (and stuck jobs) and reports its CPU, memory and threads
+#   bench_runner.py assembly
+#       Time from setup until the sanity check job starts, with the assembly cache cold and warm, in simulated minutes
+#   bench_runner.py resume
+#       Time for a restarted runner to get back to its cluster, with and without the state store, and the import time
+import argparse, logging, os, resource, shutil, subprocess, sys, tempfile, threading, time
+import job_runner
+import fake_backend
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))] if values else float('nan')
+
+
+def install_fake(args, **kwargs):
+    fake = fake_backend.FakeBackend(seed=args.seed, time_scale=args.time_scale, api_latency=args.api_latency, **kwargs)
+    job_runner.use_backend(fake)
+    cache_dir = tempfile.mkdtemp(prefix='bench-runner-')
+    job_runner.spot_price_cache = job_runner.SpotPriceHistoryCache(os.path.join(cache_dir, 'spot_price_history.json'))
+    job_runner.state_store = job_runner.StateStore(os.path.join(cache_dir, 'state.sqlite'))
+    job_runner.job_history = job_runner.JobHistory(job_runner.state_store)
+    job_runner.cluster_health = job_runner.ClusterHealthRegistry(store=job_runner.state_store)
+    source_path = os.path.join(fake.project_path, 'src', 'main', 'scala')
+    os.makedirs(source_path)
+    with open(os.path.join(source_path, 'BenchJob.scala'), 'w') as f:
+        f.write('object BenchJob')
+    job_runner.assembly_cache = job_runner.AssemblyCache(os.path.join(cache_dir, 'assembly-cache'), project_path=fake.project_path)
+    job_runner.assembly_builder = job_runner.AssemblyBuilder()
+    return fake, cache_dir
+
+
+def bench_selection(args):
+    fake, cache_dir = install_fake(args)
+    try:
+        timings = {'cold': [], 'warm': [], 'expired': []}
+        for i in range(args.repeat):
+            for kind in ['cold', 'warm', 'expired']:
+                if kind == 'cold':
+                    job_runner.spot_price_cache.entries.clear()
+                elif kind == 'expired':
+                    job_runner.spot_price_cache.entries = dict((key, (0, records)) for key, (_, records) in job_runner.spot_price_cache.entries.items())
+                calls_before = fake.counters['get_spot_price_history']
+                start = time.time()
+                job_runner.get_best_conf_and_az(job_runner.ExpireCollection(), job_runner.mysetup1_cluster_sequence)
+                timings[kind].append((time.time() - start, fake.counters['get_spot_price_history'] - calls_before))
+        print('conf selection with {0} ms of API latency, {1} runs'.format(args.api_latency * 1000, args.repeat))
+        for kind in ['cold', 'warm', 'expired']:
+            seconds = [t for t, _ in timings[kind]]
+            print('{0:>8}: p50 {1:8.1f} ms, max {2:8.1f} ms, {3} API calls per run'.format(
+                kind, percentile(seconds, 50) * 1000, max(seconds) * 1000, timings[kind][0][1]))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def run_supervisor(*args, **kwargs):
+    try:
+        job_runner.run_continuously(*args, **kwargs)
+    except fake_backend.SimulationFinished:
+        pass
+
+
+def start_supervisor(args, fake):
+    results_dir = tempfile.mkdtemp(prefix='bench-runner-results-')
+    supervisor = threading.Thread(target=run_supervisor, name='supervisor',
+                                  args=(results_dir, 'bench', 'BenchSetup', 'bench', job_runner.mysetup1_cluster_sequence),
+                                  kwargs=dict(warm_standby=args.warm_standby))
+    supervisor.daemon = True
+    supervisor.start()
+    return supervisor
+
+
+def jobs_finished(fake):
+    return [e for e in fake.events if e[1] == 'job_finished' and e[3] != fake.sanity_check_job_name]
+
+
+def bench_recovery(args):
+    fake, cache_dir = install_fake(args)
+    supervisor = start_supervisor(args, fake)
+    recoveries = []
+    try:
+        while len(recoveries) < args.failures:
+            # Wait for a job to finish, then kill the cluster that ran it
+            finished = len(jobs_finished(fake))
+            while len(jobs_finished(fake)) == finished:
+                time.sleep(0.01)
+            if args.warm_standby:
+                # Give the standby the time to get ready, otherwise this is the same as without it
+                time.sleep(fake.launch_minutes * 60 * fake.time_scale * 2)
+            cluster_name = jobs_finished(fake)[-1][2]
+            failed_at = time.time()
+            fake.cluster.kill(cluster_name)
+            finished = len(jobs_finished(fake))
+            while len(jobs_finished(fake)) == finished:
+                time.sleep(0.01)
+            started = [e for e in fake.events if e[1] == 'job_started' and e[3] != fake.sanity_check_job_name and e[0] >= failed_at]
+            recoveries.append(fake.to_simulated_minutes(started[0][0] - failed_at))
+        print('recovery{0}: {1} failures, p50 {2:.1f} min, max {3:.1f} min (simulated)'.format(
+            ' with warm standby' if args.warm_standby else '', len(recoveries), percentile(recoveries, 50), max(recoveries)))
+    finally:
+        fake.finish_after(0)
+        supervisor.join(10)
+        # A standby being prepared may still write to the state store for a moment
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def bench_soak(args):
+    fake, cache_dir = install_fake(args, launch_failure_rate=args.failure_rate, job_failure_rate=args.failure_rate,
+                                   cluster_failure_rate=args.failure_rate, job_stall_rate=args.stall_rate,
+                                   spark_rest_api=not args.no_rest_api)
+    job_runner.job_progress_from_stages_page = args.stages_page
+    fake.finish_after(args.hours * 60)
+    cpu_before = os.times()
+    wall_before = time.time()
+    supervisor = start_supervisor(args, fake)
+    max_threads = 0
+    try:
+        while supervisor.is_alive():
+            max_threads = max(max_threads, threading.active_count())
+            time.sleep(0.1)
+        cpu = os.times()
+        cpu_seconds = (cpu[0] - cpu_before[0]) + (cpu[1] - cpu_before[1])
+        wall_seconds = time.time() - wall_before
+        # ru_maxrss is in kilobytes on Linux, bytes on OS X
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+        interruptions = len([e for e in fake.events if e[1] == 'interrupted'])
+        stalls = len([e for e in fake.events if e[1] == 'job_stalled'])
+        killed_stalls = len([a for a in fake.alerts if '"Job stuck' in a])
+        print('soak{0}: {1} simulated hours in {2:.1f} s'.format(' with warm standby' if args.warm_standby else '', args.hours, wall_seconds))
+        print('  jobs finished {0}, launches {1}, spot interruptions {2}, stuck jobs {3} ({4} killed early), alerts {5}'.format(
+            len(jobs_finished(fake)), fake.counters['launch'], interruptions, stalls, killed_stalls, len(fake.alerts)))
+        print('  supervisor cpu {0:.2f} s ({1:.1f}% of wall), max rss {2:.1f} MB, max threads {3}'.format(
+            cpu_seconds, 100 * cpu_seconds / wall_seconds, max_rss, max_threads))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def bench_assembly(args):
+    fake, cache_dir = install_fake(args)
+    results_dir = tempfile.mkdtemp(prefix='bench-runner-results-')
+    cluster_name = 'bench-assembly'
+    try:
+        print('assembly build {0} min, cluster launch {1} min (simulated)'.format(fake.build_minutes, fake.launch_minutes))
+        for kind in ['cold', 'warm']:
+            # A fresh deploy: no jar in the project and no assembly built by this process
+            if fake.cluster.get_assembly_path():
+                os.remove(fake.cluster.get_assembly_path())
+            job_runner.assembly_builder = job_runner.AssemblyBuilder()
+            builds_before = fake.counters['build_assembly']
+            start = time.time()
+            job_runner.setup('BenchSetup')
+            job_runner.ensure_cluster(cluster_name, job_runner.mysetup1_cluster_sequence, None, job_runner.ExpireCollection(),
+                                      results_dir, 'bench', False)
+            sanity_check_start = [e[0] for e in fake.events if e[1] == 'job_started' and e[0] >= start][0]
+            print('{0:>8}: sanity check started after {1:.1f} min, {2} builds'.format(
+                kind, fake.to_simulated_minutes(sanity_check_start - start), fake.counters['build_assembly'] - builds_before))
+            job_runner.destroy_all_clusters(cluster_name)
+    finally:
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(results_dir)
+
+
+def bench_resume(args):
+    command = [sys.executable, '-c', 'import time; start = time.time(); import job_runner; print(time.time() - start)']
+    imports = [float(subprocess.check_output(command, cwd=os.path.dirname(os.path.abspath(__file__)))) for i in range(args.repeat)]
+    print('import job_runner: p50 {0:.0f} ms'.format(percentile(imports, 50) * 1000))
+    fake, cache_dir = install_fake(args)
+    results_dir = tempfile.mkdtemp(prefix='bench-runner-results-')
+    cluster_name = 'bench-resume'
+    store = job_runner.state_store
+    try:
+        job_runner.ensure_cluster(cluster_name, job_runner.mysetup1_cluster_sequence, None, job_runner.ExpireCollection(),
+                                  results_dir, 'bench', False)
+        for kind in ['without state', 'with state']:
+            # A restart: the in-memory health records are gone, the state store (if any) is still on disk
+            job_runner.state_store = store if kind == 'with state' else job_runner.StateStore(None)
+            timings = []
+            for i in range(args.repeat):
+                job_runner.cluster_health = job_runner.ClusterHealthRegistry(store=job_runner.state_store)
+                start = time.time()
+                job_runner.ensure_cluster(cluster_name, job_runner.mysetup1_cluster_sequence, None, job_runner.ExpireCollection(),
+                                          results_dir, 'bench', False)
+                timings.append(time.time() - start)
+            sanity_checks = len([e for e in fake.events if e[1] == 'job_started' and e[3] == fake.sanity_check_job_name])
+            print('{0:>14}: back to the cluster in p50 {1:.3f} s, {2} sanity checks so far'.format(
+                kind, percentile(timings, 50), sanity_checks))
+    finally:
+        job_runner.state_store = store
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(results_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--time-scale', type=float, default=0.001, help='real seconds per simulated second')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='real seconds per EC2 API call')
+    parser.add_argument('--verbose', action='store_true', help='show the runner log')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    selection = subparsers.add_parser('selection')
+    selection.add_argument('--repeat', type=int, default=5)
+    selection.set_defaults(run=bench_selection)
+    recovery = subparsers.add_parser('recovery')
+    recovery.add_argument('--failures', type=int, default=3)
+    recovery.add_argument('--warm-standby', action='store_true')
+    recovery.set_defaults(run=bench_recovery)
+    soak = subparsers.add_parser('soak')
+    soak.add_argument('--hours', type=float, default=6)
+    soak.add_argument('--failure-rate', type=float, default=0.05)
+    soak.add_argument('--warm-standby', action='store_true')
+    soak.add_argument('--stall-rate', type=float, default=0.0, help='probability of a job getting stuck')
+    soak.add_argument('--no-rest-api', action='store_true', help='drivers without the REST API, like Spark < 1.4')
+    soak.add_argument('--stages-page', action='store_true', help='also get the driver progress from its stages page')
+    soak.set_defaults(run=bench_soak)
+    assembly = subparsers.add_parser('assembly')
+    assembly.set_defaults(run=bench_assembly)
+    resume = subparsers.add_parser('resume')
+    resume.add_argument('--repeat', type=int, default=3)
+    resume.set_defaults(run=bench_resume)
+    args = parser.parse_args()
+    if not args.verbose:
+        job_runner.log.setLevel(logging.CRITICAL)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
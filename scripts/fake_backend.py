@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# An in-process stand-in for everything job_runner.py talks to (EC2, the clusters, Librato and VictorOps)
+# It lets the supervisor run, and be timed, without AWS:
+#   import job_runner, fake_backend
+#   job_runner.use_backend(fake_backend.FakeBackend(seed=42))
+# Prices come from a synthetic spot market and cluster operations take simulated minutes, which
+# are slept for time_scale real seconds each (so 0.001 turns a 20 minutes launch into 1.2 seconds)
+# Failures are injected at the rates given to FakeBackend. See bench_runner.py for the benchmarks built on it
+import collections, datetime, os, random, tempfile, threading, time, zlib
+
+SpotPrice = collections.namedtuple('SpotPrice', ['timestamp', 'price'])
+
+# Rough on demand prices, the synthetic spot prices revolve around a fraction of them
+on_demand_prices = {
+    'r3.8xlarge': 2.8, 'r3.4xlarge': 1.4, 'r3.2xlarge': 0.7, 'r3.xlarge': 0.35,
+    'hi1.4xlarge': 3.1, 'c3.8xlarge': 1.68, 'c3.4xlarge': 0.84,
+    'm2.4xlarge': 0.98, 'm3.2xlarge': 0.53,
+}
+
+
+class SimulationFinished(BaseException):
+    """Raised by the fake cluster operations once the simulation time is over
+    It's a BaseException so the runner's 'except Exception' recovery code lets it through"""
+
+
+class FakeClusterException(Exception): pass
+
+
+class FakeSpotMarket:
+    """
+    Deterministic synthetic spot prices: a new price every change_interval seconds of real time,
+    around spot_ratio of the on demand price, with occasional spikes well above it
+    >>> m = FakeSpotMarket(seed=1)
+    >>> m.price_at('us-east-1a', 'r3.xlarge', 1000000) == m.price_at('us-east-1a', 'r3.xlarge', 1000000)
+    True
+    """
+    def __init__(self, seed=0, change_interval=10 * 60, spot_ratio=0.15, noise=0.3, spike_rate=0.02, spike_multiplier=8):
+        self.seed = seed
+        self.change_interval = change_interval
+        self.spot_ratio = spot_ratio
+        self.noise = noise
+        self.spike_rate = spike_rate
+        self.spike_multiplier = spike_multiplier
+
+    def price_at(self, az, instance_type, epoch):
+        slot = int(epoch // self.change_interval)
+        rnd = random.Random(zlib.crc32('{0}/{1}/{2}/{3}'.format(self.seed, az, instance_type, slot).encode('utf-8')))
+        price = on_demand_prices.get(instance_type, 1.0) * self.spot_ratio * (1 + self.noise * rnd.random())
+        if rnd.random() < self.spike_rate:
+            price *= self.spike_multiplier
+        return round(price, 4)
+
+    def history(self, az, instance_type, start_epoch, end_epoch):
+        slot = int(start_epoch // self.change_interval)
+        records = []
+        while slot * self.change_interval <= end_epoch:
+            epoch = slot * self.change_interval
+            timestamp = datetime.datetime.utcfromtimestamp(epoch).isoformat()[:19] + '.000Z'
+            records.append(SpotPrice(timestamp, self.price_at(az, instance_type, epoch)))
+            slot += 1
+        # Like EC2, newest first
+        return list(reversed(records))
+
+
+class FakeEC2Connection:
+    def __init__(self, fake, region):
+        self.fake = fake
+        self.region = region
+
+    def get_spot_price_history(self, start_time=None, end_time=None, instance_type=None, product_description=None, availability_zone=None):
+        self.fake.count('get_spot_price_history')
+        # Network latency is real time, it isn't scaled
+        time.sleep(self.fake.api_latency)
+        now = time.time()
+        start = parse_timestamp(start_time) if start_time else now - 24 * 60 * 60
+        return self.fake.market.history(availability_zone, instance_type, start, now)
+
+
+def parse_timestamp(timestamp):
+    epoch = datetime.datetime(1970, 1, 1)
+    return (datetime.datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S') - epoch).total_seconds()
+
+
+class FakeCluster:
+    """Same interface as the parts of core/tools/cluster.py used by job_runner.py"""
+    def __init__(self, fake):
+        self.fake = fake
+        self.lock = threading.Lock()
+        # cluster name -> dict with the cluster state
+        self.clusters = {}
+        self.assembly_path = os.path.join(fake.project_path, 'target', 'scala-2.10', 'fake-assembly.jar')
+
+    def _check_finished(self):
+        if self.fake.finished():
+            raise SimulationFinished()
+
+    def _get(self, cluster_name, region=None):
+        with self.lock:
+            state = self.clusters.get(cluster_name)
+        if state is None or (region is not None and state['region'] != region):
+            raise FakeClusterException('No cluster {0} in region {1}'.format(cluster_name, region))
+        return state
+
+    def kill(self, cluster_name):
+        """Simulates the loss of the cluster, e.g. its spot instances being reclaimed"""
+        with self.lock:
+            if cluster_name in self.clusters:
+                self.clusters[cluster_name]['alive'] = False
+
+    def build_assembly(self):
+        self._check_finished()
+        self.fake.simulate('build_assembly', self.fake.build_minutes)
+        if not os.path.isdir(os.path.dirname(self.assembly_path)):
+            os.makedirs(os.path.dirname(self.assembly_path))
+        with open(self.assembly_path, 'w') as f:
+            f.write('fake assembly')
+
+    def get_assembly_path(self):
+        return self.assembly_path if os.path.exists(self.assembly_path) else None
+
+    def launch(self, cluster_name=None, slaves=None, instance_type=None, spot_price=None, ondemand=False,
+               worker_instances=None, zone=None, region=None, **kwargs):
+        self._check_finished()
+        with self.lock:
+            if cluster_name in self.clusters:
+                raise FakeClusterException('Cluster {0} already exists'.format(cluster_name))
+            self.clusters[cluster_name] = dict(region=region, zone=zone, instance_type=instance_type,
+                                               spot_price=None if ondemand else float(spot_price),
+                                               slaves=int(slaves), worker_instances=int(worker_instances),
+                                               alive=False, extra_data=None)
+        self.fake.simulate('launch', self.fake.launch_minutes, cluster_name)
+        if self.fake.chance(self.fake.launch_failure_rate):
+            raise FakeClusterException('Launch of {0} failed'.format(cluster_name))
+        self._get(cluster_name)['alive'] = True
+
+    def destroy(self, cluster_name, region=None):
+        self._check_finished()
+        with self.lock:
+            state = self.clusters.get(cluster_name)
+            if state is None or (region is not None and state['region'] != region):
+                return
+            del self.clusters[cluster_name]
+        self.fake.simulate('destroy', self.fake.destroy_minutes, cluster_name)
+
+    def _check_alive(self, cluster_name, region=None):
+        state = self._get(cluster_name, region)
+        if state['alive'] and state['spot_price'] is not None:
+            price = self.fake.market.price_at(state['zone'], state['instance_type'], time.time())
+            if price > state['spot_price']:
+                self.fake.event('interrupted', cluster_name)
+                state['alive'] = False
+        if not state['alive']:
+            raise FakeClusterException('Cluster {0} is dead'.format(cluster_name))
+        return state
+
+    def health_check(self, cluster_name=None, region=None, **kwargs):
+        self._check_finished()
+        self._check_alive(cluster_name, region)
+
+    def get_master(self, cluster_name, region=None):
+        self._get(cluster_name, region)
+        return 'master.' + cluster_name
+
+    def killall_jobs(self, cluster_name, region=None):
+        self._check_finished()
+        with self.lock:
+            job = self.clusters.get(cluster_name, {}).get('job')
+            if job is not None:
+                job['killed'] = True
+
+    def job_run(self, cluster_name=None, job_name=None, region=None, job_timeout_minutes=None, **kwargs):
+        self._check_finished()
+        sanity_check = job_name == self.fake.sanity_check_job_name
+        state = self._check_alive(cluster_name, region)
+        minutes = self.fake.sanity_check_minutes if sanity_check else self.fake.job_minutes
+        job = state['job'] = dict(started=time.time(), stalled=None, killed=False)
+        self.fake.event('job_started', cluster_name, job_name)
+        if not sanity_check and self.fake.chance(self.fake.job_stall_rate):
+            # Hangs halfway, until it's killed or times out
+            self.fake.simulate('job', minutes / 2.0, cluster_name)
+            job['stalled'] = time.time()
+            self.fake.event('job_stalled', cluster_name, job_name)
+            waited = minutes / 2.0
+            while not job['killed'] and (job_timeout_minutes is None or waited < job_timeout_minutes):
+                self._check_finished()
+                time.sleep(60 * self.fake.time_scale)
+                waited += 1
+            self.fake.event('job_failed', cluster_name, job_name)
+            raise FakeClusterException('Job {0} {1}'.format(job_name, 'was killed' if job['killed'] else 'timed out'))
+        if job_timeout_minutes is not None and minutes > job_timeout_minutes:
+            self.fake.simulate('sanity_check' if sanity_check else 'job', job_timeout_minutes, cluster_name)
+            self.fake.event('job_failed', cluster_name, job_name)
+            raise FakeClusterException('Job {0} timed out'.format(job_name))
+        self.fake.simulate('sanity_check' if sanity_check else 'job', minutes, cluster_name)
+        if not sanity_check and self.fake.chance(self.fake.cluster_failure_rate):
+            self.kill(cluster_name)
+        self._check_alive(cluster_name, region)
+        if not sanity_check and self.fake.chance(self.fake.job_failure_rate):
+            self.fake.event('job_failed', cluster_name, job_name)
+            raise FakeClusterException('Job {0} failed'.format(job_name))
+        self.fake.event('job_finished', cluster_name, job_name)
+
+    def save_extra_data(self, data, cluster_name, region=None):
+        self._get(cluster_name, region)['extra_data'] = data
+
+    def load_extra_data(self, cluster_name, region=None):
+        data = self._get(cluster_name, region)['extra_data']
+        if data is None:
+            raise FakeClusterException('No extra data on {0}'.format(cluster_name))
+        return data
+
+
+class FakeResponse:
+    def __init__(self, text='', data=None):
+        self.text = text
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeHttpSession:
+    """Accepts the VictorOps alerts and answers the Spark master json with the cluster's workers"""
+    def __init__(self, fake):
+        self.fake = fake
+
+    def post(self, url, data=None, **kwargs):
+        self.fake.count('http_post')
+        self.fake.alerts.append(data)
+        return FakeResponse('{"result":"success"}')
+
+    def get(self, url, **kwargs):
+        self.fake.count('http_get')
+        master = url.split('//', 1)[1].split(':', 1)[0]
+        state = self.fake.cluster._get(master[len('master.'):])
+        if '/api/v1/applications' in url:
+            return self._driver_api(url, state)
+        if url.endswith('/stages/'):
+            return self._driver_stages_page(state)
+        workers = [{'state': 'ALIVE' if state['alive'] else 'DEAD'}] * (state['slaves'] * state['worker_instances'])
+        return FakeResponse(data={'workers': workers})
+
+    def _completed_tasks(self, state):
+        """The running job completes tasks_per_minute until it stalls"""
+        job = state.get('job')
+        if job is None:
+            raise FakeClusterException('No driver running')
+        until = job['stalled'] or time.time()
+        return int(self.fake.to_simulated_minutes(until - job['started']) * self.fake.tasks_per_minute)
+
+    def _driver_api(self, url, state):
+        """The Spark driver REST API, which only exists with spark_rest_api (Spark 1.4+)"""
+        if not self.fake.spark_rest_api:
+            raise FakeClusterException('404 Not Found')
+        completed = self._completed_tasks(state)
+        if not url.endswith('/stages'):
+            return FakeResponse(data=[{'id': 'app-fake'}])
+        return FakeResponse(data=[{'numCompleteTasks': completed, 'inputBytes': completed * 1000}])
+
+    def _driver_stages_page(self, state):
+        """The stages page of the driver UI, as in Spark 1.2, with a single stage"""
+        completed = self._completed_tasks(state)
+        return FakeResponse(text='<title>Spark Stages</title><div class="progress">\n'
+                                 '<span style="text-align:center; position:absolute; width:100%; left:0;">{0}/{1}</span>'
+                                 '</div>'.format(completed, max(completed, 1000)))
+
+
+class FakeLibratoQueue:
+    def __init__(self, fake):
+        self.fake = fake
+        self.measurements = []
+
+    def add(self, name, value, **kwargs):
+        self.measurements.append((name, value))
+
+    def submit(self):
+        self.fake.count('librato_submit')
+        self.fake.metrics.extend(self.measurements)
+
+
+class FakeLibrato:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def new_queue(self):
+        return FakeLibratoQueue(self.fake)
+
+
+class FakeBackend:
+    """
+    Drop-in replacement for job_runner.AwsBackend
+    Durations are in simulated minutes, failure rates are probabilities per operation
+    The assembly is built in project_path, a temporary directory by default
+    """
+    def __init__(self, seed=0, time_scale=0.001, api_latency=0.05, market=None,
+                 launch_minutes=20, destroy_minutes=2, sanity_check_minutes=3, job_minutes=30, build_minutes=5,
+                 launch_failure_rate=0.0, job_failure_rate=0.0, cluster_failure_rate=0.0, job_stall_rate=0.0, tasks_per_minute=10,
+                 sanity_check_job_name='HelloWorldSetup', project_path=None, spark_rest_api=True):
+        self.random = random.Random(seed)
+        self.time_scale = time_scale
+        self.api_latency = api_latency
+        self.market = market or FakeSpotMarket(seed=seed)
+        self.launch_minutes = launch_minutes
+        self.destroy_minutes = destroy_minutes
+        self.sanity_check_minutes = sanity_check_minutes
+        self.job_minutes = job_minutes
+        self.build_minutes = build_minutes
+        self.launch_failure_rate = launch_failure_rate
+        self.job_failure_rate = job_failure_rate
+        self.cluster_failure_rate = cluster_failure_rate
+        self.job_stall_rate = job_stall_rate
+        self.tasks_per_minute = tasks_per_minute
+        # Without it, the driver progress only comes from the stages page, like on Spark < 1.4
+        self.spark_rest_api = spark_rest_api
+        self.sanity_check_job_name = sanity_check_job_name
+        self.project_path = project_path or tempfile.mkdtemp(prefix='fake-project-')
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        # (real time, event, cluster name, details)
+        self.events = []
+        self.alerts = []
+        self.metrics = []
+        self.finish_time = None
+        self.start_time = time.time()
+        self.cluster = FakeCluster(self)
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def event(self, name, cluster_name=None, details=None):
+        with self.lock:
+            self.events.append((time.time(), name, cluster_name, details))
+
+    def simulate(self, operation, minutes, cluster_name=None):
+        self.count(operation)
+        time.sleep(minutes * 60 * self.time_scale)
+
+    def finish_after(self, simulated_minutes):
+        """After this much simulated time, the fake cluster operations raise SimulationFinished"""
+        self.finish_time = time.time() + simulated_minutes * 60 * self.time_scale
+
+    def finished(self):
+        return self.finish_time is not None and time.time() >= self.finish_time
+
+    def to_simulated_minutes(self, seconds):
+        return seconds / self.time_scale / 60
+
+    # AwsBackend interface
+
+    def connect_to_region(self, region):
+        return FakeEC2Connection(self, region)
+
+    def librato_connect(self, user, token):
+        return FakeLibrato(self)
+
+    def http_session(self):
+        return FakeHttpSession(self)
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self.time_scale)
+
+    def time(self):
+        """Simulated seconds since the backend was created"""
+        return (time.time() - self.start_time) / self.time_scale
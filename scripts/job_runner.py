@@ -12,19 +12,45 @@
 
 # You can call this script from cron or a system service
 # See start_mysetup1_job_runner.sh for a example on how to call this script
-import os, sys, collections, itertools, logging, traceback, subprocess, datetime, base64, pickle, time, uuid, json
-import boto.ec2
-import librato
-import requests
+# Many setups can be supervised by a single process with the multi command, e.g.: job_runner.py multi <results_dir> mysetup1 mysetup2
+# Options of a single setup go after its name: job_runner.py multi <results_dir> mysetup1:objective=cost mysetup2:warm_standby
+# A restarted runner resumes from its state store (see StateStore) without asking AWS for its cluster
+# The doctests of this script run with: job_runner.py selftest
+import os, sys, collections, itertools, logging, traceback, subprocess, datetime, base64, pickle, time, uuid, json, threading, warnings, atexit, heapq, math, contextlib, hashlib, shutil, tempfile, importlib, re
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from multiprocessing.pool import ThreadPool
+
+
+class LazyModule:
+    """
+    A module imported when one of its attributes is first used, so starting the runner doesn't pay for it
+    """
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+np = LazyModule('numpy')
 script_path = os.path.dirname(os.path.realpath(__file__))
 # We expect some conventional structure:
 # It will read a user data file localized in the same directory as the script
 # This user data is a script that runs on each machine initialization. It can be used to configure stuff like log rotation
 user_data_script = os.path.join(script_path, 'user_data.sh')
+# The shape of the cluster (instance type, slaves, worker instances) is appended to it in /etc/environment so the jobs
+# can size their Spark configuration (see cluster_user_data and ClusterSizing.scala)
+# The sbt project is the parent directory of the script
+project_path = os.path.abspath(os.path.join(script_path, '..'))
 # We will import the cluster.py, which we expect to be in a path relative to this script
 # E.g if job_runner is at root/scripts/job_runner.py, cluster.py must be at root/core/tools/cluster.py
+# It's imported by AwsBackend when first used
 sys.path.insert(0, os.path.join(script_path, '..', 'core', 'tools'))
-import cluster
 
 
 ## Pseudo-types defnition
@@ -32,6 +58,13 @@ import cluster
 ClusterConf = collections.namedtuple('ClusterConf', ['instance_type', 'spot_price', 'slaves', 'worker_instances', 'job_mem', 'ami_type'])
 RegionConf = collections.namedtuple('RegionConf', ['region', 'ami_pvm', 'ami_hvm', 'az_suffixes', 'vpc', 'subnet_by_az'])
 FullConf = collections.namedtuple('FullConf', ['cluster_conf', 'region_conf', 'az'])
+PriceRecord = collections.namedtuple('PriceRecord', ['timestamp', 'price'])
+# Columnar price history: epoch seconds and prices as numpy arrays
+PriceHistory = collections.namedtuple('PriceHistory', ['timestamps', 'prices'])
+# Each field is an array with one value per scored price history
+PriceScores = collections.namedtuple('PriceScores', ['recent', 'historical', 'percentile', 'volatility', 'time_above_bid'])
+# outcome is 'success', 'failure' (the cluster was still healthy) or 'interrupted' (the cluster was lost)
+JobRun = collections.namedtuple('JobRun', ['timestamp', 'duration', 'outcome'])
 
 ## Constants
 
@@ -41,14 +74,50 @@ default_security_group = 'spark-cluster-sg' # This can and should be overriden b
 # We use a job that reads bigs files from s3, syncs it to hdfs then make a count
 sanity_check_job_name = 'HelloWorldSetup' 
 sanity_check_job_timeout_minutes = 7
+# Before running the sanity check job, a cheap probe checks the master and the workers registered on it
+# The result of a sanity check that passed is trusted for this long, as long as the probe keeps passing
+healthy_cluster_ttl_seconds = 30 * 60
+spark_master_ui_port = 8080
+cluster_probe_timeout_seconds = 30
 # This may change fast, see the default in cluster.py for the best version
 spark_version = 'https://circle-artifacts.com/gh/chaordic/spark/3/artifacts/0/tmp/circle-artifacts.zAWvGZt/spark-1.2.2-SNAPSHOT-bin-1.0.4.tgz'
 
 job_timeout_minutes = 240
+# Once a job has job_history_min_runs successful runs on a conf, its timeout is this percentile of their durations
+# times the margin, but never less than adaptive_timeout_min_minutes nor more than the fixed timeout above
+# The sanity check job timeout adapts the same way. After a run that failed past the learned timeout, the next one gets
+# the fixed timeout, otherwise a job that got slower would time out forever without a success to learn from
+adaptive_timeout_percentile = 95
+adaptive_timeout_margin = 2.0
+adaptive_timeout_min_minutes = 5
+# While a job runs, the progress of its driver is polled. If there is no progress for job_stall_timeout_minutes, the job
+# is considered stuck and killed. The progress is the completed tasks and bytes processed from the Spark REST API, which
+# only exists from Spark 1.4. On older versions, like the spark_version above, it can be the completed tasks shown by the
+# driver's stages page with job_progress_from_stages_page. It's off by default: the page only counts finished tasks, so
+# a healthy stage whose tasks all take longer than job_stall_timeout_minutes looks stuck and would be killed
+# After job_progress_unreachable_polls polls without an answer, a warning is logged: stuck jobs aren't detected, only
+# the job timeout applies
+spark_driver_ui_port = 4040
+job_progress_poll_seconds = 60
+job_stall_timeout_minutes = 30
+job_progress_unreachable_polls = 3
+job_progress_from_stages_page = False
 # Max number of consecutive errors on a healthy cluster before forcing cluster destruction
 # For instance, this may happen if the disk is almost full, but not full enough to fail the sanity checks
 max_errors_on_healthy_cluster = 5000 # Change this to a low number to enable it
 
+# A conf that failed is blacklisted for a while. Each new failure of the same conf multiplies
+# the time it stays blacklisted by blacklist_backoff, up to blacklist_max_timeout_seconds
+blacklist_timeout_seconds = 60 * 60 * 3
+blacklist_backoff = 2
+blacklist_max_timeout_seconds = 60 * 60 * 24
+# A conf that isn't blacklisted again for blacklist_backoff_memory_seconds after it expires starts over from
+# blacklist_timeout_seconds, so a few failures spread over weeks don't keep it out for the max timeout
+blacklist_backoff_memory_seconds = 60 * 60 * 24
+
+# Operations done on all regions (finding and destroying clusters) run in parallel, each limited to this long
+region_operation_timeout_seconds = 15 * 60
+
 # If you are going to use VPC, change below
 # The AMI is per region, you can see some AMI IDs here:
 # https://github.com/chaordic/spark-ec2/tree/v3/ami-list
@@ -65,11 +134,74 @@ regions_conf = collections.OrderedDict([
     # This may be undesirable due to data transfer costs. Add other regions with caution
 ])
 
+# Spot price histories are fetched concurrently, one request per (instance type, AZ)
+# Set this to 1 to fetch them one at a time
+spot_price_fetch_workers = 16
+# Spot price histories are cached on disk, so retries and restarts only fetch the records that are new
+spot_price_cache_path = os.path.join(os.path.expanduser('~'), '.ignition', 'spot_price_history.json')
+# For how long a cached history is used as is, without asking AWS for newer records
+spot_price_cache_ttl_seconds = 5 * 60
+# How much history is kept in the cache. It must cover the largest window used in get_best_conf_and_az
+spot_price_history_hours = 12
+
+# Job runs (duration and outcome) are recorded per job and cluster conf, so get_best_conf_and_az can pick
+# the conf with the lowest expected cost, or time, per completed run instead of the first affordable one
+# They are kept in the state store (see StateStore), shared by all the runners of the machine
+# Confs with fewer runs than this are not ranked by their history
+job_history_min_runs = 3
+# Only the most recent runs of each job and conf are kept, so the history follows changes in the job
+job_history_max_runs = 50
+
+# What the runner needs to resume after a restart without asking AWS: the conf of each cluster it created, the
+# blacklisted confs, the consecutive job failures and the last sanity checks (see StateStore)
+state_store_path = os.path.join(os.path.expanduser('~'), '.ignition', 'state.sqlite')
+
+# Assembly jars are cached by the hash of everything that goes in them, so a deploy that didn't change them doesn't
+# run sbt. Paths are relative to project_path, missing ones are ignored. core is in the jar too
+assembly_source_paths = ['src/main', 'core/src/main', 'project/build.scala', 'project/plugins.sbt', 'project/build.properties', 'assembly.sbt']
+assembly_cache_dir = os.path.join(os.path.expanduser('~'), '.ignition', 'assembly-cache')
+# The least recently used jars are deleted when the cache has more than this
+assembly_cache_max_entries = 10
+# A failed assembly build is tried again after this, doubling after each failure up to the max
+assembly_retry_seconds = 60
+assembly_max_retry_seconds = 30 * 60
+
+# With warm standby enabled (run_continuously only), a second cluster is kept ready to replace the primary
+# It is smaller than the conf it uses, with this fraction of its slaves
+standby_slaves_ratio = 0.5
+standby_cluster_suffix = '-standby'
+
+# While run_continuously or run_once runs jobs, the spot market of the active conf is checked every market_watch_interval_seconds
+# When its interruption risk (see interruption_risk) reaches market_risk_threshold, a replacement is launched on the
+# next best conf, like a warm standby, so it's ready if the spot instances are reclaimed
+# Unless warm standby is enabled, the replacement is destroyed if the risk falls below market_calm_threshold
+market_watch_interval_seconds = 5 * 60
+market_risk_threshold = 0.5
+market_calm_threshold = 0.2
+
 master_ami_type = 'pvm'
 master_instance_type = 'm3.2xlarge'
 
 runner_eid = "runner-{0}".format(uuid.uuid4())
 victorops_url = "https://alert.victorops.com/integrations/generic/20131114/alert/<you_key>/<your_tag>"
+librato_user = '<your_user>'
+librato_token = '<your_token>'
+
+# Heartbeats and alerts are delivered by a background thread, so the supervisor never waits on Librato or VictorOps
+# If they are down for long, the queue fills up and new messages are dropped (and logged)
+telemetry_queue_size = 1000
+# Heartbeats of the same metric within this interval are sent only once
+telemetry_flush_interval_seconds = 10
+telemetry_max_retries = 5
+telemetry_max_backoff_seconds = 60
+
+# Each supervisor phase (price selection, launch, sanity check, job, ...) is traced as a span: a json line with
+# its start, end, outcome, conf and retry count. By default the trace goes to this file in the results dir
+trace_file_name = 'job_runner_trace.jsonl'
+# Set this to write the traces of all setups to the same file instead
+trace_file_path = None
+# The phase durations are also sent to Librato as these percentiles (plus the max and count) per flush interval
+trace_percentiles = [50, 90]
 
 
 ## LOGGING
@@ -78,6 +210,8 @@ log = logging.getLogger()
 log.setLevel(logging.INFO)
 #log.setLevel(logging.DEBUG)
 formatter = logging.Formatter('job-runner - %(asctime)s - %(levelname)s - %(message)s')
+if not log.handlers:
+    log.addHandler(logging.StreamHandler())
 handler = log.handlers[0]
 handler.setFormatter(formatter)
 log.addHandler(handler)
@@ -85,6 +219,8 @@ log.addHandler(handler)
 
 ## Cluster Configuration
 
+# The jobs size executor memory, cores, parallelism and memory fractions for the instance type, slaves and
+# worker_instances they run on (see ClusterSizing.scala), so job_mem is only used for instance types it doesn't know
 mysetup1_cluster_sequence = [
     ClusterConf('r3.8xlarge', 0.42 * 3, '8', '4', '30G', 'hvm'),
     ClusterConf('r3.4xlarge', 0.21 * 3, '15', '2', '40G', 'hvm'),
@@ -112,46 +248,284 @@ mysetup2_cluster_sequence = [
 ]
 
 namespace = "runner"
+# Each setup runs in its own thread when many setups are supervised by the same process (see multi)
+# so per-setup state, like the metrics namespace, is kept in a thread local
+setup_context = threading.local()
 
-# This is a heart beat so we know the script is running. Currently we send it to librato
-def send_heartbeat(retries=3):
-    for i in range(retries):
+def get_namespace():
+    return getattr(setup_context, 'namespace', namespace)
+
+## Backends
+
+class AwsBackend:
+    """
+    Everything the runner talks to: EC2 (boto), the clusters (core/tools/cluster.py), Librato and VictorOps
+    The modules are only imported when first needed. See fake_backend.py for an in-process replacement
+    """
+    @property
+    def cluster(self):
+        import cluster
+        return cluster
+
+    def connect_to_region(self, region):
+        import boto.ec2
+        return boto.ec2.connect_to_region(region)
+
+    def librato_connect(self, user, token):
+        import librato
+        return librato.connect(user, token)
+
+    def http_session(self):
+        import requests
+        return requests.Session()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def time(self):
+        """The clock used to measure jobs, in seconds"""
+        return time.time()
+
+backend = AwsBackend()
+
+def use_backend(new_backend):
+    global backend
+    backend = new_backend
+
+
+class TelemetryDispatcher:
+    """
+    Background delivery of heartbeats (to Librato) and alerts (to VictorOps)
+    Each backend has its own bounded queue and worker thread, so producers never block and an outage of one
+    backend doesn't delay the other. Metrics are coalesced and submitted in batches every flush_interval seconds.
+    Each backend keeps a single connection and failed deliveries are retried with exponential backoff
+    """
+    def __init__(self, queue_size=telemetry_queue_size, flush_interval=telemetry_flush_interval_seconds,
+                 max_retries=telemetry_max_retries, max_backoff=telemetry_max_backoff_seconds):
+        self.metrics_queue = queue.Queue(maxsize=queue_size)
+        self.alerts_queue = queue.Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.threads = None
+        self.librato_api = None
+        self.http_session = None
+
+    def submit_metric(self, name, value):
+        self._put(self.metrics_queue, ('metric', name, value))
+
+    def record_timing(self, name, seconds):
+        """Unlike metrics, timings are not coalesced: they are summarized by summarize_timings on each flush"""
+        self._put(self.metrics_queue, ('timing', name, seconds))
+
+    def alert(self, entity_id, severity, message):
+        self._put(self.alerts_queue, ('alert', entity_id, severity, message, int(time.time())))
+
+    def flush(self, timeout=30):
+        """Blocks until everything queued so far is delivered (or given up), or timeout seconds pass
+        """
+        if self.threads is None:
+            return True
+        deadline = time.time() + timeout
+        done = [threading.Event(), threading.Event()]
+        self._put(self.metrics_queue, ('flush', done[0]))
+        self._put(self.alerts_queue, ('flush', done[1]))
+        for event in done:
+            event.wait(max(0, deadline - time.time()))
+        return all(event.is_set() for event in done)
+
+    def _put(self, queue_, item):
+        self._ensure_started()
         try:
-            user = '<your_user>'
-            token = '<your_token>'
-            api = librato.connect(user, token)
-            api.submit('runner.{0}.heartbeat'.format(namespace), 1)
-            break
+            queue_.put_nowait(item)
+        except queue.Full:
+            log.error('Telemetry queue is full, dropping {0}'.format(item))
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.threads is None:
+                self.threads = [threading.Thread(target=self._run_metrics, name='telemetry-librato'),
+                                threading.Thread(target=self._run_alerts, name='telemetry-victorops')]
+                for thread in self.threads:
+                    thread.daemon = True
+                    thread.start()
+
+    def _run_metrics(self):
+        metrics = collections.OrderedDict()
+        timings = collections.OrderedDict()
+        next_flush = time.time() + self.flush_interval
+        while True:
+            try:
+                item = self.metrics_queue.get(timeout=max(0, next_flush - time.time()))
+            except queue.Empty:
+                item = None
+            try:
+                if item is None:
+                    pass
+                elif item[0] == 'metric':
+                    metrics[item[1]] = item[2]
+                elif item[0] == 'timing':
+                    timings.setdefault(item[1], []).append(item[2])
+                elif item[0] == 'flush':
+                    self._deliver_metrics(metrics, timings)
+                    item[1].set()
+                if time.time() >= next_flush:
+                    self._deliver_metrics(metrics, timings)
+                    next_flush = time.time() + self.flush_interval
+            except Exception as e:
+                log.exception('Unexpected exception in telemetry dispatcher')
+
+    def _run_alerts(self):
+        while True:
+            item = self.alerts_queue.get()
+            try:
+                if item[0] == 'alert':
+                    self._deliver_alert(*item[1:])
+                elif item[0] == 'flush':
+                    item[1].set()
+            except Exception as e:
+                log.exception('Unexpected exception in telemetry dispatcher')
+
+    def _retrying(self, description, f, reset):
+        for attempt in range(self.max_retries):
+            try:
+                return f()
+            except Exception as e:
+                log.exception('Exception {0} (attempt {1} of {2})'.format(description, attempt + 1, self.max_retries))
+                if attempt + 1 == self.max_retries:
+                    raise
+                # Start over with a fresh connection
+                reset()
+                time.sleep(min(2 ** attempt, self.max_backoff))
+
+    def _reset_librato(self):
+        self.librato_api = None
+
+    def _reset_http_session(self):
+        self.http_session = None
+
+    def _deliver_metrics(self, metrics, timings):
+        measurements = list(metrics.items())
+        for name, values in timings.items():
+            measurements.extend(summarize_timings(name, values))
+        metrics.clear()
+        timings.clear()
+        if not measurements:
+            return
+        def submit():
+            if self.librato_api is None:
+                self.librato_api = backend.librato_connect(librato_user, librato_token)
+            q = self.librato_api.new_queue()
+            for name, value in measurements:
+                q.add(name, value)
+            q.submit()
+        try:
+            self._retrying('sending metrics to librato', submit, self._reset_librato)
         except Exception as e:
-            log.exception('Exception sending health check to librato')
-            notify("Exception sending health check to librato\n\nException is: " + traceback.format_exc(), severity="WARNING")
-            time.sleep(1)
+            # Queued for the alerts worker, so a VictorOps outage doesn't hold the next flush
+            self.alert(runner_eid, "WARNING", "Exception sending health check to librato\n\nException is: " + traceback.format_exc())
+
+    def _deliver_alert(self, entity_id, severity, message, timestamp):
+        def post():
+            if self.http_session is None:
+                self.http_session = backend.http_session()
+            return victorops_alert(entity_id, severity, message, timestamp=timestamp, session=self.http_session)
+        try:
+            self._retrying('sending alert to victorops', post, self._reset_http_session)
+        except Exception as e:
+            log.exception('This is bad, notification failed. Someone must be notified about this.')
+
+def summarize_timings(name, values, percentiles=trace_percentiles):
+    """
+    Librato gauges for a batch of durations
+    >>> summarize_timings('phase', [1, 2, 3, 4, 10])
+    [('phase.count', 5), ('phase.p50', 3.0), ('phase.p90', 7.6), ('phase.max', 10.0)]
+    """
+    values = np.asarray(values, dtype=float)
+    return ([(name + '.count', len(values))] +
+            [('{0}.p{1}'.format(name, p), round(float(np.percentile(values, p)), 3)) for p in percentiles] +
+            [(name + '.max', round(float(values.max()), 3))])
+
+telemetry = TelemetryDispatcher()
+# Give the last messages a chance to be delivered before the process exits
+atexit.register(telemetry.flush)
+
+# This is a heart beat so we know the script is running. Currently we send it to librato
+def send_heartbeat():
+    telemetry.submit_metric('runner.{0}.heartbeat'.format(get_namespace()), 1)
 
 # Every problem is sent to VictorOps. Some issues will be automatically be resolved by the script if it get to auto-recover from the problem
-def victorops_alert(entity_id, severity="CRITICAL", message=""):
+def victorops_alert(entity_id, severity="CRITICAL", message="", timestamp=None, session=None):
     message = {
         "message_type": severity,
         "entity_id": entity_id,
-        "timestamp": int(time.time()),
+        "timestamp": timestamp or int(time.time()),
         "state_message": message,
     }
 
-    r = requests.post(victorops_url, data=json.dumps(message))
+    session = session or backend.http_session()
+    r = session.post(victorops_url, data=json.dumps(message), timeout=30)
+    r.raise_for_status()
     return r.text
 
 def notify(message, severity="CRITICAL", entity_id=runner_eid):
     try:
-        return victorops_alert(entity_id, severity, message)
+        telemetry.alert(entity_id, severity, message)
     except Exception as e:
         log.exception('This is bad, notification failed. Someone must be notified about this.')
 
+## Tracing
+
+trace_lock = threading.Lock()
+
+def get_trace_path():
+    return trace_file_path or getattr(setup_context, 'trace_path', None)
 
-def avg(it):
-    l = list(it)
-    return sum(l) / len(l) if len(l) > 0 else 0
+def full_conf_to_trace(full_conf):
+    """
+    >>> full_conf_to_trace(FullConf(mysetup2_cluster_sequence[0], regions_conf['us-east-1'], 'us-east-1a'))['instance_type']
+    'r3.2xlarge'
+    """
+    if full_conf is None:
+        return None
+    cluster_conf = full_conf.cluster_conf
+    return collections.OrderedDict([('instance_type', cluster_conf.instance_type), ('spot_price', cluster_conf.spot_price),
+                                    ('slaves', cluster_conf.slaves), ('worker_instances', cluster_conf.worker_instances),
+                                    ('region', full_conf.region_conf.region), ('az', full_conf.az)])
+
+def write_trace(span):
+    path = get_trace_path()
+    if path is None:
+        return
+    try:
+        with trace_lock:
+            with open(path, 'a') as f:
+                f.write(json.dumps(span) + '\n')
+    except Exception as e:
+        log.exception('Failed to write trace to {0}'.format(path))
 
-def get_avg_worst_price(hprices, n):
-    return avg(sorted([h.price for h in hprices], reverse=True)[:n])
+@contextlib.contextmanager
+def trace_span(phase, full_conf=None, cluster_name=None, retries=0, **attributes):
+    """
+    Traces the code inside the with block as the given phase, see trace_file_name
+    The yielded span is a dict that the block may update, e.g. with the conf once it's known or a different outcome
+    """
+    span = collections.OrderedDict([('phase', phase), ('namespace', get_namespace()), ('cluster_name', cluster_name),
+                                    ('full_conf', full_conf), ('retries', retries), ('outcome', 'success')])
+    span.update(attributes)
+    start = time.time()
+    try:
+        yield span
+    except BaseException as e:
+        span['outcome'] = 'error'
+        span['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        raise
+    finally:
+        end = time.time()
+        span.update([('full_conf', full_conf_to_trace(span['full_conf'])), ('start', start), ('end', end), ('duration', end - start)])
+        write_trace(span)
+        telemetry.record_timing('runner.{0}.phase.{1}.duration'.format(span['namespace'], phase), end - start)
 
 
 def get_date_start_at(hours_past, now=None):
@@ -163,138 +537,1083 @@ def get_date_start_at(hours_past, now=None):
     return (now - datetime.timedelta(hours=hours_past)).isoformat()[:19] + '.000Z'
 
 
-def get_prices_after_hours_ago(hprices, hours):
-    timestamp = get_date_start_at(hours)
-    return [h for h in hprices if h.timestamp >= timestamp]
+def price_history_from_records(records):
+    """
+    >>> h = price_history_from_records([PriceRecord('2014-05-01T01:00:00.000Z', 0.3), PriceRecord('2014-05-01T00:00:00.000Z', 0.2)])
+    >>> h.timestamps.tolist(), h.prices.tolist()
+    ([1398902400.0, 1398906000.0], [0.2, 0.3])
+    """
+    timestamps = np.array([r.timestamp[:19] for r in records], dtype='datetime64[s]').astype(np.int64).astype(np.float64)
+    prices = np.array([float(r.price) for r in records], dtype=np.float64)
+    order = np.argsort(timestamps, kind='mergesort')
+    return PriceHistory(timestamps[order], prices[order])
+
+
+def _avg_worst_prices(prices, mask, n):
+    # Average of the n highest prices of each row where mask is set, 0 if there are none
+    # np.partition puts the n highest values in the last n columns without sorting the rows
+    values = np.where(mask, prices, -np.inf)
+    if values.shape[1] > n:
+        values = np.partition(values, values.shape[1] - n, axis=1)[:, -n:]
+    valid = np.isfinite(values)
+    counts = valid.sum(axis=1)
+    return np.where(valid, values, 0).sum(axis=1) / np.maximum(counts, 1)
+
+
+def score_price_histories(histories, bids, now=None, recent_hours=6, recent_n=2, historical_hours=12, historical_n=10, percentile=90):
+    """
+    Scores many price histories at once. They are padded into a matrix and every statistic is computed
+    in a single vectorized pass, one row per history:
+    - recent: average of the recent_n worst prices in the last recent_hours
+    - historical: average of the historical_n worst prices in the last historical_hours
+    - percentile: the given percentile of the prices in the last historical_hours
+    - volatility: standard deviation of the prices in the last historical_hours
+    - time_above_bid: fraction of the last historical_hours in which the price was above the row's bid
+
+    >>> now = 1398902400.0
+    >>> a = PriceHistory(np.array([now - 10 * 3600, now - 3 * 3600, now - 3600]), np.array([0.5, 0.1, 0.2]))
+    >>> b = PriceHistory(np.array([now - 2 * 3600]), np.array([0.3]))
+    >>> s = score_price_histories([a, b], [0.4, 0.4], now=now)
+    >>> s.recent.tolist(), s.historical.tolist()
+    ([0.15000000000000002, 0.3], [0.26666666666666666, 0.3])
+    >>> s.time_above_bid.tolist()
+    [0.5833333333333334, 0.0]
+    """
+    now = now if now is not None else time.time()
+    size = max([len(h.prices) for h in histories] + [1])
+    timestamps = np.full((len(histories), size), np.nan)
+    prices = np.full((len(histories), size), np.nan)
+    for i, h in enumerate(histories):
+        timestamps[i, :len(h.timestamps)] = h.timestamps
+        prices[i, :len(h.prices)] = h.prices
+    bids = np.asarray(bids, dtype=np.float64).reshape(-1, 1)
+
+    present = ~np.isnan(prices)
+    recent_start = now - recent_hours * 3600
+    historical_start = now - historical_hours * 3600
+    with np.errstate(invalid='ignore'):
+        recent_mask = present & (timestamps >= recent_start)
+        historical_mask = present & (timestamps >= historical_start)
+
+    # Each price holds from its timestamp until the next one (or now), clipped to the historical window
+    next_timestamps = np.concatenate([timestamps[:, 1:], np.full((len(histories), 1), np.nan)], axis=1)
+    next_timestamps = np.where(np.isnan(next_timestamps), now, next_timestamps)
+    durations = np.clip(next_timestamps - np.fmax(timestamps, historical_start), 0, None)
+    with np.errstate(invalid='ignore'):
+        above_bid = present & (prices > bids)
+    time_above_bid = np.where(above_bid, durations, 0).sum(axis=1) / (now - historical_start)
+
+    historical_prices = np.where(historical_mask, prices, np.nan)
+    with warnings.catch_warnings():
+        # Histories without prices in the window give nan, reported as 0 below
+        warnings.simplefilter('ignore', RuntimeWarning)
+        price_percentile = np.nanpercentile(historical_prices, percentile, axis=1) if len(histories) else np.zeros(0)
+        volatility = np.nanstd(historical_prices, axis=1)
+
+    return PriceScores(recent=_avg_worst_prices(prices, recent_mask, recent_n),
+                       historical=_avg_worst_prices(prices, historical_mask, historical_n),
+                       percentile=np.nan_to_num(price_percentile),
+                       volatility=np.nan_to_num(volatility),
+                       time_above_bid=time_above_bid)
+
+
+# Price policies turn the scores into the price used to compare confs, one per history
+def worst_recent_or_historical_price(scores):
+    """We pick the worst between the recent and the historical averages"""
+    return np.maximum(scores.recent, scores.historical)
+
+
+def interruption_risk(current_prices, bids, scores):
+    """
+    Rough probability, between 0 and 1, of being outbid soon, one per history:
+    1 if the current price is above the bid. Otherwise the larger of exp(-z), where z is how many standard deviations
+    (volatility) the current price is below the bid, and the fraction of the window the price was above the bid
+
+    >>> scores = PriceScores(recent=None, historical=None, percentile=None, volatility=np.array([0.1, 0.1, 0.01, 0.1]),
+    ...                      time_above_bid=np.array([0.0, 0.0, 0.0, 0.6]))
+    >>> np.round(interruption_risk([0.2, 0.45, 0.2, 0.2], [0.5, 0.5, 0.5, 0.5], scores), 2).tolist()
+    [0.05, 0.61, 0.0, 0.6]
+    >>> interruption_risk([0.6], [0.5], PriceScores(None, None, None, np.array([0.0]), np.array([0.0]))).tolist()
+    [1.0]
+    """
+    current_prices = np.asarray(current_prices, dtype=np.float64)
+    bids = np.asarray(bids, dtype=np.float64)
+    # A flat history still has some risk, as if it moved 1% of the bid
+    volatility = np.maximum(scores.volatility, 0.01 * bids)
+    z = (bids - current_prices) / volatility
+    risk = np.maximum(np.exp(-np.clip(z, 0, None)), scores.time_above_bid)
+    return np.where(current_prices >= bids, 1.0, np.clip(risk, 0, 1))
+
 
 def get_azs_for_region(region_conf):
     return [region_conf.region + a for a in region_conf.az_suffixes]
 
 
+class SpotPriceHistoryCache:
+    """
+    Spot price histories keyed by (region, az, instance_type), kept in memory and persisted to a json file
+    Records older than window_hours are dropped, so a refresh only needs what came after the last cached record
+
+    >>> import tempfile
+    >>> c = SpotPriceHistoryCache(os.path.join(tempfile.mkdtemp(), 'cache.json'), ttl=60, window_hours=12)
+    >>> key = ('us-east-1', 'us-east-1a', 'r3.xlarge')
+    >>> c.get(key) is None
+    True
+    >>> c.last_timestamp(key) is None
+    True
+    >>> c.update(key, [PriceRecord(get_date_start_at(1), 0.2), PriceRecord(get_date_start_at(13), 0.9)])
+    >>> [r.price for r in c.get(key)]
+    [0.2]
+    >>> c.update(key, [PriceRecord(get_date_start_at(1), 0.2), PriceRecord(get_date_start_at(0), 0.3)])
+    >>> [r.price for r in c.get(key)]
+    [0.2, 0.3]
+    >>> c.save()
+    >>> [r.price for r in SpotPriceHistoryCache(c.path).get(key)]
+    [0.2, 0.3]
+    """
+    def __init__(self, path=spot_price_cache_path, ttl=spot_price_cache_ttl_seconds, window_hours=spot_price_history_hours):
+        self.path = path
+        self.ttl = ttl
+        self.window_hours = window_hours
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # key -> (fetched_at, records sorted by timestamp)
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def get(self, key):
+        """Returns the cached records for key, or None if there is nothing cached or it's older than ttl
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            return self._prune(entry[1])
+
+    def records(self, key):
+        """Returns the cached records for key, however old they are
+        """
+        with self.lock:
+            return self._prune(self.entries.get(key, (None, []))[1])
+
+    def last_timestamp(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not entry[1]:
+                return None
+            return entry[1][-1].timestamp
+
+    def update(self, key, records, fetched_at=None):
+        """Merges freshly fetched records into the cached ones
+        """
+        with self.lock:
+            old_records = self.entries.get(key, (None, []))[1]
+            merged = set(old_records)
+            merged.update(PriceRecord(r.timestamp, float(r.price)) for r in records)
+            self.entries[key] = (fetched_at or time.time(), self._prune(sorted(merged)))
+            self.dirty = True
+
+    def _prune(self, records):
+        timestamp = get_date_start_at(self.window_hours)
+        return [r for r in records if r.timestamp >= timestamp]
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            for item in data:
+                self.entries[tuple(item['key'])] = (item['fetched_at'], [PriceRecord(t, p) for t, p in item['records']])
+        except Exception as e:
+            log.debug('Spot price cache not loaded from {0}: {1}'.format(self.path, e))
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = [{'key': list(key), 'fetched_at': fetched_at, 'records': [list(r) for r in self._prune(records)]}
+                        for key, (fetched_at, records) in self.entries.items()]
+                self.dirty = False
+            try:
+                save_json(self.path, data)
+            except Exception as e:
+                log.warning('Failed to save spot price cache to {0}: {1}'.format(self.path, e))
+
+def save_json(path, data):
+    """Writes to a temporary file then renames it, so readers never see a partial file"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+spot_price_cache = SpotPriceHistoryCache()
+
+
+def get_spot_price_histories(cluster_sequence, max_workers=spot_price_fetch_workers, cache=None):
+    """
+    Gets the spot price history of every (instance type, AZ) used by the spot confs in cluster_sequence
+    Histories are served from the cache while fresh. The others are refreshed in parallel on a bounded thread pool,
+    with one connection per region, asking only for the records newer than the last cached one
+    Returns a dict {(region, az, instance_type): prices}. Requests that failed are left out
+    """
+    cache = cache if cache is not None else spot_price_cache
+    instance_types = []
+    for cluster_conf in cluster_sequence:
+        if cluster_conf.spot_price is not None and cluster_conf.instance_type not in instance_types:
+            instance_types.append(cluster_conf.instance_type)
+    keys = [(region, az, instance_type)
+            for region, region_conf in regions_conf.items()
+            for az in get_azs_for_region(region_conf)
+            for instance_type in instance_types]
+
+    prices_by_key = {}
+    for key in keys:
+        prices = cache.get(key)
+        if prices is not None:
+            prices_by_key[key] = prices
+    keys_to_fetch = [key for key in keys if key not in prices_by_key]
+    if not keys_to_fetch:
+        return prices_by_key
+
+    connections = dict((region, backend.connect_to_region(region)) for region in set(key[0] for key in keys_to_fetch))
+
+    def fetch(key):
+        region, az, instance_type = key
+        try:
+            fetched_at = time.time()
+            start_time = cache.last_timestamp(key) or get_date_start_at(cache.window_hours)
+            records = connections[region].get_spot_price_history(start_time=start_time, instance_type=instance_type,
+                                                                 availability_zone=az, product_description='Linux/UNIX')
+            cache.update(key, records, fetched_at)
+            return key, cache.records(key)
+        except Exception as e:
+            log.debug('Failed to get spot price history for {0} in {1}: {2}'.format(instance_type, az, e))
+            return key, None
+
+    pool = ThreadPool(max(1, min(max_workers, len(keys_to_fetch))))
+    try:
+        results = pool.map(fetch, keys_to_fetch)
+    finally:
+        pool.terminate()
+    cache.save()
+    prices_by_key.update((key, prices) for key, prices in results if prices is not None)
+    return prices_by_key
+
+
+class JobHistory:
+    """
+    The last max_runs runs of each job on each cluster conf, in the state store, so the runners of all the setups of
+    the machine record into and learn from the same history. Without a store, the runs are only kept in memory
+    The bid (spot_price) is not part of the key, changing it doesn't change how the conf performs
+
+    >>> import tempfile
+    >>> h = JobHistory(StateStore(os.path.join(tempfile.mkdtemp(), 'state.sqlite')), min_runs=2)
+    >>> conf = mysetup2_cluster_sequence[0]
+    >>> h.record('MyJob', conf, 3600, 'success', timestamp=1)
+    >>> h.expected_hours_per_completed_run('MyJob', conf) is None
+    True
+    >>> JobHistory(h.store, min_runs=2).record('MyJob', conf, 1800, 'interrupted', timestamp=2)
+    >>> h.expected_hours_per_completed_run('MyJob', conf)
+    1.5
+    >>> h.expected_hours_per_completed_run('MyJob', conf._replace(spot_price=1))
+    1.5
+    >>> for i in range(3): JobHistory(h.store, max_runs=2).record('MyJob', conf, 60, 'success', timestamp=3 + i)
+    >>> [r.timestamp for r in h.runs_of('MyJob', conf)]
+    [4.0, 5.0]
+    """
+    def __init__(self, store=None, min_runs=job_history_min_runs, max_runs=job_history_max_runs):
+        self.store = store
+        self.min_runs = min_runs
+        self.max_runs = max_runs
+        self.lock = threading.Lock()
+        # Without a store: key -> list of JobRun, oldest first
+        self.runs = {}
+
+    @staticmethod
+    def key(job_name, cluster_conf):
+        return '/'.join([job_name, cluster_conf.instance_type, str(cluster_conf.slaves), str(cluster_conf.worker_instances),
+                         str(cluster_conf.job_mem), str(cluster_conf.ami_type)])
+
+    def record(self, job_name, cluster_conf, duration, outcome, timestamp=None):
+        run = JobRun(timestamp or time.time(), duration, outcome)
+        key = self.key(job_name, cluster_conf)
+        if self.store is not None:
+            self.store.save_job_run(key, run, self.max_runs)
+            return
+        with self.lock:
+            runs = self.runs.setdefault(key, [])
+            runs.append(run)
+            del runs[:-self.max_runs]
+
+    def runs_of(self, job_name, cluster_conf):
+        """The runs of job_name on cluster_conf, oldest first"""
+        key = self.key(job_name, cluster_conf)
+        if self.store is not None:
+            return self.store.load_job_runs(key)
+        with self.lock:
+            return list(self.runs.get(key, []))
+
+    def expected_hours_per_completed_run(self, job_name, cluster_conf):
+        """
+        The time spent running the job, including the failed and interrupted runs, divided by the runs that succeeded
+        None if there are less than min_runs runs. Infinite if none succeeded
+        """
+        runs = self.runs_of(job_name, cluster_conf)
+        if len(runs) < self.min_runs:
+            return None
+        successes = len([r for r in runs if r.outcome == 'success'])
+        return sum(r.duration for r in runs) / 3600.0 / successes if successes else float('inf')
+
+    def duration_percentile(self, job_name, cluster_conf, percentile):
+        """The given percentile of the durations of the successful runs, None if there are less than min_runs of them"""
+        durations = [r.duration for r in self.runs_of(job_name, cluster_conf) if r.outcome == 'success']
+        if len(durations) < self.min_runs:
+            return None
+        return float(np.percentile(durations, percentile))
+
+
+
+class StateStore:
+    """
+    What the runner needs to resume after a restart, in a sqlite database: the conf of each cluster it created, the
+    blacklisted confs with their wall clock deadlines, the consecutive job failures and the last sanity check of each
+    cluster. It's only a shortcut: anything not found here is found the slow way (e.g. load_conf_from_cluster)
+    It also holds the job runs of JobHistory
+    Each operation opens its own connection, so it's safe to use from any thread. Errors are logged, not raised
+    With path None nothing is saved
+
+    >>> import tempfile
+    >>> store = StateStore(os.path.join(tempfile.mkdtemp(), 'state.sqlite'))
+    >>> store.save_cluster('c', mysetup2_cluster_sequence[0])
+    >>> store.load_cluster('c').instance_type, store.load_cluster('other')
+    ('r3.2xlarge', None)
+    >>> store.save_failures('c', 3)
+    >>> store.load_failures('c'), store.load_failures('other')
+    (3, 0)
+    >>> store.save_sanity_check('c', 1000.0, True, 8)
+    >>> store.load_sanity_check('c')
+    (1000.0, True, 8)
+    >>> store.forget_cluster('c')
+    >>> store.load_cluster('c'), store.load_sanity_check('c'), store.load_failures('c')
+    (None, None, 3)
+    >>> store.save_active_cluster('c', 'c-standby')
+    >>> store.load_active_cluster('c'), store.load_active_cluster('other')
+    ('c-standby', None)
+    >>> store.save_blacklisted('c', ('conf', 1), time.time() + 60, 2)
+    >>> store.save_blacklisted('c', ('expired', 1), time.time() - 10, 1)
+    >>> store.save_blacklisted('c', ('forgotten', 1), time.time() - 100, 1)
+    >>> [(item, int(round(remaining)), additions) for item, remaining, additions in store.load_blacklist('c', memory=60)]
+    [(('conf', 1), 60, 2), (('expired', 1), -10, 1)]
+    """
+    schema = [
+        'CREATE TABLE IF NOT EXISTS clusters (cluster_name TEXT PRIMARY KEY, full_conf BLOB, updated_at REAL)',
+        'CREATE TABLE IF NOT EXISTS blacklist (name TEXT, item_key TEXT, item BLOB, deadline REAL, additions INTEGER, PRIMARY KEY (name, item_key))',
+        'CREATE TABLE IF NOT EXISTS failures (cluster_name TEXT PRIMARY KEY, consecutive_failures INTEGER)',
+        'CREATE TABLE IF NOT EXISTS sanity_checks (cluster_name TEXT PRIMARY KEY, timestamp REAL, healthy INTEGER, alive_workers INTEGER)',
+        'CREATE TABLE IF NOT EXISTS active_clusters (name TEXT PRIMARY KEY, cluster_name TEXT)',
+        'CREATE TABLE IF NOT EXISTS job_runs (key TEXT, timestamp REAL, duration REAL, outcome TEXT)',
+        'CREATE INDEX IF NOT EXISTS job_runs_by_key ON job_runs (key, timestamp)',
+    ]
+
+    def __init__(self, path=state_store_path):
+        self.path = path
+        self.created = False
+
+    def _execute(self, statements):
+        """Runs (sql, parameters) statements in a transaction, returns the rows of the last one"""
+        if self.path is None:
+            return []
+        import sqlite3
+        try:
+            # Creating the tables twice from two threads is harmless
+            create = not self.created
+            if create:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                statements = [(sql, ()) for sql in self.schema] + list(statements)
+            with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as connection:
+                with connection:
+                    rows = []
+                    for sql, parameters in statements:
+                        rows = connection.execute(sql, parameters).fetchall()
+            self.created = True
+            return rows
+        except Exception as e:
+            log.warning('Failed to use the state store {0}: {1}'.format(self.path, e))
+            return []
+
+    def save_cluster(self, cluster_name, full_conf):
+        self._execute([('INSERT OR REPLACE INTO clusters VALUES (?, ?, ?)', (cluster_name, object_to_base64(full_conf), time.time()))])
+
+    def load_cluster(self, cluster_name):
+        rows = self._execute([('SELECT full_conf FROM clusters WHERE cluster_name = ?', (cluster_name,))])
+        return base64_to_object(rows[0][0]) if rows else None
+
+    def forget_cluster(self, cluster_name):
+        """The cluster is gone, and so is its conf and sanity check. Its failures belong to the setup and are kept"""
+        self._execute([('DELETE FROM clusters WHERE cluster_name = ?', (cluster_name,)),
+                       ('DELETE FROM sanity_checks WHERE cluster_name = ?', (cluster_name,))])
+
+    def forget_sanity_check(self, cluster_name):
+        self._execute([('DELETE FROM sanity_checks WHERE cluster_name = ?', (cluster_name,))])
+
+    def save_active_cluster(self, name, cluster_name):
+        """cluster_name is the cluster the setup whose cluster is named name runs on, see WarmStandby"""
+        self._execute([('INSERT OR REPLACE INTO active_clusters VALUES (?, ?)', (name, cluster_name))])
+
+    def load_active_cluster(self, name):
+        rows = self._execute([('SELECT cluster_name FROM active_clusters WHERE name = ?', (name,))])
+        return rows[0][0] if rows else None
+
+    def save_failures(self, cluster_name, consecutive_failures):
+        self._execute([('INSERT OR REPLACE INTO failures VALUES (?, ?)', (cluster_name, consecutive_failures))])
+
+    def load_failures(self, cluster_name):
+        rows = self._execute([('SELECT consecutive_failures FROM failures WHERE cluster_name = ?', (cluster_name,))])
+        return rows[0][0] if rows else 0
+
+    def save_sanity_check(self, cluster_name, timestamp, healthy, alive_workers):
+        self._execute([('INSERT OR REPLACE INTO sanity_checks VALUES (?, ?, ?, ?)', (cluster_name, timestamp, int(healthy), alive_workers))])
+
+    def load_sanity_check(self, cluster_name):
+        """(timestamp, healthy, alive_workers) or None"""
+        rows = self._execute([('SELECT timestamp, healthy, alive_workers FROM sanity_checks WHERE cluster_name = ?', (cluster_name,))])
+        return (rows[0][0], bool(rows[0][1]), rows[0][2]) if rows else None
+
+    def save_job_run(self, key, run, max_runs):
+        """Adds the JobRun and keeps only the max_runs most recent runs of key, in the same transaction"""
+        self._execute([('INSERT INTO job_runs VALUES (?, ?, ?, ?)', (key, run.timestamp, run.duration, run.outcome)),
+                       ('DELETE FROM job_runs WHERE key = ? AND rowid NOT IN '
+                        '(SELECT rowid FROM job_runs WHERE key = ? ORDER BY timestamp DESC, rowid DESC LIMIT ?)',
+                        (key, key, max_runs))])
+
+    def load_job_runs(self, key):
+        """The JobRuns of key, oldest first"""
+        rows = self._execute([('SELECT timestamp, duration, outcome FROM job_runs WHERE key = ? ORDER BY timestamp, rowid', (key,))])
+        return [JobRun(*row) for row in rows]
+
+    def save_blacklisted(self, name, item, deadline, additions):
+        """deadline is a wall clock time (time.time()), so it's still right after a restart"""
+        self._execute([('INSERT OR REPLACE INTO blacklist VALUES (?, ?, ?, ?, ?)',
+                        (name, repr(freeze(item)), object_to_base64(item), deadline, additions))])
+
+    def load_blacklist(self, name, memory=0):
+        """
+        [(item, remaining seconds, additions)] of the items that didn't expire more than memory seconds ago
+        (see ExpireCollection), the remaining seconds are negative for the expired ones. The older ones are deleted
+        """
+        now = time.time()
+        rows = self._execute([('DELETE FROM blacklist WHERE name = ? AND deadline + ? <= ?', (name, memory, now)),
+                              ('SELECT item, deadline, additions FROM blacklist WHERE name = ? ORDER BY deadline DESC', (name,))])
+        return [(base64_to_object(item), deadline - now, additions) for item, deadline, additions in rows]
+
+state_store = StateStore()
+job_history = JobHistory(state_store)
+
+
+def get_job_timeout_minutes(job_name, cluster_conf, default_minutes, history=None):
+    """
+    Timeout for job_name on cluster_conf learned from its history, see adaptive_timeout_percentile
+
+    >>> h = JobHistory(None, min_runs=3)
+    >>> conf = mysetup2_cluster_sequence[0]
+    >>> get_job_timeout_minutes('MyJob', conf, 240, h)
+    240
+    >>> for minutes in [30, 32, 35]: h.record('MyJob', conf, minutes * 60, 'success')
+    >>> get_job_timeout_minutes('MyJob', conf, 240, h)
+    70
+    >>> get_job_timeout_minutes('MyJob', conf, 60, h), get_job_timeout_minutes('MyJob', conf._replace(slaves='1'), 60, h)
+    (60, 60)
+    >>> h.record('Fast', conf, 60, 'success'); h.record('Fast', conf, 60, 'success'); h.record('Fast', conf, 60, 'success')
+    >>> get_job_timeout_minutes('Fast', conf, 240, h)
+    5
+
+    A run that failed after the learned timeout probably hit it, so the next one gets the fixed timeout and, if the job
+    just got slower, its success teaches the new durations
+
+    >>> h.record('MyJob', conf, 72 * 60, 'failure')
+    >>> get_job_timeout_minutes('MyJob', conf, 240, h)
+    240
+    >>> h.record('MyJob', conf, 100 * 60, 'success')
+    >>> get_job_timeout_minutes('MyJob', conf, 240, h)
+    181
+    """
+    history = history or job_history
+    seconds = history.duration_percentile(job_name, cluster_conf, adaptive_timeout_percentile)
+    if seconds is None:
+        return default_minutes
+    minutes = min(default_minutes, max(adaptive_timeout_min_minutes, int(math.ceil(seconds * adaptive_timeout_margin / 60))))
+    last_run = history.runs_of(job_name, cluster_conf)[-1]
+    if last_run.outcome != 'success' and last_run.duration >= minutes * 60:
+        return default_minutes
+    return minutes
+
+
+# What get_best_conf_and_az can pick confs by, besides the sequence order
+objectives = ['cost', 'time']
+
+def check_objective(objective):
+    """
+    Raises ValueError unless objective is None or one of objectives, so a typo fails before any cluster work
+
+    >>> check_objective('costs')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown objective costs. Available objectives are: cost, time
+    """
+    if objective is not None and objective not in objectives:
+        raise ValueError('Unknown objective {0}. Available objectives are: {1}'.format(objective, ', '.join(objectives)))
+    return objective
+
+def rank_by_job_history(choices, job_name, objective, history):
+    """
+    Sorts the (price, full_conf) choices by expected cost or time per completed run of job_name, best first
+    Choices without enough history come first, in their order, so each one gets the runs to be ranked instead of the
+    first conf ranked winning forever. Choices without a price, for the cost, can't be ranked and come last
+    Returns None if none of them can be ranked
+
+    >>> history = JobHistory(None, min_runs=1)
+    >>> big, small = mysetup2_cluster_sequence[3], mysetup2_cluster_sequence[1]
+    >>> history.record('MyJob', big, 3600, 'success')
+    >>> history.record('MyJob', small, 4 * 3600, 'success')
+    >>> choices = [(0.05, FullConf(small, None, 'a')), (2.0, FullConf(big, None, 'a'))]
+    >>> [c.cluster_conf.slaves for p, c in rank_by_job_history(choices, 'MyJob', 'cost', history)]
+    ['16', '2']
+    >>> [c.cluster_conf.slaves for p, c in rank_by_job_history(choices, 'MyJob', 'time', history)]
+    ['2', '16']
+    >>> new = FullConf(mysetup2_cluster_sequence[2], None, 'a')
+    >>> [c.cluster_conf.slaves for p, c in rank_by_job_history(choices + [(None, new), (1.0, new)], 'MyJob', 'cost', history)]
+    ['4', '16', '2', '4']
+    """
+    ranked = []
+    unexplored = []
+    unranked = []
+    for price, full_conf in choices:
+        hours = history.expected_hours_per_completed_run(job_name, full_conf.cluster_conf)
+        if objective == 'cost' and price is None:
+            unranked.append((price, full_conf))
+        elif hours is None:
+            unexplored.append((price, full_conf))
+        elif objective == 'cost':
+            ranked.append((price * int(full_conf.cluster_conf.slaves) * hours, price, full_conf))
+        else:
+            ranked.append((hours, price, full_conf))
+    if not ranked:
+        return None
+    ranked.sort(key=lambda r: r[0])
+    for expected, price, full_conf in ranked:
+        log.info('Expected {0} per completed run of {1} on {2} is {3}'.format(objective, job_name, full_conf, expected))
+    return unexplored + [(price, full_conf) for expected, price, full_conf in ranked] + unranked
+
+
 # This is the main algorithm to pick a configuration. It may be changed to suit different needs
-def get_best_conf_and_az(blacklisted_confs, cluster_sequence, safe_price_margin = 0.8, entity_id=runner_eid):
+# By default the first affordable conf in the cluster sequence wins. With objective='cost' or 'time' all the affordable
+# confs are considered and, among those with enough history of job_name, the one with the lowest expected cost or time
+# per completed run is picked (see rank_by_job_history). Confs without enough history are tried first, in the sequence
+# order, until they have it
+# With max_interruption_risk, spot confs whose interruption_risk is at least that are skipped
+def get_best_conf_and_az(blacklisted_confs, cluster_sequence, safe_price_margin = 0.8, entity_id=runner_eid, price_policy=worst_recent_or_historical_price,
+                         job_name=None, objective=None, history=None, max_interruption_risk=None):
     def inotify(message, severity="CRITICAL"):
         return notify(message, severity, entity_id=entity_id)
 
-    while True:
-        send_heartbeat()
-        log.info('Getting spot price history')
-        try:
-            for cluster_conf in cluster_sequence:
-                if cluster_conf.spot_price is not None:
-                    price_per_full_conf = []
-                    for region, region_conf in regions_conf.items():
-                        conn = boto.ec2.connect_to_region(region)
-                        for az in get_azs_for_region(region_conf):
-                            try:
-                                prices = conn.get_spot_price_history(instance_type=cluster_conf.instance_type, availability_zone=az, product_description='Linux/UNIX')
-                            except Exception as e2:
-                                continue
-                            # Get the avg of the 10 worst prices in last week
-                            average_worst_historical_price = get_avg_worst_price(get_prices_after_hours_ago(prices, 12), 10)
-                            # Get the prices from approx. the last 6 hours and average the two worst
-                            average_worst_recent_price = get_avg_worst_price(get_prices_after_hours_ago(prices, 6), 2)
-                            if average_worst_recent_price > 0 or average_worst_historical_price > 0:
-                                log.info('Price (recent, historical) for instance {0} in {1} is ({2}, {3})'.format(cluster_conf.instance_type, az, average_worst_recent_price, average_worst_historical_price))
-                                # We pick the worst price
-                                price = max(average_worst_recent_price, average_worst_historical_price)
+    check_objective(objective)
+    history = history or job_history
+    with trace_span('price_selection', objective=objective) as span:
+        for retries in itertools.count():
+            send_heartbeat()
+            log.info('Getting spot price history')
+            try:
+                prices_by_key = get_spot_price_histories(cluster_sequence)
+                # Score all the (conf, az) candidates in one pass
+                candidates = [FullConf(cluster_conf, region_conf, az)
+                              for cluster_conf in cluster_sequence if cluster_conf.spot_price is not None
+                              for region, region_conf in regions_conf.items()
+                              for az in get_azs_for_region(region_conf)
+                              if (region, az, cluster_conf.instance_type) in prices_by_key]
+                histories = [price_history_from_records(prices_by_key[(c.region_conf.region, c.az, c.cluster_conf.instance_type)]) for c in candidates]
+                # Recent is the avg of the 2 worst prices in the last 6 hours, historical is the avg of the 10 worst prices in the last 12 hours
+                scores = score_price_histories(histories, [float(c.cluster_conf.spot_price) for c in candidates])
+                policy_prices = price_policy(scores)
+                risks = interruption_risk([h.prices[-1] if len(h.prices) else 0 for h in histories],
+                                          [float(c.cluster_conf.spot_price) for c in candidates], scores)
+                # FullConf is not hashable (RegionConf holds lists), so index the scores by its hashable parts
+                score_index = dict(((c.cluster_conf, c.region_conf.region, c.az), i) for i, c in enumerate(candidates))
+                # The best (price, full_conf) of each affordable conf, in the sequence order. The price is None for ondemand confs
+                choices = []
+                for cluster_conf in cluster_sequence:
+                    if choices and objective is None:
+                        break
+                    if cluster_conf.spot_price is not None:
+                        price_per_full_conf = []
+                        for region, region_conf in regions_conf.items():
+                            for az in get_azs_for_region(region_conf):
+                                full_conf = FullConf(cluster_conf, region_conf, az)
+                                i = score_index.get((cluster_conf, region, az))
+                                if i is None:
+                                    continue
+                                average_worst_recent_price, average_worst_historical_price = scores.recent[i], scores.historical[i]
+                                if average_worst_recent_price > 0 or average_worst_historical_price > 0:
+                                    log.info('Price (recent, historical) for instance {0} in {1} is ({2}, {3})'.format(cluster_conf.instance_type, az, average_worst_recent_price, average_worst_historical_price))
+                                    price = float(policy_prices[i])
+                                    if full_conf in blacklisted_confs:
+                                        log.info("Ignoring this conf because it's blacklisted for now: {0}".format(blacklisted_confs))
+                                    elif max_interruption_risk is not None and risks[i] >= max_interruption_risk:
+                                        log.info('Ignoring {0} in {1} because its interruption risk is {2:.2f}'.format(cluster_conf.instance_type, az, risks[i]))
+                                    else:
+                                        price_per_full_conf.append((price, full_conf))
+                        # price_per_full_conf is a list [ (price1, fullconf1), ...]
+                        # sort: cheaper regions/azs first
+                        price_per_full_conf.sort(key=lambda p: p[0])
+                        maximum_accepted_price = float(cluster_conf.spot_price) * safe_price_margin
+                        if price_per_full_conf and price_per_full_conf[0][0] < maximum_accepted_price:
+                            choices.append(price_per_full_conf[0])
+                        else:
+                            log.info('{0} is too expensive for the max acceptable price: {1}'.format(cluster_conf.instance_type, maximum_accepted_price))
+                    else:
+                        ondemand_full_confs = []
+                        for region, region_conf in regions_conf.items():
+                            for az in get_azs_for_region(region_conf):
                                 full_conf = FullConf(cluster_conf, region_conf, az)
                                 if full_conf not in blacklisted_confs:
-                                    price_per_full_conf.append((price, full_conf))
+                                    ondemand_full_confs.append(full_conf)
                                 else:
                                     log.info("Ignoring this conf because it's blacklisted for now: {0}".format(blacklisted_confs))
-                    # price_per_full_conf is a list [ (price1, fullconf1), ...]
-                    # sort: cheaper regions/azs first
-                    price_per_full_conf.sort()
-                    maximum_accepted_price = float(cluster_conf.spot_price) * safe_price_margin
-                    if price_per_full_conf and price_per_full_conf[0][0] < maximum_accepted_price:
-                        full_conf = price_per_full_conf[0][1]
-                        log.info('Best conf is: {0}, with average price {1}'.format(full_conf, price_per_full_conf[0][0]))
-                        if full_conf.cluster_conf != cluster_sequence[0]:
-                            if cluster_conf == cluster_sequence[-1]:
+                        if ondemand_full_confs:
+                            full_conf = ondemand_full_confs[0]
+                            log.info('Working with ondemand instance {0} on region {1} and AZ {2}'.format(cluster_conf.instance_type, full_conf.region_conf.region, full_conf.az))
+                            choices.append((None, full_conf))
+                if choices:
+                    # The alerts are about the market, so they look at the first affordable conf in the sequence order,
+                    # not at a conf picked by the objective on purpose
+                    first_price, first_full_conf = choices[0]
+                    if objective is not None and job_name is not None:
+                        choices = rank_by_job_history(choices, job_name, objective, history) or choices
+                    price, full_conf = choices[0]
+                    if price is not None:
+                        log.info('Best conf is: {0}, with average price {1}'.format(full_conf, price))
+                    if first_price is not None:
+                        if first_full_conf.cluster_conf != cluster_sequence[0]:
+                            if first_full_conf.cluster_conf == cluster_sequence[-1]:
                                 inotify('Urgent: Imminent cluster failure' "\n" 'We are using our last cluster option. The processing is close to a halt if this cluster fails. By the way, this cluster is expensive and potentially slow.')
-                            elif cluster_sequence.index(full_conf.cluster_conf) >= len(cluster_sequence) // 2:
+                            elif cluster_sequence.index(first_full_conf.cluster_conf) >= len(cluster_sequence) // 2:
                                 inotify('Spot problems __right now__' "\n" 'We are using one of our last cluster configurations. There is a risk we may face a halt in the processing if the problem persists and no action is taken.')
                             else:
                                 inotify('Spot problems ahead' "\n" 'We are not running on our first cluster choice. This indicates the market is bad and our performance may be reduced.', severity="WARNING")
-                        return full_conf
-                    else:
-                        log.info('{0} is too expensive for the max acceptable price: {1}'.format(cluster_conf.instance_type, maximum_accepted_price))
-                else:
-                    for region, region_conf in regions_conf.items():
-                        for az in get_azs_for_region(region_conf):
-                            log.info('Working with ondemand instance {0} on region {1} and AZ {2}'.format(cluster_conf.instance_type, region, az))
-                            full_conf = FullConf(cluster_conf, region_conf, az)
-                            if full_conf not in blacklisted_confs:
-                                return full_conf
-                            else:
-                                log.info("Ignoring this conf because it's blacklisted for now: {0}".format(blacklisted_confs))
-            log.info('No cluster configuration is economically viable!')
-            inotify('Extremely urgent: All processing is halted!' "\n" 'Time to panic. No cluster configuration is economically viable. Probably the spot market crashed for good. Immediate action is necessary to restore the cluster.')
-        except Exception as e:
-            log.exception('Exception while getting spot price history')
-            inotify('Exception while getting spot price history' "\n" 'This is very weird. If it happens more than once, better panic. Exception is: ' + traceback.format_exc(), severity="WARNING")
-        time.sleep(60)
+                    span.update(full_conf=full_conf, retries=retries)
+                    return full_conf
+                log.info('No cluster configuration is economically viable!')
+                inotify('Extremely urgent: All processing is halted!' "\n" 'Time to panic. No cluster configuration is economically viable. Probably the spot market crashed for good. Immediate action is necessary to restore the cluster.')
+            except Exception as e:
+                log.exception('Exception while getting spot price history')
+                inotify('Exception while getting spot price history' "\n" 'This is very weird. If it happens more than once, better panic. Exception is: ' + traceback.format_exc(), severity="WARNING")
+            backend.sleep(60)
 
 class AssemblyFailedException(Exception): pass
 
+class ClusterUnhealthyException(Exception): pass
+
 def build_assembly():
     send_heartbeat()
     try:
-        cluster.build_assembly()
+        with trace_span('build_assembly'):
+            backend.cluster.build_assembly()
     except Exception as e:
         log.exception('Failed to build assembly')
         raise AssemblyFailedException()
 
+class AssemblyCache:
+    """
+    Assembly jars by the hash of their sources (see assembly_source_paths)
+    Each entry is a directory named after the hash, holding the jar at the same path it has relative to project_path
+    The entries are touched when used and the least recently used ones are evicted above max_entries
+
+    >>> import tempfile
+    >>> project = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(project, 'src', 'main'))
+    >>> with open(os.path.join(project, 'src', 'main', 'Job.scala'), 'w') as f: _ = f.write('object Job')
+    >>> c = AssemblyCache(tempfile.mkdtemp(), project_path=project, source_paths=['src/main', 'assembly.sbt'])
+    >>> key = c.source_hash()
+    >>> c.restore(key)
+    False
+    >>> os.makedirs(os.path.join(project, 'target'))
+    >>> with open(os.path.join(project, 'target', 'job-assembly.jar'), 'w') as f: _ = f.write('jar')
+    >>> c.store(key, os.path.join(project, 'target', 'job-assembly.jar'))
+    >>> os.remove(os.path.join(project, 'target', 'job-assembly.jar'))
+    >>> c.restore(key), os.path.exists(os.path.join(project, 'target', 'job-assembly.jar'))
+    (True, True)
+    >>> with open(os.path.join(project, 'src', 'main', 'Job.scala'), 'w') as f: _ = f.write('object Job2')
+    >>> c.source_hash() == key
+    False
+    """
+    def __init__(self, directory=assembly_cache_dir, max_entries=assembly_cache_max_entries, project_path=project_path,
+                 source_paths=assembly_source_paths):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.project_path = project_path
+        self.source_paths = source_paths
+
+    def source_files(self):
+        for source_path in self.source_paths:
+            path = os.path.join(self.project_path, source_path)
+            if os.path.isfile(path):
+                yield source_path
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.relpath(os.path.join(root, name), self.project_path)
+
+    def source_hash(self):
+        """Hash of the paths and contents of the source files, None if there are none"""
+        sha = hashlib.sha1()
+        found = False
+        for relative_path in self.source_files():
+            found = True
+            sha.update(relative_path.replace(os.sep, '/').encode('utf-8') + b'\0')
+            with open(os.path.join(self.project_path, relative_path), 'rb') as f:
+                sha.update(f.read())
+            sha.update(b'\0')
+        return sha.hexdigest() if found else None
+
+    def restore(self, key):
+        """Copies the cached jar to its place in the project. Returns False on a cache miss"""
+        entry = os.path.join(self.directory, key)
+        if not os.path.isdir(entry):
+            return False
+        for root, dirs, files in os.walk(entry):
+            for name in files:
+                relative_path = os.path.relpath(os.path.join(root, name), entry)
+                target = os.path.join(self.project_path, relative_path)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.copyfile(os.path.join(root, name), target + '.tmp')
+                os.rename(target + '.tmp', target)
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, jar_path):
+        relative_path = os.path.relpath(jar_path, self.project_path)
+        if relative_path.startswith(os.pardir):
+            log.warning('Not caching assembly {0}, it is outside of the project {1}'.format(jar_path, self.project_path))
+            return
+        entry = os.path.join(self.directory, key)
+        tmp_entry = '{0}.tmp-{1}'.format(entry, uuid.uuid4())
+        os.makedirs(os.path.join(tmp_entry, os.path.dirname(relative_path)))
+        shutil.copyfile(jar_path, os.path.join(tmp_entry, relative_path))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Someone else stored it first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if '.tmp-' not in name]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            log.info('Evicting assembly {0} from the cache'.format(entry))
+            shutil.rmtree(entry, ignore_errors=True)
+
+assembly_cache = AssemblyCache()
+
+
+def ensure_assembly(cache=None):
+    """Restores the assembly from the cache, or builds it (and caches it) if it isn't there"""
+    cache = cache or assembly_cache
+    try:
+        key = cache.source_hash()
+    except Exception as e:
+        log.warning('Could not hash the assembly sources: {0}'.format(e))
+        key = None
+    if key is None:
+        # Without the sources we can't tell if the jar is up to date, so trust the one there is, if any
+        if backend.cluster.get_assembly_path() is None:
+            build_assembly()
+        return
+    try:
+        if cache.restore(key):
+            log.info('Using cached assembly {0}'.format(key))
+            return
+    except Exception as e:
+        log.warning('Failed to restore assembly {0} from the cache: {1}'.format(key, e))
+    build_assembly()
+    try:
+        cache.store(key, backend.cluster.get_assembly_path())
+    except Exception as e:
+        log.warning('Failed to cache assembly {0}: {1}'.format(key, e))
+
+
+class AssemblyBuilder:
+    """
+    Gets the assembly ready in background, once per process, so price selection and the cluster launch don't wait for it
+    Everything that runs a job on the cluster must call wait() first. A failed build is retried with backoff, see
+    assembly_retry_seconds, and wait() raises AssemblyFailedException until a build succeeds
+    """
+    def __init__(self, retry_seconds=assembly_retry_seconds, max_retry_seconds=assembly_max_retry_seconds):
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ready = threading.Event()
+        # Set once a build finished, until the next one starts after a failure
+        self.finished = threading.Event()
+
+    def start(self, entity_id=runner_eid):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._build, args=(entity_id, dict(setup_context.__dict__)), name='assembly-builder')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def wait(self):
+        if self.ready.is_set():
+            return
+        self.start()
+        with trace_span('wait_for_assembly'):
+            log.info('Waiting for the assembly')
+            while not self.finished.wait(60):
+                send_heartbeat()
+            if not self.ready.is_set():
+                raise AssemblyFailedException('The assembly build failed, it will be tried again')
+
+    def _build(self, entity_id, context):
+        setup_context.__dict__.update(context)
+        for attempt in itertools.count():
+            try:
+                ensure_assembly()
+                self.ready.set()
+                self.finished.set()
+                return
+            except Exception as e:
+                log.exception('Failed to get the assembly ready')
+                retry_seconds = min(self.retry_seconds * 2 ** attempt, self.max_retry_seconds)
+                notify('Failed to build assembly' + "\n" +
+                       'Someone messed up with the installation/deploy. An urgent action is needed. '
+                       'Trying again in {0} minutes. Exception is: {1}'.format(retry_seconds // 60, traceback.format_exc()),
+                       entity_id=entity_id)
+                self.finished.set()
+            backend.sleep(retry_seconds)
+            self.finished.clear()
+
+# Setups running in the same process share the assembly
+assembly_builder = AssemblyBuilder()
+
 def killall_jobs(cluster_name, region):
     send_heartbeat()
     try:
-        cluster.killall_jobs(cluster_name, region=region)
+        with trace_span('killall_jobs', cluster_name=cluster_name, region=region):
+            backend.cluster.killall_jobs(cluster_name, region=region)
     except Exception as e:
         pass
 
 def run_sanity_checks(collect_results_dir, full_conf, cluster_name):
     send_heartbeat()
-    log.info('Running sanity check')
     region = full_conf.region_conf.region
     cluster_conf = full_conf.cluster_conf
-    cluster.health_check(cluster_name=cluster_name, region=region)
-    cluster.job_run(cluster_name=cluster_name, job_name=sanity_check_job_name, job_mem=cluster_conf.job_mem,
-                    region=region, job_timeout_minutes=sanity_check_job_timeout_minutes,
-                    collect_results_dir=collect_results_dir,
-                    detached=True, kill_on_failure=True, disable_assembly_build=True)
+    timeout = get_job_timeout_minutes(sanity_check_job_name, cluster_conf, sanity_check_job_timeout_minutes)
+    log.info('Running sanity check with a timeout of {0} minutes'.format(timeout))
+    assembly_builder.wait()
+    started = backend.time()
+    try:
+        backend.cluster.job_run(cluster_name=cluster_name, job_name=sanity_check_job_name, job_mem=cluster_conf.job_mem,
+                        region=region, job_timeout_minutes=timeout,
+                        collect_results_dir=collect_results_dir,
+                        detached=True, kill_on_failure=True, disable_assembly_build=True)
+    except Exception as e:
+        job_history.record(sanity_check_job_name, cluster_conf, backend.time() - started, 'failure')
+        raise
+    job_history.record(sanity_check_job_name, cluster_conf, backend.time() - started, 'success')
+
+class ClusterHealthRegistry:
+    """
+    Health check results by cluster name. For each cluster keeps the last probe and the last sanity check,
+    as (timestamp, healthy, alive_workers). With a store (see StateStore), the sanity checks outlive the process
+    >>> r = ClusterHealthRegistry(ttl=60)
+    >>> r.record_sanity_check('c', True, 10)
+    >>> r.is_known_healthy('c', 10), r.is_known_healthy('c', 9), r.is_known_healthy('other', 10)
+    (True, False, False)
+    >>> r.invalidate('c')
+    >>> r.is_known_healthy('c', 10)
+    False
+    """
+    def __init__(self, ttl=healthy_cluster_ttl_seconds, store=None):
+        self.ttl = ttl
+        self.store = store
+        self.lock = threading.Lock()
+        self.probes = {}
+        self.sanity_checks = {}
+
+    def record_probe(self, cluster_name, healthy, alive_workers):
+        with self.lock:
+            self.probes[cluster_name] = (time.time(), healthy, alive_workers)
+
+    def record_sanity_check(self, cluster_name, healthy, alive_workers):
+        timestamp = time.time()
+        with self.lock:
+            self.sanity_checks[cluster_name] = (timestamp, healthy, alive_workers)
+        if self.store:
+            self.store.save_sanity_check(cluster_name, timestamp, healthy, alive_workers)
+
+    def is_known_healthy(self, cluster_name, alive_workers):
+        """True if a sanity check passed within ttl and the cluster still has at least as many workers as it had then"""
+        with self.lock:
+            result = self.sanity_checks.get(cluster_name)
+        if result is None and self.store:
+            # The sanity check of a previous run of the runner
+            result = self.store.load_sanity_check(cluster_name)
+        if result is None:
+            return False
+        timestamp, healthy, workers_then = result
+        return healthy and time.time() - timestamp < self.ttl and workers_then is not None and alive_workers >= workers_then
+
+    def invalidate(self, cluster_name):
+        with self.lock:
+            self.probes.pop(cluster_name, None)
+            self.sanity_checks.pop(cluster_name, None)
+        if self.store:
+            self.store.forget_sanity_check(cluster_name)
+
+cluster_health = ClusterHealthRegistry(store=state_store)
+
+
+def probe_cluster(full_conf, cluster_name):
+    """
+    Cheap health check: the master answers and has workers registered
+    Returns (healthy, alive_workers), where healthy is True, False or None when inconclusive
+    """
+    region = full_conf.region_conf.region
+    try:
+        backend.cluster.health_check(cluster_name=cluster_name, region=region)
+    except Exception as e:
+        log.exception('Cluster health check failed')
+        return False, None
+    try:
+        master = backend.cluster.get_master(cluster_name, region=region)
+        status = backend.http_session().get('http://{0}:{1}/json/'.format(master, spark_master_ui_port), timeout=cluster_probe_timeout_seconds).json()
+        alive_workers = len([w for w in status.get('workers', []) if w.get('state') == 'ALIVE'])
+    except Exception as e:
+        log.warning('Could not get the workers from the master of {0}: {1}'.format(cluster_name, e))
+        return None, None
+    if alive_workers == 0:
+        log.warning('No workers alive on {0}'.format(cluster_name))
+        return False, alive_workers
+    return True, alive_workers
+
+
+def check_cluster_health(collect_results_dir, full_conf, cluster_name, retries=0, entity_id=runner_eid):
+    """
+    Probes the cluster and only runs the sanity check job if the probe is inconclusive or there is no recent
+    sanity check that passed. Raises ClusterUnhealthyException if the cluster isn't healthy
+    """
+    send_heartbeat()
+    with trace_span('health_probe', full_conf, cluster_name) as span:
+        healthy, alive_workers = probe_cluster(full_conf, cluster_name)
+        span.update(outcome={True: 'success', False: 'unhealthy', None: 'inconclusive'}[healthy], alive_workers=alive_workers)
+    cluster_health.record_probe(cluster_name, healthy, alive_workers)
+    if healthy is False:
+        cluster_health.record_sanity_check(cluster_name, False, alive_workers)
+        raise ClusterUnhealthyException('Cluster {0} failed the health probe'.format(cluster_name))
+    if healthy and cluster_health.is_known_healthy(cluster_name, alive_workers):
+        log.info('Cluster {0} passed the health probe and a recent sanity check, skipping the sanity check job'.format(cluster_name))
+        return
+    for attempt in range(retries + 1):
+        try:
+            with trace_span('sanity_check', full_conf, cluster_name, retries=attempt):
+                run_sanity_checks(collect_results_dir, full_conf, cluster_name)
+            cluster_health.record_sanity_check(cluster_name, True, alive_workers)
+            return
+        except AssemblyFailedException:
+            # The sanity check job didn't run, this says nothing about the cluster
+            raise
+        except Exception as e:
+            log.exception('Sanity check failed')
+            cluster_health.record_sanity_check(cluster_name, False, alive_workers)
+            if attempt == retries:
+                raise ClusterUnhealthyException('Cluster {0} failed the sanity check: {1}'.format(cluster_name, e))
+            notify('Sanity check failed' "\n" 'It will be checked once more before destroying the cluster', severity="WARNING", entity_id=entity_id)
+
+
+class RegionTimeoutException(Exception): pass
+
+def run_in_regions(f, regions, timeout=region_operation_timeout_seconds):
+    """
+    Calls f(region) for all regions in parallel and yields (region, result, exception) as each call finishes
+    Calls still running after timeout seconds are yielded with a RegionTimeoutException and left behind
+    The caller may stop iterating at any time, the results of the remaining calls are then ignored
+    >>> sorted(run_in_regions(lambda region: region.upper(), ['a', 'b']))
+    [('a', 'A', None), ('b', 'B', None)]
+    >>> [(r, type(e).__name__) for r, _, e in run_in_regions(lambda region: time.sleep(1), ['a'], timeout=0.1)]
+    [('a', 'RegionTimeoutException')]
+    """
+    results = queue.Queue()
+    def run(region):
+        try:
+            results.put((region, f(region), None))
+        except Exception as e:
+            results.put((region, None, e))
+    pending = list(regions)
+    for region in pending:
+        thread = threading.Thread(target=run, args=(region,), name='region-{0}'.format(region))
+        thread.daemon = True
+        thread.start()
+    deadline = time.time() + timeout
+    while pending:
+        try:
+            region, result, exception = results.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            for region in pending:
+                yield region, None, RegionTimeoutException('Timed out after {0} seconds on region {1}'.format(timeout, region))
+            return
+        pending.remove(region)
+        yield region, result, exception
 
 def destroy_all_clusters(cluster_name):
     send_heartbeat()
-    for region in regions_conf:
-        cluster.destroy(cluster_name, region=region)
+    cluster_health.invalidate(cluster_name)
+    state_store.forget_cluster(cluster_name)
+    errors = []
+    with trace_span('destroy_all_clusters', cluster_name=cluster_name):
+        for region, _, exception in run_in_regions(lambda region: backend.cluster.destroy(cluster_name, region=region), regions_conf):
+            if exception is not None:
+                log.error('Failed to destroy cluster {0} on region {1}: {2}'.format(cluster_name, region, exception))
+                errors.append(exception)
+        if errors:
+            raise errors[0]
 
 def cluster_job_run(*args, **kwargs):
     send_heartbeat()
-    cluster.job_run(*args, **kwargs)
+    assembly_builder.wait()
+    backend.cluster.job_run(*args, **kwargs)
 
-def cluster_destroy(*args, **kwargs):
+def cluster_destroy(cluster_name, *args, **kwargs):
     send_heartbeat()
-    cluster.destroy(*args, **kwargs)
+    cluster_health.invalidate(cluster_name)
+    state_store.forget_cluster(cluster_name)
+    with trace_span('cluster_destroy', cluster_name=cluster_name, region=kwargs.get('region')):
+        backend.cluster.destroy(cluster_name, *args, **kwargs)
 
 def cluster_launch(*args, **kwargs):
     send_heartbeat()
-    cluster.launch(*args, **kwargs)
+    backend.cluster.launch(*args, **kwargs)
 
 def save_conf_on_cluster(full_conf, cluster_name):
     send_heartbeat()
-    cluster.save_extra_data(object_to_base64(full_conf), cluster_name, region=full_conf.region_conf.region)
+    backend.cluster.save_extra_data(object_to_base64(full_conf), cluster_name, region=full_conf.region_conf.region)
+    state_store.save_cluster(cluster_name, full_conf)
 
 def load_conf_from_cluster(cluster_name):
     send_heartbeat()
-    for region in regions_conf:
-        try:
-            data = cluster.load_extra_data(cluster_name, region=region)
-            conf = base64_to_object(data)
+    load = lambda region: base64_to_object(backend.cluster.load_extra_data(cluster_name, region=region))
+    # The first region to answer with a conf wins, we don't wait for the others
+    for region, conf, exception in run_in_regions(load, regions_conf):
+        if exception is None:
             log.info('Found conf {0} from existing cluster'.format(conf))
             return conf
-        except Exception as e:
-            pass
     log.info('No existing cluster conf found')
     return None
 
@@ -310,45 +1629,91 @@ def get_master_ami(full_conf):
     else:
         return full_conf.region_conf.ami_pvm
 
-def ensure_cluster(cluster_name, cluster_sequence, full_conf, blacklisted_confs, collect_results_dir, entity_id, disable_vpc, spark_version=spark_version, security_group=default_security_group, tag=[]):
-    while True:
+def cluster_user_data(full_conf, slaves, user_data_script=user_data_script):
+    """
+    The user data script followed by the export of the cluster shape to /etc/environment
+
+    >>> print(cluster_user_data(FullConf(mysetup1_cluster_sequence[0], regions_conf['us-east-1'], 'us-east-1a'), '4', os.devnull))
+    <BLANKLINE>
+    cat >> /etc/environment <<'EOF'
+    IGNITION_INSTANCE_TYPE=r3.8xlarge
+    IGNITION_SLAVES=4
+    IGNITION_WORKER_INSTANCES=4
+    EOF
+    <BLANKLINE>
+    """
+    with open(user_data_script) as f:
+        user_data = f.read()
+    return '\n'.join([user_data.rstrip('\n'),
+                      "cat >> /etc/environment <<'EOF'",
+                      'IGNITION_INSTANCE_TYPE={0}'.format(full_conf.cluster_conf.instance_type),
+                      'IGNITION_SLAVES={0}'.format(slaves),
+                      'IGNITION_WORKER_INSTANCES={0}'.format(full_conf.cluster_conf.worker_instances),
+                      'EOF', ''])
+
+def launch_cluster(cluster_name, full_conf, disable_vpc, slaves=None, spark_version=spark_version, security_group=default_security_group, tag=[], retries=0):
+    cluster_health.invalidate(cluster_name)
+    slaves = str(slaves or full_conf.cluster_conf.slaves)
+    user_data_fd, user_data_path = tempfile.mkstemp(prefix='user_data-', suffix='.sh')
+    with os.fdopen(user_data_fd, 'w') as f:
+        f.write(cluster_user_data(full_conf, slaves))
+    try:
+        with trace_span('cluster_launch', full_conf, cluster_name, retries=retries, slaves=slaves):
+            cluster_launch(cluster_name=cluster_name, slaves=slaves,
+                           master_instance_type=master_instance_type,
+                           instance_type=full_conf.cluster_conf.instance_type,
+                           ondemand=full_conf.cluster_conf.spot_price is None,
+                           spot_price=str(full_conf.cluster_conf.spot_price),
+                           ami=get_ami_for(full_conf),
+                           master_ami=get_master_ami(full_conf),
+                           worker_instances=str(full_conf.cluster_conf.worker_instances),
+                           zone=full_conf.az,
+                           vpc = full_conf.region_conf.vpc if not disable_vpc else None,
+                           vpc_subnet = full_conf.region_conf.subnet_by_az.get(full_conf.az) if not disable_vpc else None,
+                           just_ignore_existing=False,
+                           spark_version=spark_version,
+                           security_group=security_group, env=env,
+                           region=full_conf.region_conf.region, max_clusters_to_create=1,
+                           user_data=user_data_path, tag=tag,
+                           script_timeout_total_minutes=110,
+                           script_timeout_inactivity_minutes=20)
+    finally:
+        os.remove(user_data_path)
+
+def ensure_cluster(cluster_name, cluster_sequence, full_conf, blacklisted_confs, collect_results_dir, entity_id, disable_vpc, spark_version=spark_version, security_group=default_security_group, tag=[],
+                   job_name=None, objective=None):
+    # Without a conf, the runner just started and what the state store says may be stale
+    resuming = full_conf is None
+    for attempt in itertools.count():
+        # The conf saved by this runner, before a restart, saves asking every region for it
+        full_conf = state_store.load_cluster(cluster_name)
+        from_state = full_conf is not None
         try:
-            full_conf = load_conf_from_cluster(cluster_name)
+            if not full_conf:
+                full_conf = load_conf_from_cluster(cluster_name)
             if not full_conf:
                 log.info('No existing cluster found, destroying all possible half-created clusters then proceeding to create a new cluster')
                 destroy_all_clusters(cluster_name)
-                full_conf = get_best_conf_and_az(blacklisted_confs, cluster_sequence, entity_id=entity_id)
+                full_conf = get_best_conf_and_az(blacklisted_confs, cluster_sequence, entity_id=entity_id, job_name=job_name, objective=objective)
                 log.info('Trying to launch cluster with configuration {}'.format(full_conf))
-                cluster_launch(cluster_name=cluster_name, slaves=str(full_conf.cluster_conf.slaves),
-                               master_instance_type=master_instance_type,
-                               instance_type=full_conf.cluster_conf.instance_type,
-                               ondemand=full_conf.cluster_conf.spot_price is None,
-                               spot_price=str(full_conf.cluster_conf.spot_price),
-                               ami=get_ami_for(full_conf),
-                               master_ami=get_master_ami(full_conf),
-                               worker_instances=str(full_conf.cluster_conf.worker_instances),
-                               zone=full_conf.az,
-                               vpc = full_conf.region_conf.vpc if not disable_vpc else None,
-                               vpc_subnet = full_conf.region_conf.subnet_by_az.get(full_conf.az) if not disable_vpc else None,
-                               just_ignore_existing=False,
-                               spark_version=spark_version,
-                               security_group=security_group, env=env,
-                               region=full_conf.region_conf.region, max_clusters_to_create=1,
-                               user_data=user_data_script, tag=tag,
-                               script_timeout_total_minutes=110,
-                               script_timeout_inactivity_minutes=20)
+                launch_cluster(cluster_name, full_conf, disable_vpc, spark_version=spark_version, security_group=security_group, tag=tag, retries=attempt)
                 save_conf_on_cluster(full_conf, cluster_name)
             killall_jobs(cluster_name, full_conf.region_conf.region)
-            try:
-                run_sanity_checks(collect_results_dir, full_conf, cluster_name)
-            except Exception as e:
-                log.exception('Sanity check failed')
-                notify('Sanity check failed' "\n" 'It will be checked once more before destroying the cluster', severity="WARNING", entity_id=entity_id)
-            run_sanity_checks(collect_results_dir, full_conf, cluster_name)
+            check_cluster_health(collect_results_dir, full_conf, cluster_name, retries=1, entity_id=entity_id)
             break
+        except AssemblyFailedException as e:
+            # Nothing can run without the assembly, but the cluster and its conf aren't to blame. AssemblyBuilder alerts
+            log.warning('No assembly to check cluster {0} with, waiting for the next build'.format(cluster_name))
+            backend.sleep(assembly_retry_seconds)
         except Exception as e:
+            if from_state and resuming:
+                # The cluster may have been destroyed while the runner was down. Look for it the slow way before
+                # blaming its conf
+                log.exception('Cluster from the state store failed, looking for it in all regions')
+                state_store.forget_cluster(cluster_name)
+                continue
             if full_conf:
-                blacklisted_confs.add(full_conf)
+                blacklisted_confs.add(full_size_conf(full_conf, cluster_sequence))
             log.exception('Cluster failed')
             notify("""Cluster failed
 
@@ -357,22 +1722,390 @@ Our current cluster configuration is {0}
 Exception is: {1}
 """
                     .format(full_conf, traceback.format_exc()), severity="WARNING", entity_id=entity_id)
-            cluster_destroy(cluster_name, region=full_conf.region_conf.region)
+            if full_conf:
+                cluster_destroy(cluster_name, region=full_conf.region_conf.region)
     return full_conf
 
 
+class ExcludingCollection:
+    """Everything in collection plus the given items"""
+    def __init__(self, collection, items):
+        self.collection = collection
+        self.items = items
+
+    def __contains__(self, elem):
+        return elem in self.items or elem in self.collection
+
+    def __str__(self):
+        return '{0} + {1}'.format(self.collection, self.items)
+
+
+def full_size_conf(full_conf, cluster_sequence):
+    """
+    The conf of cluster_sequence that full_conf is a smaller version of (see WarmStandby), or full_conf itself
+
+    >>> full_conf = FullConf(mysetup1_cluster_sequence[1], regions_conf['us-east-1'], 'us-east-1a')
+    >>> standby_conf = full_conf._replace(cluster_conf=full_conf.cluster_conf._replace(slaves='8'))
+    >>> full_size_conf(standby_conf, mysetup1_cluster_sequence) == full_conf, full_size_conf(full_conf, []) == full_conf
+    (True, True)
+    """
+    if full_conf.cluster_conf in cluster_sequence:
+        return full_conf
+    for cluster_conf in cluster_sequence:
+        if cluster_conf._replace(slaves=full_conf.cluster_conf.slaves) == full_conf.cluster_conf:
+            return full_conf._replace(cluster_conf=cluster_conf)
+    return full_conf
+
+
+class WarmStandby:
+    """
+    Keeps a second, smaller cluster launched and sanity-checked in background, on the best conf other than the primary's
+    that isn't at risk of interruption (see market_risk_threshold)
+    When the primary fails, the standby is promoted right away and a new standby is prepared under the old primary name
+    The two clusters alternate between the names cluster_name and cluster_name + standby_cluster_suffix. The one the
+    setup runs on is kept in the state store, so a restarted runner finds it
+    The standby's conf has its smaller number of slaves, so the jobs that run on it after a promotion are recorded
+    apart from the full size conf (see full_size_conf). With full_size, the cluster prepared is a full size
+    replacement for a promoted standby instead
+    """
+    def __init__(self, cluster_name, cluster_sequence, blacklisted_confs, collect_results_dir, entity_id, disable_vpc,
+                 spark_version=spark_version, security_group=default_security_group, tag=[], job_name=None, objective=None):
+        self.cluster_names = (cluster_name, cluster_name + standby_cluster_suffix)
+        self.cluster_sequence = cluster_sequence
+        self.blacklisted_confs = blacklisted_confs
+        self.collect_results_dir = collect_results_dir
+        self.entity_id = entity_id
+        self.disable_vpc = disable_vpc
+        self.spark_version = spark_version
+        self.security_group = security_group
+        self.tag = tag
+        self.job_name = job_name
+        self.objective = objective
+        # The namespace and trace file of the setup
+        self.context = dict(setup_context.__dict__)
+        self.lock = threading.Lock()
+        self.thread = None
+        # (cluster_name, full_conf) of a standby that passed the sanity checks
+        self.ready = None
+        # Set by discard while the standby is being prepared, so it's destroyed instead of becoming ready
+        self.discard_requested = False
+
+    def prepare(self, primary_cluster_name, primary_conf, full_size=False):
+        """Starts preparing a standby for the given primary, unless one is already ready or on its way"""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                # Wanted again before it's ready
+                self.discard_requested = False
+                return
+            if self.ready is not None:
+                return
+            self.discard_requested = False
+            cluster_name = self.other_cluster_name(primary_cluster_name)
+            self.thread = threading.Thread(target=self._prepare, args=(cluster_name, primary_conf, full_size), name='warm-standby')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def other_cluster_name(self, cluster_name):
+        return [name for name in self.cluster_names if name != cluster_name][0]
+
+    def discard(self):
+        """Destroys the ready standby, if any. A standby still being prepared is destroyed once it's launched"""
+        with self.lock:
+            discarded, self.ready = self.ready, None
+            if discarded is None and self.thread is not None and self.thread.is_alive():
+                self.discard_requested = True
+        if discarded:
+            log.info('Discarding standby cluster {0}'.format(discarded[0]))
+            destroy_all_clusters(discarded[0])
+
+    def join(self):
+        """Waits for the standby being prepared, if any, e.g. so a discarded one is destroyed before the runner exits"""
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def destroy_leftover(self, active_cluster_name):
+        """Destroys a standby left by a previous run of the runner, known by the state store, under the other name"""
+        cluster_name = self.other_cluster_name(active_cluster_name)
+        if state_store.load_cluster(cluster_name) is not None:
+            log.info('Destroying standby cluster {0} left by a previous run'.format(cluster_name))
+            destroy_all_clusters(cluster_name)
+
+    def _discarding(self, cluster_name):
+        """Destroys the cluster if a discard was requested while it was being prepared"""
+        with self.lock:
+            discard, self.discard_requested = self.discard_requested, False
+        if discard:
+            log.info('Discarding standby cluster {0}'.format(cluster_name))
+            destroy_all_clusters(cluster_name)
+        return discard
+
+    def is_ready(self):
+        with self.lock:
+            return self.ready is not None
+
+    def promote(self):
+        """Returns the (cluster_name, full_conf) of the ready standby, which stops being the standby, or None"""
+        with self.lock:
+            promoted, self.ready = self.ready, None
+        if promoted:
+            log.info('Promoting standby cluster {0} with configuration {1}'.format(*promoted))
+        return promoted
+
+    def _prepare(self, cluster_name, primary_conf, full_size):
+        setup_context.__dict__.update(self.context)
+        while True:
+            full_conf = None
+            try:
+                full_conf = load_conf_from_cluster(cluster_name)
+                if not full_conf:
+                    log.info('Preparing standby cluster {0}'.format(cluster_name))
+                    destroy_all_clusters(cluster_name)
+                    full_conf = get_best_conf_and_az(ExcludingCollection(self.blacklisted_confs, [primary_conf]),
+                                                     self.cluster_sequence, entity_id=self.entity_id,
+                                                     job_name=self.job_name, objective=self.objective,
+                                                     max_interruption_risk=market_risk_threshold)
+                    if not full_size:
+                        slaves = max(1, int(math.ceil(int(full_conf.cluster_conf.slaves) * standby_slaves_ratio)))
+                        full_conf = full_conf._replace(cluster_conf=full_conf.cluster_conf._replace(slaves=str(slaves)))
+                    log.info('Trying to launch standby cluster with configuration {0}'.format(full_conf))
+                    launch_cluster(cluster_name, full_conf, self.disable_vpc, spark_version=self.spark_version,
+                                   security_group=self.security_group, tag=self.tag)
+                    save_conf_on_cluster(full_conf, cluster_name)
+                killall_jobs(cluster_name, full_conf.region_conf.region)
+                check_cluster_health(self.collect_results_dir, full_conf, cluster_name, entity_id=self.entity_id)
+                with self.lock:
+                    if not self.discard_requested:
+                        self.ready = (cluster_name, full_conf)
+                if self._discarding(cluster_name):
+                    return
+                log.info('Standby cluster {0} is ready with configuration {1}'.format(cluster_name, full_conf))
+                return
+            except Exception as e:
+                if full_conf:
+                    self.blacklisted_confs.add(full_size_conf(full_conf, self.cluster_sequence))
+                log.exception('Standby cluster failed')
+                notify("Standby cluster failed\n\nWe will try again soon. Our standby cluster configuration was {0}\nException is: {1}"
+                       .format(full_conf, traceback.format_exc()), severity="WARNING", entity_id=self.entity_id)
+                destroy_all_clusters(cluster_name)
+                if self._discarding(cluster_name):
+                    return
+                backend.sleep(60)
+
+
+# Stage fields that grow as a job makes progress. The byte counts are updated by the executor heartbeats,
+# so long tasks show progress before they complete
+driver_progress_fields = ['numCompleteTasks', 'inputBytes', 'outputBytes', 'shuffleReadBytes', 'shuffleWriteBytes']
+
+class MarketWatcher:
+    """
+    Checks the interruption risk of the spot instances of full_conf every interval seconds, in background
+    Calls on_risk(risk) when it reaches threshold and then on_calm(risk) when it falls below calm_threshold
+    Used as a context manager around the jobs run on the cluster. Ondemand confs are not watched
+    """
+    def __init__(self, full_conf, on_risk, on_calm, interval=market_watch_interval_seconds, threshold=market_risk_threshold,
+                 calm_threshold=market_calm_threshold):
+        self.full_conf = full_conf
+        self.on_risk = on_risk
+        self.on_calm = on_calm
+        self.interval = interval
+        self.threshold = threshold
+        self.calm_threshold = calm_threshold
+        self.stopped = threading.Event()
+        self.risky = False
+
+    def __enter__(self):
+        if self.full_conf.cluster_conf.spot_price is not None:
+            thread = threading.Thread(target=self._run, args=(dict(setup_context.__dict__),), name='market-watcher')
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+
+    def check(self):
+        """The current interruption risk, None if there are no prices"""
+        cluster_conf = self.full_conf.cluster_conf
+        records = get_spot_price_histories([cluster_conf]).get((self.full_conf.region_conf.region, self.full_conf.az, cluster_conf.instance_type))
+        if not records:
+            return None
+        history = price_history_from_records(records)
+        bid = float(cluster_conf.spot_price)
+        scores = score_price_histories([history], [bid])
+        return float(interruption_risk(history.prices[-1:], [bid], scores)[0])
+
+    def _run(self, context):
+        setup_context.__dict__.update(context)
+        while True:
+            backend.sleep(self.interval)
+            if self.stopped.is_set():
+                return
+            try:
+                risk = self.check()
+                if risk is None:
+                    continue
+                log.info('Interruption risk of {0} in {1} is {2:.2f}'.format(self.full_conf.cluster_conf.instance_type, self.full_conf.az, risk))
+                if not self.risky and risk >= self.threshold:
+                    self.risky = True
+                    self.on_risk(risk)
+                elif self.risky and risk < self.calm_threshold:
+                    self.risky = False
+                    self.on_calm(risk)
+            except Exception as e:
+                log.exception('Exception while watching the spot market')
+
+
+def get_driver_progress_from_api(session, ui):
+    """Totals of driver_progress_fields over the applications of the driver, from its REST API (Spark 1.4+)"""
+    api = ui + '/api/v1/applications'
+    totals = [0] * len(driver_progress_fields)
+    for application in session.get(api, timeout=cluster_probe_timeout_seconds).json():
+        for stage in session.get('{0}/{1}/stages'.format(api, application['id']), timeout=cluster_probe_timeout_seconds).json():
+            totals = [total + stage.get(field, 0) for total, field in zip(totals, driver_progress_fields)]
+    return tuple(totals)
+
+# The "<completed>/<total>" tasks of a progress bar of the stage tables, in the driver UI of Spark 1.x
+stages_page_progress_pattern = re.compile(r'<div class="progress">\s*<span[^>]*>\s*(\d+)/(\d+)')
+
+def parse_stages_page_progress(html):
+    """
+    Completed tasks of the active and completed stages, as driver_progress_fields with 0 for the other fields
+
+    >>> parse_stages_page_progress('<div class="progress"><span style="left:0;">3/10 (1 failed)</span></div>'
+    ...                            '<div class="progress">\\n  <span>20/20</span></div>')
+    (23, 0, 0, 0, 0)
+    """
+    completed = sum(int(match.group(1)) for match in stages_page_progress_pattern.finditer(html))
+    return (completed,) + (0,) * (len(driver_progress_fields) - 1)
+
+def get_driver_progress_from_stages_page(session, ui):
+    """The completed tasks from the stages page of the driver UI, for Spark versions without the REST API"""
+    response = session.get(ui + '/stages/', timeout=cluster_probe_timeout_seconds)
+    response.raise_for_status()
+    if 'Stages' not in response.text:
+        raise ValueError('{0}/stages/ is not a Spark stages page'.format(ui))
+    return parse_stages_page_progress(response.text)
+
+def get_driver_progress_sources():
+    """
+    The ways to get the progress of a driver, see job_progress_from_stages_page
+
+    >>> get_driver_progress_sources() == [get_driver_progress_from_api]
+    True
+    """
+    if job_progress_from_stages_page:
+        return [get_driver_progress_from_api, get_driver_progress_from_stages_page]
+    return [get_driver_progress_from_api]
+
+def get_driver_progress(session, master, sources=None):
+    """
+    Progress of the driver running on master from the first of sources that answers, None if none can be reached
+    The source that answered is moved to the front of sources, so the next polls ask it first
+    """
+    sources = sources if sources is not None else get_driver_progress_sources()
+    ui = 'http://{0}:{1}'.format(master, spark_driver_ui_port)
+    for source in list(sources):
+        try:
+            progress = source(session, ui)
+        except Exception as e:
+            log.debug('Could not get the driver progress from {0} with {1}: {2}'.format(master, source.__name__, e))
+            continue
+        sources.remove(source)
+        sources.insert(0, source)
+        return progress
+    return None
+
+
+class ProgressWatchdog:
+    """
+    Kills the jobs on the cluster when its driver makes no progress for stall_timeout_minutes, see job_stall_timeout_minutes
+    A driver that can't be reached doesn't count as stuck, the job timeout takes care of it. If it can't be reached for
+    job_progress_unreachable_polls polls, a warning is logged once per cluster, until its driver answers again
+    Used as a context manager around the job run
+    """
+    # Names of the clusters whose driver couldn't be reached
+    unreachable_clusters = set()
+
+    def __init__(self, cluster_name, full_conf, entity_id=runner_eid, stall_timeout_minutes=job_stall_timeout_minutes,
+                 poll_seconds=job_progress_poll_seconds):
+        self.cluster_name = cluster_name
+        self.full_conf = full_conf
+        self.entity_id = entity_id
+        self.stall_timeout_minutes = stall_timeout_minutes
+        self.poll_seconds = poll_seconds
+        self.stopped = threading.Event()
+        self.stalled = False
+
+    def __enter__(self):
+        thread = threading.Thread(target=self._run, args=(dict(setup_context.__dict__),), name='progress-watchdog')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+
+    def _run(self, context):
+        setup_context.__dict__.update(context)
+        region = self.full_conf.region_conf.region
+        session = backend.http_session()
+        sources = get_driver_progress_sources()
+        last_progress = None
+        polls_without_progress = 0
+        unreachable_polls = 0
+        while True:
+            backend.sleep(self.poll_seconds)
+            if self.stopped.is_set():
+                return
+            try:
+                progress = get_driver_progress(session, backend.cluster.get_master(self.cluster_name, region=region), sources)
+            except Exception as e:
+                progress = None
+            unreachable_polls = unreachable_polls + 1 if progress is None else 0
+            if progress is not None:
+                self.unreachable_clusters.discard(self.cluster_name)
+            elif unreachable_polls == job_progress_unreachable_polls and self.cluster_name not in self.unreachable_clusters:
+                self.unreachable_clusters.add(self.cluster_name)
+                log.warning('Could not get the driver progress on {0} for {1} polls, stuck jobs will not be detected. '
+                            'The driver UI must answer on port {2}, and before Spark 1.4 only job_progress_from_stages_page '
+                            'gets the progress'.format(self.cluster_name, unreachable_polls, spark_driver_ui_port))
+            if progress is None or progress != last_progress:
+                last_progress = progress
+                polls_without_progress = 0
+                continue
+            polls_without_progress += 1
+            if polls_without_progress * self.poll_seconds >= self.stall_timeout_minutes * 60 and not self.stopped.is_set():
+                self.stalled = True
+                log.error('No progress on {0} for {1} minutes, killing the job'.format(self.cluster_name, self.stall_timeout_minutes))
+                notify('Job stuck' "\n" 'The job made no progress for {0} minutes on cluster {1}. It will be killed and tried again.'
+                       .format(self.stall_timeout_minutes, self.cluster_name), severity="WARNING", entity_id=self.entity_id)
+                killall_jobs(self.cluster_name, region)
+                return
+
+
 def run_job(cluster_name, job_name, full_conf, collect_results_dir, consecutive_failures=0, entity_id=runner_eid):
     while True:
+        started = backend.time()
+        timeout = get_job_timeout_minutes(job_name, full_conf.cluster_conf, job_timeout_minutes)
         try:
-            log.info('Running {}'.format(job_name))
-            cluster_job_run(cluster_name=cluster_name, job_name=job_name, job_mem=full_conf.cluster_conf.job_mem,
-                            region=full_conf.region_conf.region, job_timeout_minutes=(job_timeout_minutes),
-                            collect_results_dir=collect_results_dir,
-                            detached=True, kill_on_failure=True, disable_assembly_build=True)
+            log.info('Running {0} with a timeout of {1} minutes'.format(job_name, timeout))
+            with trace_span('job_run', full_conf, cluster_name, retries=consecutive_failures, job_name=job_name, job_timeout_minutes=timeout):
+                with ProgressWatchdog(cluster_name, full_conf, entity_id=entity_id):
+                    cluster_job_run(cluster_name=cluster_name, job_name=job_name, job_mem=full_conf.cluster_conf.job_mem,
+                                    region=full_conf.region_conf.region, job_timeout_minutes=timeout,
+                                    collect_results_dir=collect_results_dir,
+                                    detached=True, kill_on_failure=True, disable_assembly_build=True)
+            job_history.record(job_name, full_conf.cluster_conf, backend.time() - started, 'success')
             consecutive_failures = 0
             notify('Job execution completed successfully :)', severity="RESOLVE", entity_id=entity_id)
             return (True, 0)
+        except AssemblyFailedException as e:
+            # The job didn't run, AssemblyBuilder alerts
+            log.warning('No assembly to run {0} with, waiting for the next build'.format(job_name))
+            backend.sleep(assembly_retry_seconds)
         except Exception as e_job:
+            duration = backend.time() - started
             consecutive_failures += 1
             log.exception('Job execution failed')
             notify("""Job execution failed
@@ -382,8 +2115,12 @@ We had {0} consecutive failures of maximum of {1}.
 Exception is: {2}
 """
                    .format(consecutive_failures, max_errors_on_healthy_cluster, traceback.format_exc()), severity="WARNING", entity_id=entity_id)
+            # A sanity check that passed before the failure says nothing about what broke the job (e.g. a nearly
+            # full disk), so the sanity check job always runs here
+            cluster_health.invalidate(cluster_name)
             try:
-                run_sanity_checks(collect_results_dir, full_conf, cluster_name)
+                check_cluster_health(collect_results_dir, full_conf, cluster_name, entity_id=entity_id)
+                job_history.record(job_name, full_conf.cluster_conf, duration, 'failure')
                 if consecutive_failures >= max_errors_on_healthy_cluster:
                     log.error('Max number of consecutive failures reached. Killing healthy cluster =(')
                     notify("Killing healthy cluster =(" "\n\n"
@@ -392,6 +2129,7 @@ Exception is: {2}
                     cluster_destroy(cluster_name, region=full_conf.region_conf.region)
                     return (False, 0)
             except Exception as e_sanity:
+                job_history.record(job_name, full_conf.cluster_conf, duration, 'interrupted')
                 log.exception('Sanity check failed')
                 notify("Sanity check failed\nThe cluster was healthy but now it looks unhealthy. More checks will come soon.", severity="WARNING", entity_id=entity_id)
                 return (False, consecutive_failures)
@@ -400,88 +2138,168 @@ Exception is: {2}
 def setup(job_name):
     setup_eid = "{0}-{1}".format(job_name, runner_eid)
     notify("Initializing job runner\nIt's a pleasure to be back.", severity="INFO", entity_id=setup_eid)
-    while True:
-        try:
-            if cluster.get_assembly_path() is None:
-                build_assembly()
-            break
-        except AssemblyFailedException as e:
-            notify('Failed to build assembly' + "\n" +
-                   'Someone messed up with the installation/deploy. An urgent action is needed. Exception is: ' + traceback.format_exc(),
-                   entity_id=setup_eid)
-
-
-from argh import *
+    assembly_builder.start(setup_eid)
 
 
 def run_continuously(collect_results_dir, namespace_, job_name, cluster_name_prefix, cluster_sequence,
-                     disable_vpc=False, security_group=default_security_group, tag=[]):
-    global namespace
-    namespace = namespace_
+                     disable_vpc=False, security_group=default_security_group, tag=[], warm_standby=False, objective=None):
+    check_objective(objective)
+    setup_context.namespace = namespace_
+    setup_context.trace_path = os.path.join(collect_results_dir, trace_file_name)
 
     setup(job_name)
 
-    consecutive_failures = 0
-
-    blacklisted_confs = ExpireCollection()
-    cluster_name = "{0}-{1}-{2}".format(cluster_name_prefix,
-                                        "classic" if disable_vpc else "vpc",
-                                        env)
+    primary_cluster_name = "{0}-{1}-{2}".format(cluster_name_prefix,
+                                                "classic" if disable_vpc else "vpc",
+                                                env)
+    # After a promotion the setup runs on the standby's cluster name, see WarmStandby
+    cluster_name = state_store.load_active_cluster(primary_cluster_name) or primary_cluster_name
+    # The blacklist and the failures of a previous run of this setup, if it was restarted
+    blacklisted_confs = PersistentExpireCollection(state_store, primary_cluster_name, timeout=blacklist_timeout_seconds,
+                                                   backoff=blacklist_backoff, max_timeout=blacklist_max_timeout_seconds,
+                                                   memory=blacklist_backoff_memory_seconds)
+    consecutive_failures = state_store.load_failures(cluster_name)
 
     full_conf = None
     entity_id = "{0}-runner-{1}".format(cluster_name_prefix, uuid.uuid1())
     
+    # Without warm standby, the standby is only prepared when the spot market of the active conf looks risky
+    standby = WarmStandby(primary_cluster_name, cluster_sequence, blacklisted_confs, collect_results_dir, entity_id, disable_vpc,
+                          security_group=security_group, tag=tag, job_name=job_name, objective=objective)
+    if not warm_standby:
+        standby.destroy_leftover(cluster_name)
+
     def inotify(message, severity="CRITICAL"):
         return notify(message, severity, entity_id=entity_id)
+
+    def on_market_risk(risk):
+        inotify("Spot market risk\n\nThe interruption risk of our cluster {0} with configuration {1} is {2:.2f}. A replacement cluster is being prepared."
+                .format(cluster_name, full_conf, risk), severity="WARNING")
+        standby.prepare(cluster_name, full_conf)
+
+    def on_market_calm(risk):
+        log.info('Interruption risk of {0} is down to {1:.2f}'.format(cluster_name, risk))
+        if not warm_standby:
+            standby.discard()
+
     while True: 
         try:
             full_conf = ensure_cluster(cluster_name, cluster_sequence, full_conf, 
-                                       blacklisted_confs, collect_results_dir, entity_id, disable_vpc, security_group=security_group, tag=tag)
-            while True:
-                success, consecutive_failures = run_job(cluster_name, job_name, full_conf, collect_results_dir, 
-                                                        consecutive_failures, entity_id)
-                if not success:
-                    break
+                                       blacklisted_confs, collect_results_dir, entity_id, disable_vpc, security_group=security_group, tag=tag,
+                                       job_name=job_name, objective=objective)
+            # A promoted standby is smaller than its conf in the sequence. A full size replacement is prepared in its
+            # place and swapped in between two jobs
+            downsized = full_size_conf(full_conf, cluster_sequence) != full_conf
+            if downsized:
+                standby.prepare(cluster_name, full_conf, full_size=True)
+            elif warm_standby:
+                standby.prepare(cluster_name, full_conf)
+            with MarketWatcher(full_conf, on_market_risk, on_market_calm):
+                while True:
+                    success, consecutive_failures = run_job(cluster_name, job_name, full_conf, collect_results_dir, 
+                                                            consecutive_failures, entity_id)
+                    state_store.save_failures(cluster_name, consecutive_failures)
+                    if not success or (downsized and standby.is_ready()):
+                        break
+            promoted = standby.promote()
+            if not promoted and not warm_standby:
+                # A standby still being prepared is no use once the primary is relaunched
+                standby.discard()
+            if promoted:
+                if success:
+                    inotify("Replaced standby cluster\n\nThe full size cluster {0} with configuration {1} replaces the smaller cluster {2}"
+                            .format(promoted[0], promoted[1], cluster_name), severity="INFO")
+                else:
+                    blacklisted_confs.add(full_size_conf(full_conf, cluster_sequence))
+                    inotify("Promoted standby cluster\n\nThe cluster with configuration {0} failed. We are now running on the standby cluster {1} with configuration {2}"
+                            .format(full_conf, promoted[0], promoted[1]), severity="WARNING")
+                if not warm_standby:
+                    # With warm standby, the old cluster is reused or destroyed when the next standby is prepared under its name
+                    destroy_all_clusters(cluster_name)
+                cluster_name, full_conf = promoted
+                state_store.save_active_cluster(primary_cluster_name, cluster_name)
+                consecutive_failures = 0
+                state_store.save_failures(cluster_name, consecutive_failures)
         except Exception as e:
             log.exception('Completely unknown exception')
             inotify("Completely unknown exception\nTime to panic. Exception is: " + traceback.format_exc())
 
 
 def run_once(collect_results_dir, namespace_, job_name, cluster_name_prefix, cluster_sequence,
-             disable_vpc=False, security_group=default_security_group, tag=[]):
+             disable_vpc=False, security_group=default_security_group, tag=[], objective=None):
     
-    global namespace
-    namespace = namespace_
+    check_objective(objective)
+    setup_context.namespace = namespace_
+    setup_context.trace_path = os.path.join(collect_results_dir, trace_file_name)
 
     setup(job_name)
 
-    consecutive_failures = 0
-
-    blacklisted_confs = ExpireCollection()
-    cluster_name = "{0}-{1}-{2}".format(cluster_name_prefix,
-                                        "classic" if disable_vpc else "vpc",
-                                        env)
+    primary_cluster_name = "{0}-{1}-{2}".format(cluster_name_prefix,
+                                                "classic" if disable_vpc else "vpc",
+                                                env)
+    # After a promotion the setup runs on the standby's cluster name, see WarmStandby
+    cluster_name = state_store.load_active_cluster(primary_cluster_name) or primary_cluster_name
+    # The blacklist and the failures of a previous run of this setup, if it was restarted
+    blacklisted_confs = PersistentExpireCollection(state_store, primary_cluster_name, timeout=blacklist_timeout_seconds,
+                                                   backoff=blacklist_backoff, max_timeout=blacklist_max_timeout_seconds,
+                                                   memory=blacklist_backoff_memory_seconds)
+    consecutive_failures = state_store.load_failures(cluster_name)
 
     full_conf = None
     entity_id = "{0}-runner-{1}".format(cluster_name_prefix, uuid.uuid1())
+
+    # The standby is only prepared when the spot market of the active conf looks risky, see MarketWatcher
+    standby = WarmStandby(primary_cluster_name, cluster_sequence, blacklisted_confs, collect_results_dir, entity_id, disable_vpc,
+                          security_group=security_group, tag=tag, job_name=job_name, objective=objective)
+    standby.destroy_leftover(cluster_name)
+
     def inotify(message, severity="CRITICAL"):
         return notify(message, severity, entity_id=entity_id)
 
+    def on_market_risk(risk):
+        inotify("Spot market risk\n\nThe interruption risk of our cluster {0} with configuration {1} is {2:.2f}. A replacement cluster is being prepared."
+                .format(cluster_name, full_conf, risk), severity="WARNING")
+        standby.prepare(cluster_name, full_conf)
+
+    def on_market_calm(risk):
+        log.info('Interruption risk of {0} is down to {1:.2f}'.format(cluster_name, risk))
+        standby.discard()
+
     while True:
         try:
             full_conf = ensure_cluster(cluster_name, cluster_sequence, full_conf, 
-                                       blacklisted_confs, collect_results_dir, entity_id, disable_vpc, security_group=security_group, tag=tag)
-            success, consecutive_failures = run_job(cluster_name, job_name, full_conf, collect_results_dir, 
-                                                    consecutive_failures, entity_id)
+                                       blacklisted_confs, collect_results_dir, entity_id, disable_vpc, security_group=security_group, tag=tag,
+                                       job_name=job_name, objective=objective)
+            with MarketWatcher(full_conf, on_market_risk, on_market_calm):
+                success, consecutive_failures = run_job(cluster_name, job_name, full_conf, collect_results_dir, 
+                                                        consecutive_failures, entity_id)
+            state_store.save_failures(cluster_name, consecutive_failures)
             if success:
                 break
+            promoted = standby.promote()
+            if not promoted:
+                # A standby still being prepared is no use once the primary is relaunched
+                standby.discard()
+                continue
+            blacklisted_confs.add(full_size_conf(full_conf, cluster_sequence))
+            inotify("Promoted standby cluster\n\nThe cluster with configuration {0} failed. We are now running on the standby cluster {1} with configuration {2}"
+                    .format(full_conf, promoted[0], promoted[1]), severity="WARNING")
+            destroy_all_clusters(cluster_name)
+            cluster_name, full_conf = promoted
+            state_store.save_active_cluster(primary_cluster_name, cluster_name)
+            consecutive_failures = 0
+            state_store.save_failures(cluster_name, consecutive_failures)
         except Exception as e:
             log.exception('Completely unknown exception')
             inotify("Completely unknown exception\nTime to panic. Exception is: " + traceback.format_exc())
+    standby.discard()
+    standby.join()
     destroy_all_clusters(cluster_name)
+    state_store.save_active_cluster(primary_cluster_name, primary_cluster_name)
 
 
-def mysetup1(collect_results_dir, disable_vpc = False, security_group = default_security_group):
+# objective may be 'cost' or 'time' to pick confs by their job history, see get_best_conf_and_az
+def mysetup1(collect_results_dir, disable_vpc = False, security_group = default_security_group, objective = None):
     # This job will run once, then the cluster will destroyed
     run_once(collect_results_dir,
             "app1",
@@ -490,9 +2308,10 @@ def mysetup1(collect_results_dir, disable_vpc = False, security_group = default_
              cluster_sequence=mysetup1_cluster_sequence,
              disable_vpc=disable_vpc,
              security_group=security_group,
-             tag=["tag1=value1"])
+             tag=["tag1=value1"],
+             objective=objective)
 
-def mysetup2(collect_results_dir, disable_vpc = False, security_group = default_security_group):
+def mysetup2(collect_results_dir, disable_vpc = False, security_group = default_security_group, warm_standby = False, objective = None):
     # This job will run a in loop, forever
     run_continuously(collect_results_dir,
             "app2",
@@ -501,10 +2320,147 @@ def mysetup2(collect_results_dir, disable_vpc = False, security_group = default_
              cluster_sequence=mysetup1_cluster_sequence,
              disable_vpc=disable_vpc,
              security_group=security_group,
-             tag=["tag1=value1"])
-    
+             tag=["tag1=value1"],
+             warm_standby=warm_standby,
+             objective=objective)
+
+# All setups must be added here
+available_setups = [mysetup1, mysetup2]
+
+
+# Options that a setup of multi can take, see parse_setup_spec
+setup_options = {
+    'warm_standby': lambda value: value.lower() in ['', 'true', 'yes', '1'],
+    'objective': check_objective,
+}
+
+def parse_setup_spec(spec):
+    """
+    Splits name:option=value,option of the setups of multi into the setup name and its options
+    An option without a value is a flag set to true
+
+    >>> parse_setup_spec('mysetup1')
+    ('mysetup1', {})
+    >>> name, options = parse_setup_spec('mysetup2:warm_standby,objective=cost')
+    >>> name, sorted(options.items())
+    ('mysetup2', [('objective', 'cost'), ('warm_standby', True)])
+    >>> parse_setup_spec('mysetup2:color=red')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown option color of setup mysetup2. Available options are: objective, warm_standby
+    >>> parse_setup_spec('mysetup2:objective=costs')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown objective costs. Available objectives are: cost, time
+    """
+    name, _, options_spec = spec.partition(':')
+    options = {}
+    for option in filter(None, options_spec.split(',')):
+        key, _, value = option.partition('=')
+        if key not in setup_options:
+            raise ValueError('Unknown option {0} of setup {1}. Available options are: {2}'.format(key, name, ', '.join(sorted(setup_options))))
+        options[key] = setup_options[key](value)
+    return name, options
+
+def setup_arguments(setup_function):
+    return setup_function.__code__.co_varnames[:setup_function.__code__.co_argcount]
+
+
+def run_setup_isolated(setup_function, collect_results_dir, disable_vpc, security_group, options={}):
+    setup_eid = "{0}-{1}".format(setup_function.__name__, runner_eid)
+    try:
+        setup_function(collect_results_dir, disable_vpc=disable_vpc, security_group=security_group, **options)
+        log.info('Setup {0} finished'.format(setup_function.__name__))
+    except Exception as e:
+        log.exception('Setup {0} failed'.format(setup_function.__name__))
+        notify("Setup {0} failed\n\nThe other setups of this runner keep going. Exception is: {1}"
+               .format(setup_function.__name__, traceback.format_exc()), entity_id=setup_eid)
+
+
+def multi(collect_results_dir, setups, disable_vpc=False, security_group=default_security_group, warm_standby=False, objective=None):
+    """
+    Supervises many setups at the same time from this process, each one in its own thread
+    They share the spot price cache, the heartbeat/alert delivery and the assembly build,
+    while each keeps its own cluster, blacklist, failure counters and results directory (collect_results_dir/<setup>)
+    Each setup is given as name[:option[=value],...] (see parse_setup_spec). --warm-standby and --objective apply to
+    the setups that take them, unless the setup has its own
+    """
+    setup_by_name = dict((f.__name__, f) for f in available_setups)
+    try:
+        check_objective(objective)
+        specs = [parse_setup_spec(spec) for spec in setups]
+    except ValueError as e:
+        sys.exit(str(e))
+    unknown = [name for name, _ in specs if name not in setup_by_name]
+    if unknown:
+        sys.exit('Unknown setups: {0}. Available setups are: {1}'.format(', '.join(unknown), ', '.join(sorted(setup_by_name))))
+    setup_runs = []
+    for name, options in specs:
+        setup_function = setup_by_name[name]
+        arguments = setup_arguments(setup_function)
+        unsupported = [key for key in options if key not in arguments]
+        if unsupported:
+            sys.exit('Setup {0} does not take {1}'.format(name, ', '.join(unsupported)))
+        for key, value in [('warm_standby', warm_standby), ('objective', objective)]:
+            if key in arguments and key not in options and value:
+                options[key] = value
+        results_dir = os.path.join(collect_results_dir, name)
+        if not os.path.isdir(results_dir):
+            os.makedirs(results_dir)
+        setup_runs.append((setup_function, results_dir, options))
+    threads = []
+    for setup_function, results_dir, options in setup_runs:
+        thread = threading.Thread(target=run_setup_isolated, name=setup_function.__name__,
+                                  args=(setup_function, results_dir, disable_vpc, security_group, options))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    while any(thread.is_alive() for thread in threads):
+        # Join with a timeout so the main thread still gets KeyboardInterrupt
+        for thread in threads:
+            thread.join(1)
+
+def selftest(verbose=False):
+    """
+    Runs the doctests of this script. They used to run on every start, now the runner starts without them
+    """
+    import doctest
+    result = doctest.testmod(sys.modules[__name__], verbose=verbose)
+    if result.failed:
+        sys.exit('{0} of {1} doctests failed'.format(result.failed, result.attempted))
+    return '{0} doctests passed'.format(result.attempted)
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+def freeze(obj):
+    """
+    Returns a hashable version of obj, turning lists and dicts (at any depth) into tuples
+    >>> freeze(('a', 1))
+    ('a', 1)
+    >>> freeze(FullConf('a', RegionConf('r', None, None, ['a', 'b'], None, {'ra': 's'}), 'ra'))
+    ('a', ('r', None, None, ('a', 'b'), None, (('ra', 's'),)), 'ra')
+    """
+    try:
+        hash(obj)
+        return obj
+    except TypeError:
+        pass
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(o) for o in obj)
+    if isinstance(obj, dict):
+        return tuple((freeze(k), freeze(v)) for k, v in obj.items())
+    return obj
+
 class ExpireCollection:
     """
+    A set whose items are forgotten after a timeout, which may be different for each item
+    Items are indexed by hash, so checking membership doesn't depend on the size of the collection.
+    Expired items are dropped lazily from a heap ordered by deadline, no threads involved
+    If backoff > 1, each time the same item is added again its default timeout is multiplied by backoff. The backoff
+    starts over if the item isn't added again within memory seconds after it expires (max_timeout, or timeout, by default)
     >>> c = ExpireCollection(timeout=0.5)
     >>> import time
     >>> c.add('something')
@@ -515,30 +2471,136 @@ class ExpireCollection:
     >>> time.sleep(0.6)
     >>> len(c)
     0
+    >>> c.add('other', timeout=60)
+    >>> c.add('something')
+    >>> c.timeout_for('something'), sorted(c)
+    (0.5, ['other', 'something'])
+    >>> c = ExpireCollection(timeout=10, backoff=2, max_timeout=30)
+    >>> c.timeout_for('x')
+    10
+    >>> c.add('x')
+    >>> c.timeout_for('x')
+    20
+    >>> c.add('x'); c.add('x')
+    >>> c.timeout_for('x')
+    30
+    >>> now = [0]
+    >>> c = ExpireCollection(timeout=10, backoff=2, memory=100, clock=lambda: now[0])
+    >>> c.add('x'); now[0] = 109
+    >>> 'x' in c, c.timeout_for('x')
+    (False, 20)
+    >>> now[0] = 110
+    >>> c.timeout_for('x')
+    10
     """
-    def __init__(self, timeout=60*60*3):
-        import collections
+    def __init__(self, timeout=60*60*3, backoff=1, max_timeout=None, memory=None, clock=monotonic):
         self.timeout = timeout
-        self.events = collections.deque()
-
-    def add(self, item):
-        import threading
-        self.events.append(item)
-        threading.Timer(self.timeout, self.expire).start()
+        self.backoff = backoff
+        self.max_timeout = max_timeout
+        self.memory = memory if memory is not None else (max_timeout if max_timeout is not None else timeout)
+        self.clock = clock
+        self.lock = threading.Lock()
+        # frozen item -> (deadline, item)
+        self.entries = {}
+        # (deadline, sequence, frozen item). Entries whose item was added again are skipped when popped
+        self.deadlines = []
+        self.sequence = itertools.count()
+        # How many times each item was added, used for backoff
+        self.additions = collections.Counter()
+        # frozen item -> when its additions are forgotten, and a heap of (time, sequence, frozen item) like deadlines
+        self.forget_at = {}
+        self.forgets = []
+
+    def timeout_for(self, item):
+        """The timeout item gets next time it is added"""
+        with self.lock:
+            self._expire(self.clock())
+            return self._timeout_for(freeze(item))
+
+    def _timeout_for(self, key):
+        timeout = self.timeout * self.backoff ** self.additions[key]
+        return min(timeout, self.max_timeout) if self.max_timeout is not None else timeout
+
+    def add(self, item, timeout=None, additions=None):
+        """additions overrides how many times item was added, including this time"""
+        key = freeze(item)
+        with self.lock:
+            now = self.clock()
+            self._expire(now)
+            if timeout is None:
+                timeout = self._timeout_for(key)
+            self.additions[key] = additions if additions is not None else self.additions[key] + 1
+            deadline = now + timeout
+            # Expired items are kept out of entries, only their additions are remembered
+            if timeout > 0:
+                self.entries[key] = (deadline, item)
+                heapq.heappush(self.deadlines, (deadline, next(self.sequence), key))
+            self.forget_at[key] = deadline + self.memory
+            heapq.heappush(self.forgets, (deadline + self.memory, next(self.sequence), key))
 
     def __len__(self):
-        return len(self.events)
+        self.expire()
+        return len(self.entries)
+
+    def __iter__(self):
+        self.expire()
+        return iter([item for deadline, item in list(self.entries.values())])
 
     def expire(self):
         """Remove any expired events
         """
-        self.events.popleft()
+        with self.lock:
+            self._expire(self.clock())
+
+    def _expire(self, now):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, key = heapq.heappop(self.deadlines)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == deadline:
+                del self.entries[key]
+        while self.forgets and self.forgets[0][0] <= now:
+            forget_at, _, key = heapq.heappop(self.forgets)
+            if self.forget_at.get(key) == forget_at:
+                del self.forget_at[key]
+                del self.additions[key]
 
     def __str__(self):
-        return str(self.events)
+        return str(list(self))
 
     def __contains__(self, elem):
-        return elem in self.events
+        entry = self.entries.get(freeze(elem))
+        return entry is not None and entry[0] > self.clock()
+
+class PersistentExpireCollection(ExpireCollection):
+    """
+    An ExpireCollection saved in the state store under name, so a restarted runner keeps the items with the rest of
+    their timeouts and their backoff
+    >>> import tempfile
+    >>> store = StateStore(os.path.join(tempfile.mkdtemp(), 'state.sqlite'))
+    >>> c = PersistentExpireCollection(store, 'c', timeout=60, backoff=2)
+    >>> c.add('x')
+    >>> restarted = PersistentExpireCollection(store, 'c', timeout=60, backoff=2)
+    >>> 'x' in restarted, restarted.timeout_for('x'), len(PersistentExpireCollection(store, 'other'))
+    (True, 120, 0)
+    >>> store.save_blacklisted('c', 'y', time.time() - 10, 3)
+    >>> PersistentExpireCollection(store, 'c', timeout=60, backoff=2, memory=60).timeout_for('y')
+    480
+    >>> PersistentExpireCollection(store, 'c', timeout=60, backoff=2, memory=5).timeout_for('y')
+    60
+    """
+    def __init__(self, store, name, **kwargs):
+        ExpireCollection.__init__(self, **kwargs)
+        self.store = store
+        self.name = name
+        # Expired items come back with a negative timeout, only to remember their backoff for the rest of memory
+        for item, remaining, additions in store.load_blacklist(name, self.memory):
+            ExpireCollection.add(self, item, timeout=remaining, additions=additions)
+
+    def add(self, item, timeout=None):
+        if timeout is None:
+            timeout = self.timeout_for(item)
+        ExpireCollection.add(self, item, timeout=timeout)
+        self.store.save_blacklisted(self.name, item, time.time() + timeout, self.additions[freeze(item)])
 
 
 def object_to_base64(obj):
@@ -548,9 +2610,10 @@ def base64_to_object(b64):
     return pickle.loads(base64.b64decode(b64))
 
 if __name__ == '__main__':
-    import doctest
-    doctest.testmod()
+    # argh is only needed here, so importing this module (e.g. from bench_runner.py) doesn't load it
+    from argh import ArghParser, arg
     parser = ArghParser()
-    # All setups must be added here
-    parser.add_commands([mysetup1, mysetup2])
+    with_objective = lambda f: arg('-o', '--objective', choices=objectives, help='pick confs by their job history')(f) if 'objective' in setup_arguments(f) else f
+    parser.add_commands([with_objective(f) for f in available_setups] +
+                        [with_objective(arg('setups', nargs='+', help='names of the setups to run, with their options as name:option=value,...')(multi)), selftest])
     parser.dispatch()
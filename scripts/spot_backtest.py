@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# Offline backtest of the conf selection of job_runner.py (get_best_conf_and_az) on recorded spot prices
+# It replays the price histories through the selection for each combination of the given policy parameters,
+# simulating an interruption whenever the market price goes above the bid, and reports cost, uptime and switches
+# Usage:
+#   spot_backtest.py (--aws-json FILE [FILE ...] | --fetch-days N | --synthetic-days N) [--setup mysetup1]
+#                    [--recent-hours H ...] [--recent-n N ...] [--historical-hours H ...] [--historical-n N ...] [--margin M ...]
+# --aws-json takes the output of: aws ec2 describe-spot-price-history --product-descriptions Linux/UNIX --start-time ...
+# --fetch-days asks EC2 for the last N days (it keeps 90), --synthetic-days uses the fake market of fake_backend.py
+# E.g. to tune the margin and the historical window: spot_backtest.py --aws-json prices.json --margin 0.6 0.7 0.8 0.9 --historical-n 5 10 20
+#
+# Differences from the runner, on purpose to keep it fast: prices are resampled on a grid of --step-minutes, so the
+# worst N prices of a window are the worst N grid points rather than the worst N records; clusters are only replaced
+# when they are interrupted; the cost is the spot price paid by the slaves (not the master) and ondemand confs are ignored
+import argparse, collections, itertools, json, logging, sys, time
+import numpy as np
+import job_runner
+
+Market = collections.namedtuple('Market', ['keys', 'times', 'prices'])
+Result = collections.namedtuple('Result', ['params', 'cost', 'uptime', 'switches'])
+PolicyParams = collections.namedtuple('PolicyParams', ['recent_hours', 'recent_n', 'historical_hours', 'historical_n', 'margin'])
+
+
+def load_aws_json(paths, instance_types):
+    """{(region, az, instance_type): PriceHistory} from the json output of aws ec2 describe-spot-price-history"""
+    records = collections.defaultdict(list)
+    for path in paths:
+        with open(path) as f:
+            for item in json.load(f)['SpotPriceHistory']:
+                if item['InstanceType'] in instance_types and item.get('ProductDescription', 'Linux/UNIX') == 'Linux/UNIX':
+                    az = item['AvailabilityZone']
+                    records[(az[:-1], az, item['InstanceType'])].append(job_runner.PriceRecord(item['Timestamp'], float(item['SpotPrice'])))
+    return dict((key, job_runner.price_history_from_records(r)) for key, r in records.items())
+
+
+def fetch_histories(days, instance_types):
+    """{(region, az, instance_type): PriceHistory} of the last days, from EC2 through the runner's backend"""
+    histories = {}
+    for region, region_conf in job_runner.regions_conf.items():
+        connection = job_runner.backend.connect_to_region(region)
+        for az in job_runner.get_azs_for_region(region_conf):
+            for instance_type in instance_types:
+                records = []
+                kwargs = {}
+                while True:
+                    page = connection.get_spot_price_history(start_time=job_runner.get_date_start_at(days * 24), instance_type=instance_type,
+                                                             availability_zone=az, product_description='Linux/UNIX', **kwargs)
+                    records.extend(job_runner.PriceRecord(r.timestamp, float(r.price)) for r in page)
+                    next_token = getattr(page, 'next_token', None)
+                    if not next_token:
+                        break
+                    kwargs = dict(next_token=next_token)
+                if records:
+                    histories[(region, az, instance_type)] = job_runner.price_history_from_records(records)
+    return histories
+
+
+def synthetic_histories(days, instance_types, seed):
+    import fake_backend
+    market = fake_backend.FakeSpotMarket(seed=seed)
+    now = time.time()
+    histories = {}
+    for region, region_conf in job_runner.regions_conf.items():
+        for az in job_runner.get_azs_for_region(region_conf):
+            for instance_type in instance_types:
+                records = market.history(az, instance_type, now - days * 24 * 3600, now)
+                histories[(region, az, instance_type)] = job_runner.price_history_from_records(records)
+    return histories
+
+
+def resample(histories, step_seconds, start=None, end=None):
+    """
+    Forward-fills each history onto a regular grid. Before its first record a price is nan
+    >>> m = resample({('r', 'a', 't'): job_runner.PriceHistory(np.array([0., 100.]), np.array([1., 2.]))}, 50, 0, 150)
+    >>> m.times.tolist(), m.prices.tolist()
+    ([0.0, 50.0, 100.0, 150.0], [[1.0, 1.0, 2.0, 2.0]])
+    """
+    keys = sorted(histories)
+    start = start if start is not None else min(histories[key].timestamps[0] for key in keys)
+    end = end if end is not None else max(histories[key].timestamps[-1] for key in keys)
+    times = np.arange(start, end + step_seconds / 2.0, step_seconds, dtype=np.float64)
+    prices = np.full((len(keys), len(times)), np.nan)
+    for i, key in enumerate(keys):
+        history = histories[key]
+        index = np.searchsorted(history.timestamps, times, side='right') - 1
+        prices[i] = np.where(index >= 0, history.prices[np.maximum(index, 0)], np.nan)
+    return Market(keys, times, prices)
+
+
+def rolling_worst_average(prices, window, n, chunk=4096):
+    """
+    Average of the n highest prices among the last window grid points (the current one included), for every row and point
+    nan prices are ignored, the result is nan where there are none
+    >>> rolling_worst_average(np.array([[1., 5., 2., 3., 4.]]), 3, 2).tolist()
+    [[1.0, 3.0, 3.5, 4.0, 3.5]]
+    """
+    rows, points = prices.shape
+    n = min(n, window)
+    padded = np.concatenate([np.full((rows, window - 1), -np.inf), np.where(np.isnan(prices), -np.inf, prices)], axis=1)
+    result = np.empty((rows, points))
+    # The windows are a strided view of the padded prices, processed in chunks of points to bound the memory used
+    for start in range(0, points, chunk):
+        stop = min(points, start + chunk)
+        block = np.ascontiguousarray(padded[:, start:stop + window - 1])
+        windows = np.lib.stride_tricks.as_strided(block, shape=(rows, stop - start, window),
+                                                  strides=(block.strides[0], block.strides[1], block.strides[1]))
+        worst = np.partition(windows, window - n, axis=2)[:, :, window - n:]
+        valid = np.isfinite(worst)
+        counts = valid.sum(axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[:, start:stop] = np.where(counts > 0, np.where(valid, worst, 0).sum(axis=2) / counts, np.nan)
+    return result
+
+
+class Backtest:
+    """
+    Simulates run_continuously on a market for a cluster sequence. The score matrices of each window are computed
+    once and shared by all the parameter combinations that use them
+    """
+    def __init__(self, market, cluster_sequence, step_seconds, launch_minutes=20, start_index=0):
+        self.market = market
+        self.step_seconds = step_seconds
+        self.launch_steps = int(np.ceil(launch_minutes * 60.0 / step_seconds))
+        self.start_index = start_index
+        self.scores = {}
+        # (cluster_conf, bid, market rows of its instance type) for the spot confs, in the sequence order
+        self.confs = []
+        for cluster_conf in cluster_sequence:
+            if cluster_conf.spot_price is not None:
+                rows = np.array([i for i, key in enumerate(market.keys) if key[2] == cluster_conf.instance_type], dtype=int)
+                if len(rows):
+                    self.confs.append((cluster_conf, float(cluster_conf.spot_price), rows))
+
+    def score(self, hours, n):
+        key = (hours, n)
+        if key not in self.scores:
+            window = max(1, int(round(hours * 3600.0 / self.step_seconds)))
+            self.scores[key] = rolling_worst_average(self.market.prices, window, n)
+        return self.scores[key]
+
+    def run(self, params):
+        # Like worst_recent_or_historical_price, the worst of the two averages. nan where there are no prices
+        policy_prices = np.fmax(self.score(params.recent_hours, params.recent_n), self.score(params.historical_hours, params.historical_n))
+        prices = self.market.prices
+        points = prices.shape[1]
+        step_hours = self.step_seconds / 3600.0
+        blacklist_steps = job_runner.blacklist_timeout_seconds / self.step_seconds
+        max_blacklist_steps = job_runner.blacklist_max_timeout_seconds / self.step_seconds
+        # (conf index, row) -> (blacklisted until, failures)
+        blacklist = {}
+        t = self.start_index
+        cost = 0.0
+        up_steps = 0
+        switches = 0
+        while t < points:
+            choice = self.select(t, policy_prices, params.margin, blacklist)
+            if choice is None:
+                # The runner waits a minute and tries again, we wait for the next point
+                t += 1
+                continue
+            conf_index, row = choice
+            cluster_conf, bid, _ = self.confs[conf_index]
+            switches += 1
+            with np.errstate(invalid='ignore'):
+                above_bid = prices[row, t:] > bid
+            end = t + int(np.argmax(above_bid)) if above_bid.any() else points
+            cost += np.nansum(prices[row, t:end]) * int(cluster_conf.slaves) * step_hours
+            up_steps += max(0, end - (t + self.launch_steps))
+            _, failures = blacklist.get((conf_index, row), (0, 0))
+            blacklist[(conf_index, row)] = (end + min(blacklist_steps * job_runner.blacklist_backoff ** failures, max_blacklist_steps), failures + 1)
+            t = max(end, t + 1)
+        return Result(params, cost, up_steps / float(max(1, points - self.start_index)), switches)
+
+    def select(self, t, policy_prices, margin, blacklist):
+        """Like get_best_conf_and_az: the first conf in the sequence whose cheapest AZ is below bid * margin"""
+        for conf_index, (cluster_conf, bid, rows) in enumerate(self.confs):
+            candidates = policy_prices[rows, t]
+            allowed = np.array([blacklist.get((conf_index, row), (0, 0))[0] <= t for row in rows])
+            with np.errstate(invalid='ignore'):
+                viable = allowed & (candidates < bid * margin)
+            if viable.any():
+                return conf_index, rows[np.argmin(np.where(viable, candidates, np.inf))]
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--aws-json', nargs='+', help='outputs of aws ec2 describe-spot-price-history')
+    source.add_argument('--fetch-days', type=float, help='fetch this many days of prices from EC2')
+    source.add_argument('--synthetic-days', type=float, help='use this many days of synthetic prices')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic prices')
+    parser.add_argument('--setup', default='mysetup1', help='backtest <setup>_cluster_sequence of job_runner.py')
+    parser.add_argument('--step-minutes', type=float, default=15)
+    parser.add_argument('--launch-minutes', type=float, default=20, help='time from the launch until the cluster runs jobs')
+    parser.add_argument('--recent-hours', type=float, nargs='+', default=[6])
+    parser.add_argument('--recent-n', type=int, nargs='+', default=[2])
+    parser.add_argument('--historical-hours', type=float, nargs='+', default=[12])
+    parser.add_argument('--historical-n', type=int, nargs='+', default=[10])
+    parser.add_argument('--margin', type=float, nargs='+', default=[0.8], help='safe_price_margin')
+    parser.add_argument('--top', type=int, default=20, help='show this many of the best combinations')
+    args = parser.parse_args()
+    job_runner.log.setLevel(logging.WARNING)
+
+    cluster_sequence = getattr(job_runner, '{0}_cluster_sequence'.format(args.setup))
+    instance_types = sorted(set(c.instance_type for c in cluster_sequence if c.spot_price is not None))
+    started = time.time()
+    if args.aws_json:
+        histories = load_aws_json(args.aws_json, instance_types)
+    elif args.fetch_days:
+        histories = fetch_histories(args.fetch_days, instance_types)
+    else:
+        histories = synthetic_histories(args.synthetic_days, instance_types, args.seed)
+    if not histories:
+        sys.exit('No prices for the instance types {0}'.format(', '.join(instance_types)))
+    step_seconds = args.step_minutes * 60
+    market = resample(histories, step_seconds)
+    # Skip the start, until the largest window is full
+    warmup_hours = max(args.recent_hours + args.historical_hours)
+    backtest = Backtest(market, cluster_sequence, step_seconds, args.launch_minutes, start_index=int(np.ceil(warmup_hours * 3600 / step_seconds)))
+    loaded = time.time()
+
+    grid = [PolicyParams(*p) for p in itertools.product(args.recent_hours, args.recent_n, args.historical_hours, args.historical_n, args.margin)]
+    results = [backtest.run(params) for params in grid]
+    finished = time.time()
+
+    days = (market.times[-1] - market.times[backtest.start_index]) / 86400 if backtest.start_index < len(market.times) else 0
+    print('{0} combinations over {1:.1f} days of {2} price histories ({3} points each) in {4:.2f} s (+ {5:.2f} s loading)'.format(
+        len(grid), days, len(market.keys), len(market.times), finished - loaded, loaded - started))
+    defaults = PolicyParams(6, 2, 12, 10, 0.8)
+    print('{0:>8} {1:>8} {2:>8} {3:>8} {4:>6} {5:>10} {6:>8} {7:>8} {8:>12}'.format(
+        'recent_h', 'recent_n', 'hist_h', 'hist_n', 'margin', 'cost', 'uptime', 'switches', 'cost/up_hour'))
+    up_hours = lambda r: r.uptime * days * 24
+    results.sort(key=lambda r: (-round(r.uptime, 3), r.cost / up_hours(r) if up_hours(r) else float('inf')))
+    for result in results[:args.top]:
+        p = result.params
+        print('{0:>8g} {1:>8d} {2:>8g} {3:>8d} {4:>6g} {5:>10.2f} {6:>7.2f}% {7:>8d} {8:>12.3f}{9}'.format(
+            p.recent_hours, p.recent_n, p.historical_hours, p.historical_n, p.margin, result.cost, result.uptime * 100, result.switches,
+            result.cost / up_hours(result) if up_hours(result) else float('nan'), '  (current)' if p == defaults else ''))
+
+
+if __name__ == '__main__':
+    main()
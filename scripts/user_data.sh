@@ -2,3 +2,4 @@
 
 # Here you can put anything that will be run after the boot on each machine in the cluster (including the master)
 # Generally we use it to setup log rotation for long-running clusters
+# job_runner.py appends the export of the cluster shape (IGNITION_* variables) to /etc/environment after this script
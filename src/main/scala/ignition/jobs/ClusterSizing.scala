@@ -0,0 +1,98 @@
+package ignition.jobs
+
+import scala.util.Try
+
+// Derives the Spark configuration from the shape of the cluster the job runs on, so the same setup uses the whole
+// cluster whatever conf the spot market gave us (see job_runner.py, which exports the shape to every machine)
+object ClusterSizing {
+
+  case class InstanceType(cores: Int, memoryMb: Int)
+
+  case class ClusterShape(instanceType: InstanceType, slaves: Int, workerInstances: Int)
+
+  // Cores and memory of the EC2 instance types we launch slaves on
+  val instanceTypes = Map[String, InstanceType](
+    "r3.xlarge" -> InstanceType(4, 31232),
+    "r3.2xlarge" -> InstanceType(8, 62464),
+    "r3.4xlarge" -> InstanceType(16, 124928),
+    "r3.8xlarge" -> InstanceType(32, 249856),
+    "c3.2xlarge" -> InstanceType(8, 15360),
+    "c3.4xlarge" -> InstanceType(16, 30720),
+    "c3.8xlarge" -> InstanceType(32, 61440),
+    "m3.xlarge" -> InstanceType(4, 15360),
+    "m3.2xlarge" -> InstanceType(8, 30720),
+    "m2.4xlarge" -> InstanceType(8, 70042),
+    "hi1.4xlarge" -> InstanceType(16, 61952)
+  )
+
+  // Environment variables set by job_runner.py in /etc/environment of each machine
+  val instanceTypeVariable = "IGNITION_INSTANCE_TYPE"
+  val slavesVariable = "IGNITION_SLAVES"
+  val workerInstancesVariable = "IGNITION_WORKER_INSTANCES"
+
+  // Tasks per core, as the Spark tuning guide recommends 2-3 so a slow task doesn't leave cores idle
+  val tasksPerCore = 3
+  // Part of the worker memory left out of the executor heap for the JVM itself (thread stacks, code cache, netty buffers)
+  val heapOverheadFraction = 0.1
+  // Heap each running task keeps for user code (outside the shuffle and storage fractions)
+  val userMemoryPerTaskMb = 1024
+  val minUserMemoryFraction = 0.3
+  val maxUserMemoryFraction = 0.6
+  // The rest of the heap is split between shuffle and storage in the same ratio as the old fixed 0.2/0.3
+  val shuffleShare = 0.4
+
+  // Memory left to the OS, the HDFS daemons and the page cache, like spark-ec2 does when it sets the worker memory
+  def reservedMemoryMb(memoryMb: Int): Int =
+    if (memoryMb > 100 * 1024) 15 * 1024
+    else if (memoryMb > 60 * 1024) 10 * 1024
+    else if (memoryMb > 40 * 1024) 6 * 1024
+    else if (memoryMb > 20 * 1024) 3 * 1024
+    else if (memoryMb > 10 * 1024) 2 * 1024
+    else 1300
+
+  def executorCores(shape: ClusterShape): Int =
+    math.max(1, shape.instanceType.cores / shape.workerInstances)
+
+  def executorMemoryMb(shape: ClusterShape): Int = {
+    val memoryMb = shape.instanceType.memoryMb
+    val workerMemoryMb = math.max(512, memoryMb - reservedMemoryMb(memoryMb)) / shape.workerInstances
+    math.max(512, (workerMemoryMb * (1 - heapOverheadFraction)).toInt)
+  }
+
+  def totalCores(shape: ClusterShape): Int =
+    executorCores(shape) * shape.workerInstances * shape.slaves
+
+  // Executors with little memory per core need a bigger part of the heap for user code, or they run out of memory
+  def userMemoryFraction(shape: ClusterShape): Double = {
+    val fraction = userMemoryPerTaskMb.toDouble * executorCores(shape) / executorMemoryMb(shape)
+    math.min(maxUserMemoryFraction, math.max(minUserMemoryFraction, fraction))
+  }
+
+  def sparkConf(shape: ClusterShape): Map[String, String] = {
+    val parallelism = totalCores(shape) * tasksPerCore
+    val managedFraction = 1 - userMemoryFraction(shape)
+    def fraction(value: Double) = "%.2f".formatLocal(java.util.Locale.US, value)
+    Map(
+      "spark.executor.memory" -> s"${executorMemoryMb(shape)}m",
+      "spark.executor.cores" -> executorCores(shape).toString,
+      "spark.default.parallelism" -> parallelism.toString,
+      "spark.sql.shuffle.partitions" -> parallelism.toString,
+      "spark.shuffle.memoryFraction" -> fraction(managedFraction * shuffleShare),
+      "spark.storage.memoryFraction" -> fraction(managedFraction * (1 - shuffleShare))
+    )
+  }
+
+  // None if the variables are missing (e.g. a local run) or malformed, or the instance type is unknown
+  def shapeFromEnvironment(env: Map[String, String]): Option[ClusterShape] = {
+    def positiveInt(variable: String) = env.get(variable).flatMap(value => Try(value.trim.toInt).toOption).filter(_ > 0)
+    for {
+      instanceType <- env.get(instanceTypeVariable).flatMap(instanceTypes.get)
+      slaves <- positiveInt(slavesVariable)
+      workerInstances <- positiveInt(workerInstancesVariable)
+    } yield ClusterShape(instanceType, slaves, workerInstances)
+  }
+
+  // The sized configuration for the cluster we are running on, or nothing (so the job_mem given by the runner is used)
+  def sparkConfFromEnvironment(env: Map[String, String] = sys.env): Map[String, String] =
+    shapeFromEnvironment(env).map(sparkConf).getOrElse(Map.empty)
+}
@@ -0,0 +1,48 @@
+package ignition.jobs
+
+import scala.util.hashing.MurmurHash3
+
+// Approximate counts of strings in a fixed memory of depth * width counters
+// An estimate is never lower than the real count and, with probability 1 - delta, not higher than it
+// by more than epsilon * (total of the counts). Sketches with the same dimensions and seed can be merged
+class CountMinSketch(val depth: Int, val width: Int, val seed: Int = 0) extends Serializable {
+
+  val counts = Array.ofDim[Long](depth, width)
+
+  private def bucket(item: String, row: Int): Int = {
+    val hash = MurmurHash3.stringHash(item, seed + row)
+    ((hash % width) + width) % width
+  }
+
+  def add(item: String, count: Long = 1) {
+    var row = 0
+    while (row < depth) {
+      counts(row)(bucket(item, row)) += count
+      row += 1
+    }
+  }
+
+  def estimate(item: String): Long = {
+    var minimum = Long.MaxValue
+    var row = 0
+    while (row < depth) {
+      minimum = math.min(minimum, counts(row)(bucket(item, row)))
+      row += 1
+    }
+    minimum
+  }
+
+  // Adds the counts of the other sketch to this one
+  def merge(other: CountMinSketch): CountMinSketch = {
+    require(depth == other.depth && width == other.width && seed == other.seed, "Can't merge sketches of different dimensions")
+    for (row <- 0 until depth; column <- 0 until width)
+      counts(row)(column) += other.counts(row)(column)
+    this
+  }
+}
+
+object CountMinSketch {
+
+  def apply(epsilon: Double, delta: Double, seed: Int = 0): CountMinSketch =
+    new CountMinSketch(math.ceil(math.log(1 / delta)).toInt, math.ceil(math.E / epsilon).toInt, seed)
+}
@@ -0,0 +1,137 @@
+package ignition.jobs
+
+import scala.collection.mutable
+
+import org.apache.spark.rdd.RDD
+
+// Access log lines are in the format "<request id> <page> <status>"
+// Address lines are in the format "<request id> <ip>"
+// Each function parses every line once and reads its input in a single pass (plus a shuffle when it groups by key)
+object LogAnalysisJob {
+
+  case class LogLine(requestId: String, page: String, status: String)
+
+  def parse(line: String): LogLine = {
+    val tks = line.split(" ")
+    LogLine(tks(0), tks(1), tks(2))
+  }
+
+  // Number of requests and of requests per status
+  case class LogSummary(total: Long, statusCounts: Map[String, Long]) {
+    def proportion(status: String): Float = statusCounts.getOrElse(status, 0L).toFloat / total
+  }
+
+  // The pages with the most requests, and the number of requests of all the pages
+  case class PageRanking(total: Long, top: Seq[(String, Long)])
+
+  // The n greatest items, in descending order, keeping at most n of them in memory
+  def top[T](items: Iterator[T], n: Int)(implicit ordering: Ordering[T]): Seq[T] = {
+    val smallestFirst = mutable.PriorityQueue.empty[T](ordering.reverse)
+    items.foreach { item =>
+      if (smallestFirst.size < n)
+        smallestFirst.enqueue(item)
+      else if (n > 0 && ordering.gt(item, smallestFirst.head)) {
+        smallestFirst.dequeue()
+        smallestFirst.enqueue(item)
+      }
+    }
+    smallestFirst.toSeq.sorted(ordering.reverse)
+  }
+
+  val byCount = Ordering.by[(String, Long), Long](_._2)
+
+  // The status histogram and total in a single pass, counted in each partition and merged in a tree
+  def summarize(lines: RDD[String]): LogSummary =
+    lines.mapPartitions { partition =>
+      val counts = mutable.HashMap.empty[String, Long]
+      partition.foreach { line =>
+        val status = parse(line).status
+        counts(status) = counts.getOrElse(status, 0L) + 1
+      }
+      Iterator(LogSummary(counts.values.sum, counts.toMap))
+    }.treeReduce { (a, b) =>
+      LogSummary(a.total + b.total, (a.statusCounts.keySet ++ b.statusCounts.keySet).map { status =>
+        status -> (a.statusCounts.getOrElse(status, 0L) + b.statusCounts.getOrElse(status, 0L))
+      }.toMap)
+    }
+
+  // The fraction of the requests that got each of the given statuses
+  def statusProportions(lines: RDD[String], statuses: Seq[String]): Map[String, Float] = {
+    val summary = summarize(lines)
+    statuses.map { s => s -> summary.proportion(s) }.toMap
+  }
+
+  // The fraction of the distinct IPs that made at least one request with the given status
+  // With relativeSD, the distinct IPs are estimated with HyperLogLog instead of being shuffled by distinct()
+  def affectedIpsProportion(statusLines: RDD[String], addressLines: RDD[String], affectedStatus: String,
+                            relativeSD: Option[Double] = None): Float = {
+    // Only the affected requests go through the join
+    val affectedRequests = statusLines.map(parse)
+      .filter { line => line.status == affectedStatus }
+      .map { line => (line.requestId, ()) }
+
+    val ips = addressLines.map { x =>
+      val tks = x.split(" ")
+      (tks(0), tks(1))
+    }
+
+    def countDistinct(rdd: RDD[String]): Long =
+      relativeSD.map { sd => rdd.countApproxDistinct(sd) }.getOrElse(rdd.distinct().count())
+
+    val distinctAffectedIps = countDistinct(affectedRequests.join(ips).map { case (_, (_, ip)) => ip })
+    val distinctTotalIps = countDistinct(ips.map { case (_, ip) => ip })
+
+    distinctAffectedIps.toFloat / distinctTotalIps
+  }
+
+  // The n most requested pages, with a bounded selection in each partition instead of sorting all the pages
+  def topPages(lines: RDD[String], n: Int): PageRanking =
+    lines
+      .map { x => (parse(x).page, 1L) }
+      .reduceByKey { _ + _ }
+      .mapPartitions { pages =>
+        var total = 0L
+        val counted = pages.map { page => total += page._2; page }
+        val partitionTop = top(counted, n)(byCount)
+        Iterator(PageRanking(total, partitionTop))
+      }
+      .treeReduce { (a, b) => PageRanking(a.total + b.total, top((a.top ++ b.top).iterator, n)(byCount)) }
+
+  // Like topPages without the shuffle, for logs with too many distinct pages to count them all
+  // Each partition counts its pages in a CountMinSketch and keeps as candidates the candidatesPerPartition pages with
+  // the highest estimates. The merged sketch estimates the candidates of all partitions, never below their real counts
+  def approxTopPages(lines: RDD[String], n: Int, epsilon: Double = 0.001, delta: Double = 0.01,
+                     candidatesPerPartition: Int = 100): PageRanking = {
+    val (total, sketch, candidates) = lines.mapPartitions { partition =>
+      val sketch = CountMinSketch(epsilon, delta)
+      val candidates = mutable.HashMap.empty[String, Long]
+      // A lower bound of the smallest estimate of the candidates, as their estimates only grow
+      var minimum = 0L
+      var total = 0L
+      partition.foreach { line =>
+        val page = parse(line).page
+        sketch.add(page)
+        total += 1
+        val estimate = sketch.estimate(page)
+        if (candidates.contains(page) || candidates.size < candidatesPerPartition)
+          candidates(page) = estimate
+        else if (estimate > minimum) {
+          val (smallest, smallestEstimate) = candidates.minBy(_._2)
+          if (estimate > smallestEstimate) {
+            candidates -= smallest
+            candidates(page) = estimate
+          }
+          minimum = candidates.values.min
+        }
+      }
+      Iterator((total, sketch, candidates.keySet.toSet))
+    }.treeReduce { case ((totalA, sketchA, candidatesA), (totalB, sketchB, candidatesB)) =>
+      (totalA + totalB, sketchA.merge(sketchB), candidatesA ++ candidatesB)
+    }
+    PageRanking(total, top(candidates.iterator.map { page => (page, sketch.estimate(page)) }, n)(byCount))
+  }
+
+  // Estimate of the number of distinct pages, with HyperLogLog
+  def approxDistinctPages(lines: RDD[String], relativeSD: Double = 0.01): Long =
+    lines.map { x => parse(x).page }.countApproxDistinct(relativeSD)
+}
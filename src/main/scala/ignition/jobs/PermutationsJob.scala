@@ -0,0 +1,79 @@
+package ignition.jobs
+
+import scala.util.hashing.MurmurHash3
+
+import org.apache.spark.rdd.RDD
+
+object PermutationsJob {
+
+  // A count above 1 is written as one char after its letter, offset from the start of the unicode private use area
+  // (which never appears in words), so keys can't be ambiguous
+  private val countBase = '\uE000'
+
+  // Canonical key of a word and its anagrams, computed in linear time: the letters with their counts,
+  // e.g. "banana" -> "a" + count 3 + "b" + "n" + count 2. A count of 1 isn't written, so it's never longer than the word
+  // Words with other chars than a-z are keyed by their sorted chars, after a NUL char so they can't clash with the others
+  def signature(word: String): String = {
+    val counts = new Array[Int](26)
+    var i = 0
+    while (i < word.length) {
+      val letter = word.charAt(i) - 'a'
+      if (letter < 0 || letter >= 26)
+        return "\u0000" + word.sorted
+      counts(letter) += 1
+      i += 1
+    }
+    val key = new StringBuilder
+    var letter = 0
+    while (letter < 26) {
+      if (counts(letter) > 0) {
+        key += ('a' + letter).toChar
+        if (counts(letter) > 1)
+          key += (countBase + counts(letter)).toChar
+      }
+      letter += 1
+    }
+    key.toString
+  }
+
+  // 64 bits hash of a word, so two different words are taken as the same with a negligible probability
+  def wordHash(word: String): Long =
+    (MurmurHash3.stringHash(word, 0).toLong << 32) | (MurmurHash3.stringHash(word, 1) & 0xffffffffL)
+
+  private val multipleWords = Long.MinValue
+
+  // Hashes of the signatures with more than one distinct word. It shuffles only two numbers per signature and
+  // partition. A hash collision only keeps a few more words, but two words of a group with the same wordHash would
+  // make it look like a singleton
+  def multipleWordsSignatures(keyed: RDD[(String, String)]): Set[Int] =
+    keyed
+      .map { case (key, word) => (key.hashCode, wordHash(word)) }
+      .reduceByKey { (a, b) => if (a == b) a else multipleWords }
+      .filter { case (_, hash) => hash == multipleWords }
+      .keys
+      .collect()
+      .toSet
+
+  // Groups the words that are permutations (anagrams) of each other, leaving out the words without any
+  // The groups are merged as sets with map side combine, so a partition sends each distinct word of a group once
+  // With dropSingletons, the words without anagrams are found first (see multipleWordsSignatures) and are left out
+  // before the shuffle of the words. It reads and splits the input twice and collects the hashes of the groups, so
+  // it only pays off when the input is cached (or cheap to compute) and most words have no anagrams
+  def permutations(lines: RDD[String], dropSingletons: Boolean = false): RDD[Set[String]] = {
+    val keyed = lines
+      .flatMap { x => x.split(" ")}
+      .map { word => (signature(word), word) }
+
+    val candidates =
+      if (dropSingletons) {
+        val signatures = lines.sparkContext.broadcast(multipleWordsSignatures(keyed))
+        keyed.filter { case (key, _) => signatures.value.contains(key.hashCode) }
+      } else
+        keyed
+
+    candidates
+      .aggregateByKey(Set.empty[String])((set, word) => set + word, (a, b) => a ++ b)
+      .values
+      .filter { x => x.size > 1 }
+  }
+}
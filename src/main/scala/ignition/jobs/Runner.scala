@@ -5,17 +5,21 @@ import ignition.jobs.setups._
 
 object Runner {
 
+  // Executor memory, cores, parallelism and memory fractions sized for the cluster we run on (see ClusterSizing)
+  // Empty when the cluster shape isn't known, so the static defaults below and the job_mem given by the runner apply
+  val clusterSparkConf = ClusterSizing.sparkConfFromEnvironment()
+
   // Binds a setup name to a function that will run this setup and (optionally) a custom
-  // extra configuration for the given setup
+  // extra configuration for the given setup (e.g. clusterSparkConf ++ Map("spark.storage.memoryFraction" -> "0.5"))
   val availableJobsSetups = Map[String, (CoreJobRunner.RunnerContext => Unit, Map[String, String])](
     // Simple Samples
-    ("HelloWorldSetup", (context => HelloWorldSetup.run(context), Map.empty)),
-    ("WordCountSetup", (context => WordCountSetup.run(context), Map.empty)),
-    ("LogAnalysisSetup1", (context => LogAnalysisSetup1.run(context), Map.empty)),
-    ("LogAnalysisSetup2", (context => LogAnalysisSetup2.run(context), Map.empty)),
-    ("LogAnalysisSetup3", (context => LogAnalysisSetup3.run(context), Map.empty)),
-    ("PermutationsSetup", (context => PermutationsSetup.run(context), Map.empty)),
-    ("UsersPasswordsSetup", (context => UsersPasswordsSetup.run(context), Map.empty))
+    ("HelloWorldSetup", (context => HelloWorldSetup.run(context), clusterSparkConf)),
+    ("WordCountSetup", (context => WordCountSetup.run(context), clusterSparkConf)),
+    ("LogAnalysisSetup1", (context => LogAnalysisSetup1.run(context), clusterSparkConf)),
+    ("LogAnalysisSetup2", (context => LogAnalysisSetup2.run(context), clusterSparkConf)),
+    ("LogAnalysisSetup3", (context => LogAnalysisSetup3.run(context), clusterSparkConf)),
+    ("PermutationsSetup", (context => PermutationsSetup.run(context), clusterSparkConf)),
+    ("UsersPasswordsSetup", (context => UsersPasswordsSetup.run(context), clusterSparkConf))
   )
 
 
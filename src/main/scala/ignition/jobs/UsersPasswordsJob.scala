@@ -0,0 +1,42 @@
+package ignition.jobs
+
+import java.security.MessageDigest
+
+import org.apache.spark.rdd.RDD
+
+object UsersPasswordsJob {
+
+  private val hexDigits = "0123456789abcdef".toCharArray
+
+  def hex(bytes: Array[Byte]): String = {
+    val chars = new Array[Char](bytes.length * 2)
+    var i = 0
+    while (i < bytes.length) {
+      chars(i * 2) = hexDigits((bytes(i) >> 4) & 0xf)
+      chars(i * 2 + 1) = hexDigits(bytes(i) & 0xf)
+      i += 1
+    }
+    new String(chars)
+  }
+
+  def md5Hex(text: String): String =
+    hex(MessageDigest.getInstance("MD5").digest(text.getBytes))
+
+  // Finds the (user, password) pairs whose "user:password" MD5 is one of the given md5s
+  // It's a hash join: the md5s are broadcast as a set and each candidate pair is hashed once, with a MessageDigest
+  // per partition, so the work grows with users * passwords and not with the number of md5s
+  // The md5s (e.g. of a leaked credentials list) must fit in memory
+  def crack(users: RDD[String], passwords: RDD[String], md5s: RDD[String]): RDD[((String, String), String)] = {
+    val targets = users.sparkContext.broadcast(md5s.map(_.toLowerCase).collect().toSet)
+
+    users.cartesian(passwords)
+      .mapPartitions { pairs =>
+        val digest = MessageDigest.getInstance("MD5")
+        val targetSet = targets.value
+        pairs.flatMap { case (user, password) =>
+          val md5 = hex(digest.digest(s"${user}:${password}".getBytes))
+          if (targetSet.contains(md5)) Some(((user, password), md5)) else None
+        }
+      }
+  }
+}
@@ -1,6 +1,7 @@
 package ignition.jobs.setups
 
 import ignition.core.jobs.CoreJobRunner.RunnerContext
+import ignition.jobs.LogAnalysisJob
 
 object LogAnalysisSetup1 {
 
@@ -21,30 +22,12 @@ object LogAnalysisSetup1 {
     val sc = runnerContext.sparkContext
     val sparkConfig = runnerContext.config
     val rdd = sc.parallelize(sample)
-    val status = rdd.map { x =>
-      x.split(" ")(2)
-    }
-
-    val count200 =
-      status
-        .filter { s => s == "200" }
-        .count()
-
-    val count500 =
-      status
-        .filter { s => s == "500"}
-        .count()
-
-    val count401 =
-      status
-        .filter { s => s == "401"}
-        .count()
-
-    val total = rdd.count()
-
-    println(s"Count 200 = ${count200.toFloat / total}")
-    println(s"Count 500 = ${count500.toFloat / total}")
-    println(s"Count 401 = ${count401.toFloat / total}")
+
+    val proportions = LogAnalysisJob.statusProportions(rdd, Seq("200", "500", "401"))
+
+    println(s"Count 200 = ${proportions("200")}")
+    println(s"Count 500 = ${proportions("500")}")
+    println(s"Count 401 = ${proportions("401")}")
 
   }
 
@@ -1,6 +1,7 @@
 package ignition.jobs.setups
 
 import ignition.core.jobs.CoreJobRunner.RunnerContext
+import ignition.jobs.LogAnalysisJob
 
 object LogAnalysisSetup2 {
 
@@ -34,33 +35,11 @@ object LogAnalysisSetup2 {
      val sparkConfig = runnerContext.config
 
      val statusRDD = sc.parallelize(statusLines)
-     val status = statusRDD.map { x =>
-       val tks = x.split(" ")
-       (tks(0), tks(2))
-     }
-
      val ipsRDD = sc.parallelize(addressLines)
 
-     val ips = ipsRDD.map { x =>
-       val tks = x.split(" ")
-       (tks(0), tks(1))
-     }
-
-     val distinctAffectedIps =
-       status.join(ips)
-         .map { case (_, t) => t }
-         .filter { case (_status, _ip) => _status == "401" }
-         .map { case (_status, _ip) => _ip }
-         .distinct()
-         .count()
-
-     val distinctTotalIps =
-       ips
-         .map { case (_, _ip) => _ip }
-         .distinct()
-         .count()
+     val affectedIpsProportion = LogAnalysisJob.affectedIpsProportion(statusRDD, ipsRDD, "401")
 
-     println(s"Proportion of affected IPs = ${distinctAffectedIps.toFloat / distinctTotalIps}")
+     println(s"Proportion of affected IPs = ${affectedIpsProportion}")
 
 
    }
@@ -1,6 +1,7 @@
 package ignition.jobs.setups
 
 import ignition.core.jobs.CoreJobRunner.RunnerContext
+import ignition.jobs.LogAnalysisJob
 
 object LogAnalysisSetup3 {
   
@@ -25,19 +26,11 @@ object LogAnalysisSetup3 {
 
      val statusRDD = sc.parallelize(statusLines)
 
-     val pages = statusRDD.map { x =>
-       x.split(" ")(1)
-     }
+     val ranking = LogAnalysisJob.topPages(statusRDD, 5)
 
-     val total = statusRDD.count()
-
-     pages
-       .map { p => (p, 1) }
-       .reduceByKey { _ + _ }
-       .sortBy({ case (page, count) => count }, false)
-       .take(5)
+     ranking.top
        .foreach { case (page, count) =>
-         println(s"${page} ${count} ${count.toFloat / total}")
+         println(s"${page} ${count} ${count.toFloat / ranking.total}")
        }
 
 
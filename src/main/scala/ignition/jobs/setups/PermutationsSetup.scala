@@ -1,6 +1,7 @@
 package ignition.jobs.setups
 
 import ignition.core.jobs.CoreJobRunner.RunnerContext
+import ignition.jobs.PermutationsJob
 
 object PermutationsSetup {
 
@@ -21,12 +22,7 @@ object PermutationsSetup {
      val usersRDD = sc.parallelize(usersList)
 
      val words =
-       usersRDD
-         .flatMap { x => x.split(" ")}
-         .keyBy { x => x.sorted }
-         .groupByKey()
-         .map { case (_, it) => it.toSet }
-         .filter { x => x.size > 1 }
+       PermutationsJob.permutations(usersRDD)
          .map { x => x.mkString(" ") }
 
      words.collect() foreach println
@@ -1,8 +1,7 @@
 package ignition.jobs.setups
 
-import java.security.MessageDigest
-
 import ignition.core.jobs.CoreJobRunner.RunnerContext
+import ignition.jobs.UsersPasswordsJob
 
 object UsersPasswordsSetup {
 
@@ -36,13 +35,7 @@ object UsersPasswordsSetup {
      val passwordsRDD = sc.parallelize(passwordsList)
      val md5sRDD = sc.parallelize(md5sList)
 
-     usersRDD.cartesian(passwordsRDD).cartesian(md5sRDD)
-       .filter { case ((user, password), md5) =>
-         val pair = s"${user}:${password}"
-         val currentMD5 =
-           MessageDigest.getInstance("MD5").digest(pair.getBytes).map("%02x".format(_)).mkString
-         md5 == currentMD5
-       }
+     UsersPasswordsJob.crack(usersRDD, passwordsRDD, md5sRDD)
        .collect()
        .foreach(println)
 
@@ -0,0 +1,50 @@
+package ignition.jobs
+
+import org.scalatest.{ShouldMatchers, FlatSpec}
+
+
+class ClusterSizingSpec extends FlatSpec with ShouldMatchers {
+
+  def env(instanceType: String, slaves: String, workerInstances: String) = Map(
+    ClusterSizing.instanceTypeVariable -> instanceType,
+    ClusterSizing.slavesVariable -> slaves,
+    ClusterSizing.workerInstancesVariable -> workerInstances)
+
+  "ClusterSizing" should "use all the cores of the cluster" in {
+    val conf = ClusterSizing.sparkConfFromEnvironment(env("r3.8xlarge", "8", "4"))
+
+    conf("spark.executor.cores") shouldBe "8"
+    conf("spark.default.parallelism") shouldBe (8 * 32 * ClusterSizing.tasksPerCore).toString
+    conf("spark.sql.shuffle.partitions") shouldBe conf("spark.default.parallelism")
+  }
+
+  it should "split the instance memory between the workers, leaving some to the OS" in {
+    val big = ClusterSizing.sparkConfFromEnvironment(env("r3.8xlarge", "8", "4"))
+    val small = ClusterSizing.sparkConfFromEnvironment(env("r3.xlarge", "60", "1"))
+
+    big("spark.executor.memory") shouldBe "52761m"
+    small("spark.executor.memory") shouldBe "25344m"
+  }
+
+  it should "give more heap to user code when there is little memory per core" in {
+    val memoryRich = ClusterSizing.sparkConfFromEnvironment(env("r3.2xlarge", "30", "1"))
+    val memoryPoor = ClusterSizing.sparkConfFromEnvironment(env("c3.8xlarge", "10", "1"))
+
+    memoryRich("spark.shuffle.memoryFraction") shouldBe "0.28"
+    memoryRich("spark.storage.memoryFraction") shouldBe "0.42"
+    memoryPoor("spark.shuffle.memoryFraction") shouldBe "0.16"
+    memoryPoor("spark.storage.memoryFraction") shouldBe "0.24"
+  }
+
+  it should "size nothing when the cluster shape is unknown" in {
+    ClusterSizing.sparkConfFromEnvironment(Map.empty) shouldBe Map.empty
+    ClusterSizing.sparkConfFromEnvironment(env("x9.huge", "8", "1")) shouldBe Map.empty
+  }
+
+  it should "size nothing when the cluster shape is malformed" in {
+    ClusterSizing.sparkConfFromEnvironment(env("r3.8xlarge", "eight", "4")) shouldBe Map.empty
+    ClusterSizing.sparkConfFromEnvironment(env("r3.8xlarge", "8", "")) shouldBe Map.empty
+    ClusterSizing.sparkConfFromEnvironment(env("r3.8xlarge", "0", "4")) shouldBe Map.empty
+  }
+
+}
@@ -0,0 +1,71 @@
+package ignition.jobs
+
+import ignition.core.testsupport.spark.SharedSparkContext
+import org.scalatest.{ShouldMatchers, FlatSpec}
+
+
+class LogAnalysisJobSpec extends FlatSpec with ShouldMatchers with SharedSparkContext {
+
+  val statusLines = Seq(
+    "1 /comprar 200",
+    "2 /comprar 200",
+    "3 /comprar 500",
+    "4 /listar 200",
+    "5 /listar 401",
+    "6 /ver 401",
+    "7 /comprar 200",
+    "8 /excluir 404")
+
+  val addressLines = Seq(
+    "1 10.0.0.1",
+    "2 10.0.0.2",
+    "3 10.0.0.1",
+    "4 10.0.0.3",
+    "5 10.0.0.4",
+    "6 10.0.0.4",
+    "7 10.0.0.2",
+    "8 10.0.0.5")
+
+  "LogAnalysisJob" should "count the requests of each status in a single pass" in {
+    val summary = LogAnalysisJob.summarize(sc.parallelize(statusLines, 3))
+
+    summary.total shouldBe 8
+    summary.statusCounts shouldBe Map("200" -> 4L, "401" -> 2L, "500" -> 1L, "404" -> 1L)
+    summary.proportion("401") shouldBe 0.25f
+    summary.proportion("403") shouldBe 0.0f
+  }
+
+  it should "find the proportion of IPs affected by a status" in {
+    val proportion = LogAnalysisJob.affectedIpsProportion(sc.parallelize(statusLines), sc.parallelize(addressLines), "401")
+
+    proportion shouldBe 0.2f
+  }
+
+  it should "select the top pages" in {
+    val ranking = LogAnalysisJob.topPages(sc.parallelize(statusLines, 3), 2)
+
+    ranking.total shouldBe 8
+    ranking.top shouldBe Seq(("/comprar", 4L), ("/listar", 2L))
+  }
+
+  it should "estimate the top pages without undercounting them" in {
+    val pages = (1 to 2000).map { i => s"$i /page${i % 500} 200" } ++ (1 to 300).map { i => s"$i /popular 200" }
+    val ranking = LogAnalysisJob.approxTopPages(sc.parallelize(pages, 4), 1, candidatesPerPartition = 10)
+
+    ranking.total shouldBe 2300
+    ranking.top.head._1 shouldBe "/popular"
+    ranking.top.head._2 should be >= 300L
+  }
+
+  "CountMinSketch" should "merge the counts of two sketches" in {
+    val a = CountMinSketch(0.01, 0.01)
+    val b = CountMinSketch(0.01, 0.01)
+    a.add("x", 3)
+    b.add("x", 2)
+    b.add("y")
+
+    a.merge(b).estimate("x") should be >= 5L
+    a.estimate("z") should be <= 1L
+  }
+
+}
@@ -0,0 +1,41 @@
+package ignition.jobs
+
+import ignition.core.testsupport.spark.SharedSparkContext
+import ignition.jobs.setups.PermutationsSetup
+import org.scalatest.{ShouldMatchers, FlatSpec}
+
+
+class PermutationsJobSpec extends FlatSpec with ShouldMatchers with SharedSparkContext {
+
+  val expectedGroups = Set(Set("roseboro", "bororose"), Set("howlet", "telwoh"), Set("aless", "sales"))
+
+  "PermutationsJob" should "group the anagrams" in {
+    val groups = PermutationsJob.permutations(sc.parallelize(PermutationsSetup.usersList, 3))
+
+    groups.collect().toSet shouldBe expectedGroups
+  }
+
+  it should "group the same anagrams dropping the singletons first" in {
+    val groups = PermutationsJob.permutations(sc.parallelize(PermutationsSetup.usersList, 3), dropSingletons = true)
+
+    groups.collect().toSet shouldBe expectedGroups
+  }
+
+  it should "not take repeated words as anagrams" in {
+    val words = sc.parallelize(Seq("sales sales", "aless", "xyz xyz"), 2)
+
+    PermutationsJob.permutations(words).collect().toSet shouldBe Set(Set("aless", "sales"))
+    val groups = PermutationsJob.permutations(words, dropSingletons = true)
+
+    groups.collect().toSet shouldBe Set(Set("aless", "sales"))
+  }
+
+  "signature" should "be the same only for anagrams" in {
+    PermutationsJob.signature("banana") shouldBe PermutationsJob.signature("nabana")
+    PermutationsJob.signature("ab") should not be PermutationsJob.signature("aab")
+    PermutationsJob.signature("12") should not be PermutationsJob.signature("11")
+    PermutationsJob.signature("Sales") shouldBe PermutationsJob.signature("ealSs")
+    PermutationsJob.signature("sales").length should be <= "sales".length
+  }
+
+}
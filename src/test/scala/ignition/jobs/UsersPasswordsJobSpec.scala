@@ -0,0 +1,33 @@
+package ignition.jobs
+
+import ignition.core.testsupport.spark.SharedSparkContext
+import ignition.jobs.setups.UsersPasswordsSetup
+import org.scalatest.{ShouldMatchers, FlatSpec}
+
+
+class UsersPasswordsJobSpec extends FlatSpec with ShouldMatchers with SharedSparkContext {
+
+  "UsersPasswordsJob" should "find the users and passwords of the md5s" in {
+    val found = UsersPasswordsJob.crack(
+      sc.parallelize(UsersPasswordsSetup.usersList, 2),
+      sc.parallelize(UsersPasswordsSetup.passwordsList, 2),
+      sc.parallelize(UsersPasswordsSetup.md5sList))
+
+    found.collect().toSeq shouldBe Seq((("allan", "123456"), "b05cc4c5d9c2da10c463ba4edf48d4c9"))
+  }
+
+  it should "match upper case md5s" in {
+    val found = UsersPasswordsJob.crack(
+      sc.parallelize(Seq("allan")),
+      sc.parallelize(Seq("123456", "654321")),
+      sc.parallelize(Seq("B05CC4C5D9C2DA10C463BA4EDF48D4C9")))
+
+    found.collect().map(_._1).toSeq shouldBe Seq(("allan", "123456"))
+  }
+
+  it should "hash like the MD5 hex digest" in {
+    UsersPasswordsJob.md5Hex("allan:123456") shouldBe "b05cc4c5d9c2da10c463ba4edf48d4c9"
+    UsersPasswordsJob.hex(Array[Byte](0, 15, -1)) shouldBe "000fff"
+  }
+
+}
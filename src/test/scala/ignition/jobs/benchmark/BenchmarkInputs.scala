@@ -0,0 +1,89 @@
+package ignition.jobs.benchmark
+
+import scala.reflect.ClassTag
+import scala.util.Random
+
+import ignition.jobs.UsersPasswordsJob
+import org.apache.spark.SparkContext
+import org.apache.spark.rdd.RDD
+
+// Synthetic inputs for the setups, generated in the executors so big inputs don't go through the driver
+// The same size, number of partitions and seed always generate the same records
+object BenchmarkInputs {
+
+  // Status codes and their weights in the access logs
+  val statuses = Seq("200" -> 70, "201" -> 2, "401" -> 8, "403" -> 5, "404" -> 5, "500" -> 10)
+  val pages = 1000
+  val vocabulary = 10000
+  val wordsPerLine = 10
+
+  def generate[T: ClassTag](sc: SparkContext, records: Int, partitions: Int, seed: Long)(record: (Random, Long) => T): RDD[T] =
+    sc.parallelize(0 until partitions, partitions).flatMap { partition =>
+      val random = new Random(seed * 31 + partition)
+      val start = records.toLong * partition / partitions
+      val end = records.toLong * (partition + 1) / partitions
+      (start until end).iterator.map { id => record(random, id) }
+    }
+
+  // A number in [0, n) where the low numbers are much more frequent, like pages, IPs or words in real data
+  def skewed(random: Random, n: Int): Int =
+    math.min(n - 1, (n * math.pow(random.nextDouble(), 3)).toInt)
+
+  def status(random: Random): String = {
+    var weight = random.nextInt(statuses.map(_._2).sum)
+    statuses.find { case (_, w) => weight -= w; weight < 0 }.get._1
+  }
+
+  // A lower case word of at least 4 letters for each number
+  def word(i: Int): String = {
+    val letters = new StringBuilder
+    var n = i + 26 * 26 * 26
+    while (n > 0) {
+      letters += ('a' + n % 26).toChar
+      n /= 26
+    }
+    letters.toString
+  }
+
+  def ip(i: Int): String = s"10.${(i >> 16) & 255}.${(i >> 8) & 255}.${i & 255}"
+
+  // "<request id> <page> <status>", like the samples of the LogAnalysis setups
+  def logLines(sc: SparkContext, records: Int, partitions: Int, seed: Long): RDD[String] =
+    generate(sc, records, partitions, seed) { (random, id) =>
+      s"$id /page${skewed(random, pages)}.html ${status(random)}"
+    }
+
+  // "<request id> <ip>" for the same request ids as logLines, with a request per 20 IPs on average
+  def addressLines(sc: SparkContext, records: Int, partitions: Int, seed: Long): RDD[String] = {
+    val ips = math.max(1, records / 20)
+    generate(sc, records, partitions, seed + 1) { (random, id) =>
+      s"$id ${ip(skewed(random, ips))}"
+    }
+  }
+
+  def textLines(sc: SparkContext, records: Int, partitions: Int, seed: Long): RDD[String] =
+    generate(sc, records, partitions, seed) { (random, _) =>
+      Seq.fill(wordsPerLine)(word(skewed(random, vocabulary))).mkString(" ")
+    }
+
+  // One word per line, each a random permutation of a word of the vocabulary, so there are many anagram groups
+  def permutedWords(sc: SparkContext, records: Int, partitions: Int, seed: Long): RDD[String] =
+    generate(sc, records, partitions, seed) { (random, _) =>
+      random.shuffle(word(skewed(random, vocabulary)).toSeq).mkString
+    }
+
+  def users(sc: SparkContext, records: Int, partitions: Int): RDD[String] =
+    generate(sc, records, partitions, 0) { (_, id) => s"user$id" }
+
+  def passwords(sc: SparkContext, records: Int, partitions: Int): RDD[String] =
+    generate(sc, records, partitions, 0) { (_, id) => s"password$id" }
+
+  // MD5s of "user:password", half of them of pairs of users and passwords, the other half of unknown pairs
+  def md5s(sc: SparkContext, users: Int, passwords: Int, records: Int, partitions: Int, seed: Long): RDD[String] =
+    generate(sc, records, partitions, seed) { (random, id) =>
+      if (id % 2 == 0)
+        UsersPasswordsJob.md5Hex(s"user${random.nextInt(users)}:password${random.nextInt(passwords)}")
+      else
+        UsersPasswordsJob.md5Hex(s"unknown$id:${random.nextLong()}")
+    }
+}
@@ -0,0 +1,232 @@
+package ignition.jobs.benchmark
+
+import java.io.{File, PrintWriter}
+import java.lang.management.{ManagementFactory, MemoryType}
+import java.util.concurrent.{LinkedBlockingQueue, TimeUnit}
+import java.util.concurrent.atomic.AtomicLong
+
+import scala.collection.JavaConverters._
+import scala.io.Source
+
+import ignition.jobs.{LogAnalysisJob, PermutationsJob, UsersPasswordsJob, WordCountJob}
+import org.apache.spark.rdd.RDD
+import org.apache.spark.scheduler.{SparkListener, SparkListenerJobStart, SparkListenerTaskEnd}
+import org.apache.spark.{SparkConf, SparkContext}
+
+// Runs the jobs of each setup in Runner.availableJobsSetups in Spark local mode against generated inputs (see
+// BenchmarkInputs) and reports records per second, shuffle bytes written and peak heap, comparing them with a baseline
+// Usage:
+//   ./sbt "test:runMain ignition.jobs.benchmark.SetupsBenchmark [--records N] [--partitions N] [--iterations N]
+//       [--only Name1,Name2] [--baseline path] [--save-baseline] [--tolerance 0.2]"
+// It exits with 1 if any benchmark regressed, so it can be used in a CI step
+// HelloWorldSetup is left out: it only counts files in S3
+object SetupsBenchmark {
+
+  // A benchmark generates and caches its inputs, then returns their number of records and the job to time
+  case class Benchmark(name: String, prepare: (SparkContext, Config) => (Long, () => Any))
+
+  case class Config(records: Int = 100000,
+                    partitions: Int = 8,
+                    warmup: Int = 1,
+                    iterations: Int = 3,
+                    seed: Long = 0,
+                    only: Set[String] = Set.empty,
+                    baselinePath: String = "src/test/resources/benchmark-baseline.tsv",
+                    saveBaseline: Boolean = false,
+                    tolerance: Double = 0.2)
+
+  // Best records per second of the iterations, shuffle bytes of the last one and the highest peak heap of them all
+  case class Measurement(name: String, records: Long, recordsPerSecond: Double, shuffleBytes: Long, peakHeapBytes: Long)
+
+  def cached[T](rdd: RDD[T]): RDD[T] = {
+    rdd.cache()
+    rdd.count()
+    rdd
+  }
+
+  val benchmarks = Seq(
+    Benchmark("WordCountSetup", { (sc, config) =>
+      val lines = cached(BenchmarkInputs.textLines(sc, config.records, config.partitions, config.seed))
+      (config.records.toLong, () => WordCountJob.wc(lines).map { case (word, count) => (count, word) }.top(1000))
+    }),
+    Benchmark("LogAnalysisSetup1", { (sc, config) =>
+      val lines = cached(BenchmarkInputs.logLines(sc, config.records, config.partitions, config.seed))
+      (config.records.toLong, () => LogAnalysisJob.statusProportions(lines, Seq("200", "500", "401")))
+    }),
+    Benchmark("LogAnalysisSetup2", { (sc, config) =>
+      val lines = cached(BenchmarkInputs.logLines(sc, config.records, config.partitions, config.seed))
+      val addresses = cached(BenchmarkInputs.addressLines(sc, config.records, config.partitions, config.seed))
+      (config.records * 2L, () => LogAnalysisJob.affectedIpsProportion(lines, addresses, "401"))
+    }),
+    Benchmark("LogAnalysisSetup3", { (sc, config) =>
+      val lines = cached(BenchmarkInputs.logLines(sc, config.records, config.partitions, config.seed))
+      (config.records.toLong, () => LogAnalysisJob.topPages(lines, 5))
+    }),
+    Benchmark("LogAnalysisSetup3Approx", { (sc, config) =>
+      val lines = cached(BenchmarkInputs.logLines(sc, config.records, config.partitions, config.seed))
+      (config.records.toLong, () => LogAnalysisJob.approxTopPages(lines, 5))
+    }),
+    Benchmark("PermutationsSetup", { (sc, config) =>
+      val words = cached(BenchmarkInputs.permutedWords(sc, config.records, config.partitions, config.seed))
+      (config.records.toLong, () => PermutationsJob.permutations(words).count())
+    }),
+    Benchmark("PermutationsSetupDropSingletons", { (sc, config) =>
+      val words = cached(BenchmarkInputs.permutedWords(sc, config.records, config.partitions, config.seed))
+      (config.records.toLong, () => PermutationsJob.permutations(words, dropSingletons = true).count())
+    }),
+    Benchmark("UsersPasswordsSetup", { (sc, config) =>
+      // The records are the candidate (user, password) pairs, as many as the other benchmarks have input records
+      val side = math.max(1, math.sqrt(config.records.toDouble).toInt)
+      val targets = 20
+      val users = cached(BenchmarkInputs.users(sc, side, config.partitions))
+      val passwords = cached(BenchmarkInputs.passwords(sc, side, config.partitions))
+      val md5s = cached(BenchmarkInputs.md5s(sc, side, side, targets, config.partitions, config.seed))
+      (side.toLong * side, () => UsersPasswordsJob.crack(users, passwords, md5s).count())
+    })
+  )
+
+  // Sums the shuffle bytes written by the tasks. Listener events are delivered asynchronously, so a measurement
+  // ends with a marker job: when its start is seen, all the events of the benchmarked jobs were seen too
+  class BenchmarkListener extends SparkListener {
+    val shuffleBytes = new AtomicLong(0)
+    val markers = new LinkedBlockingQueue[String]()
+
+    override def onTaskEnd(taskEnd: SparkListenerTaskEnd) {
+      for (metrics <- Option(taskEnd.taskMetrics); writeMetrics <- metrics.shuffleWriteMetrics)
+        shuffleBytes.addAndGet(writeMetrics.shuffleBytesWritten)
+    }
+
+    override def onJobStart(jobStart: SparkListenerJobStart) {
+      for (properties <- Option(jobStart.properties); group <- Option(properties.getProperty("spark.jobGroup.id"))
+           if group.startsWith(markerGroupPrefix))
+        markers.put(group)
+    }
+  }
+
+  val markerGroupPrefix = "benchmark-marker-"
+  val markerTimeoutSeconds = 60
+
+  def waitForListener(sc: SparkContext, listener: BenchmarkListener, marker: String) {
+    sc.setJobGroup(markerGroupPrefix + marker, "benchmark marker")
+    sc.parallelize(Seq(1), 1).count()
+    sc.clearJobGroup()
+    var group = listener.markers.poll(markerTimeoutSeconds, TimeUnit.SECONDS)
+    while (group != null && group != markerGroupPrefix + marker)
+      group = listener.markers.poll(markerTimeoutSeconds, TimeUnit.SECONDS)
+    require(group != null, s"Listener events of $marker were not delivered in $markerTimeoutSeconds seconds")
+  }
+
+  def heapPools = ManagementFactory.getMemoryPoolMXBeans.asScala.filter(_.getType == MemoryType.HEAP)
+
+  def measure(sc: SparkContext, listener: BenchmarkListener, benchmark: Benchmark, config: Config): Measurement = {
+    val (records, job) = benchmark.prepare(sc, config)
+    try {
+      (1 to config.warmup).foreach { _ => job() }
+      val runs = (1 to config.iterations).map { i =>
+        System.gc()
+        heapPools.foreach(_.resetPeakUsage())
+        listener.shuffleBytes.set(0)
+        val start = System.nanoTime()
+        job()
+        val seconds = (System.nanoTime() - start) / 1e9
+        val peakHeapBytes = heapPools.map(_.getPeakUsage.getUsed).sum
+        waitForListener(sc, listener, s"${benchmark.name}-$i")
+        (seconds, listener.shuffleBytes.get, peakHeapBytes)
+      }
+      Measurement(benchmark.name, records, records / runs.map(_._1).min, runs.last._2, runs.map(_._3).max)
+    } finally {
+      sc.getPersistentRDDs.values.foreach(_.unpersist())
+    }
+  }
+
+  // Throughput can be lower, and shuffle bytes and peak heap higher, than the baseline by the tolerance
+  // Measurements of a different number of records aren't compared
+  def regressions(measurement: Measurement, baseline: Measurement, tolerance: Double): Seq[String] =
+    if (measurement.records != baseline.records)
+      Seq.empty
+    else
+      Seq(
+        if (measurement.recordsPerSecond < baseline.recordsPerSecond * (1 - tolerance))
+          Option(f"records/s ${measurement.recordsPerSecond}%.0f < ${baseline.recordsPerSecond}%.0f") else None,
+        if (measurement.shuffleBytes > baseline.shuffleBytes * (1 + tolerance))
+          Option(s"shuffle bytes ${measurement.shuffleBytes} > ${baseline.shuffleBytes}") else None,
+        if (measurement.peakHeapBytes > baseline.peakHeapBytes * (1 + tolerance))
+          Option(s"peak heap ${measurement.peakHeapBytes} > ${baseline.peakHeapBytes}") else None
+      ).flatten
+
+  // Tab separated: name, records, records per second, shuffle bytes, peak heap bytes
+  def loadBaseline(path: String): Map[String, Measurement] =
+    if (!new File(path).exists)
+      Map.empty
+    else {
+      val source = Source.fromFile(path)
+      try {
+        source.getLines().filter(_.nonEmpty).map { line =>
+          val Array(name, records, recordsPerSecond, shuffleBytes, peakHeapBytes) = line.split("\t")
+          name -> Measurement(name, records.toLong, recordsPerSecond.toDouble, shuffleBytes.toLong, peakHeapBytes.toLong)
+        }.toMap
+      } finally {
+        source.close()
+      }
+    }
+
+  def saveBaseline(path: String, measurements: Seq[Measurement]) {
+    val writer = new PrintWriter(path)
+    try {
+      measurements.foreach { m =>
+        writer.println(Seq(m.name, m.records, m.recordsPerSecond, m.shuffleBytes, m.peakHeapBytes).mkString("\t"))
+      }
+    } finally {
+      writer.close()
+    }
+  }
+
+  def parseArgs(args: List[String], config: Config = Config()): Config = args match {
+    case Nil => config
+    case "--records" :: value :: rest => parseArgs(rest, config.copy(records = value.toInt))
+    case "--partitions" :: value :: rest => parseArgs(rest, config.copy(partitions = value.toInt))
+    case "--warmup" :: value :: rest => parseArgs(rest, config.copy(warmup = value.toInt))
+    case "--iterations" :: value :: rest => parseArgs(rest, config.copy(iterations = value.toInt))
+    case "--seed" :: value :: rest => parseArgs(rest, config.copy(seed = value.toLong))
+    case "--only" :: value :: rest => parseArgs(rest, config.copy(only = value.split(",").toSet))
+    case "--baseline" :: value :: rest => parseArgs(rest, config.copy(baselinePath = value))
+    case "--save-baseline" :: rest => parseArgs(rest, config.copy(saveBaseline = true))
+    case "--tolerance" :: value :: rest => parseArgs(rest, config.copy(tolerance = value.toDouble))
+    case unknown :: _ => throw new IllegalArgumentException(s"Unknown argument $unknown")
+  }
+
+  def main(args: Array[String]) {
+    val config = parseArgs(args.toList)
+    val sparkConf = new SparkConf()
+      .setMaster(s"local[${config.partitions}]")
+      .setAppName("SetupsBenchmark")
+      .set("spark.ui.enabled", "false")
+    val sc = new SparkContext(sparkConf)
+    val listener = new BenchmarkListener
+    sc.addSparkListener(listener)
+    val baseline = loadBaseline(config.baselinePath)
+    val measurements = try {
+      benchmarks.filter(b => config.only.isEmpty || config.only.contains(b.name)).map { benchmark =>
+        measure(sc, listener, benchmark, config)
+      }
+    } finally {
+      sc.stop()
+    }
+
+    println("%-32s %10s %12s %11s %13s".format("setup", "records", "records/s", "shuffle MB", "peak heap MB"))
+    val regressed = measurements.map { m =>
+      val found = baseline.get(m.name).map(b => regressions(m, b, config.tolerance)).getOrElse(Seq.empty)
+      val flag = if (found.nonEmpty) found.mkString("  REGRESSION: ", ", ", "")
+                 else if (baseline.get(m.name).exists(_.records == m.records)) "" else "  (no baseline)"
+      println(f"${m.name}%-32s ${m.records}%10d ${m.recordsPerSecond}%12.0f ${m.shuffleBytes / 1e6}%11.2f ${m.peakHeapBytes / 1e6}%13.1f$flag")
+      found.nonEmpty
+    }
+
+    if (config.saveBaseline) {
+      saveBaseline(config.baselinePath, (baseline -- measurements.map(_.name)).values.toSeq ++ measurements)
+      println(s"Baseline saved to ${config.baselinePath}")
+    } else if (regressed.contains(true)) {
+      sys.exit(1)
+    }
+  }
+}
@@ -0,0 +1,29 @@
+package ignition.jobs.benchmark
+
+import ignition.jobs.benchmark.SetupsBenchmark.Measurement
+import org.scalatest.{ShouldMatchers, FlatSpec}
+
+
+class SetupsBenchmarkSpec extends FlatSpec with ShouldMatchers {
+
+  val baseline = Measurement("WordCountSetup", 1000, 500.0, 2000, 100000)
+
+  "SetupsBenchmark" should "flag a measurement worse than the baseline by more than the tolerance" in {
+    val slower = baseline.copy(recordsPerSecond = 350.0, shuffleBytes = 3000)
+
+    SetupsBenchmark.regressions(slower, baseline, 0.2) should have size 2
+  }
+
+  it should "accept a measurement within the tolerance" in {
+    val noisy = baseline.copy(recordsPerSecond = 450.0, peakHeapBytes = 110000)
+
+    SetupsBenchmark.regressions(noisy, baseline, 0.2) shouldBe empty
+  }
+
+  it should "not compare measurements of a different number of records" in {
+    val bigger = baseline.copy(records = 2000, recordsPerSecond = 100.0)
+
+    SetupsBenchmark.regressions(bigger, baseline, 0.2) shouldBe empty
+  }
+
+}